@@ -0,0 +1,707 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# deb/archive.py - compare source packages without unpacking them
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Produce what "diff -pruN" prints for two source packages unpacked with
+"dpkg-source --skip-patches -x", straight from their tarballs.
+
+The tarballs are read as streams, so nothing is written to disk, and a
+tarball both packages use (usually the .orig.tar) is read only once and
+its members are never compared. Only the members that differ are kept in
+memory, and diffed with util.diff.
+
+Sources whose unpacked trees cannot be worked out this way (format 1.0
+with a .diff.gz, symlinks leaving the tree, special files and so on), or
+whose differences are too large to be worth diffing in Python, raise
+Unsupported; they should be unpacked and compared with diff instead.
+"""
+
+from __future__ import with_statement
+
+import gzip
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tarfile
+from contextlib import contextmanager
+
+from deb.controlfile import ControlFile
+from util import diff
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+logger = logging.getLogger('deb.archive')
+
+# Beyond this much differing content, unpacking and running diff is faster
+MAX_CHANGED_BYTES = 64 << 20
+
+# Listings of the tarballs read recently, since consecutive diffs of a
+# package share one side: {(checksum, hashed): _Listing}
+_listings = {}
+_LISTINGS_KEPT = 8
+
+_TARBALL_RE = re.compile(r'\.tar\.(gz|bz2|xz|lzma)$')
+
+
+class Unsupported(Exception):
+    """The sources can't be compared from their tarballs."""
+    pass
+
+
+class _Member(object):
+    """What extracting one tarball member leaves in the tree."""
+
+    def __init__(self, kind, size=0, mtime=0, nsec=0, linkname=None,
+                 source=None, sha=None):
+        # "file", "symlink", "dir" or "other"
+        self.kind = kind
+        self.size = size
+        self.mtime = mtime
+        self.nsec = nsec
+        self.linkname = linkname
+        # (tarball checksum, member name) to read the contents from
+        self.source = source
+        self.sha = sha
+
+
+class _Listing(object):
+    """The members of a tarball, as (raw name, _Member) in order."""
+
+    def __init__(self, checksum, members, hashed):
+        self.checksum = checksum
+        self.members = members
+        self.hashed = hashed
+
+
+class _Tree(object):
+    """The tree dpkg-source would unpack: {path: _Member}, with the
+    directories implied by the paths in dirs.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.dirs = set()
+
+    def _children(self, path):
+        prefix = path + '/'
+        return [p for p in self.nodes if p.startswith(prefix)] \
+            + [d for d in self.dirs if d.startswith(prefix)]
+
+    def erase(self, path):
+        for p in self._children(path):
+            self.nodes.pop(p, None)
+            self.dirs.discard(p)
+        self.nodes.pop(path, None)
+        self.dirs.discard(path)
+
+    def put(self, path, member):
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            parent = '/'.join(parts[:i])
+            node = self.nodes.get(parent)
+            if node is not None and node.kind != 'dir':
+                raise Unsupported('%s is not a directory' % parent)
+            self.dirs.add(parent)
+
+        if member.kind == 'dir':
+            node = self.nodes.get(path)
+            if node is not None and node.kind != 'dir':
+                del self.nodes[path]
+            self.dirs.add(path)
+        elif path in self.dirs:
+            if self._children(path):
+                raise Unsupported('%s replaces a directory' % path)
+            self.dirs.discard(path)
+        self.nodes[path] = member
+
+    def isdir(self, path):
+        return path == '' or path in self.dirs
+
+    def resolve(self, path):
+        """Return the regular file path leads to, following symlinks as
+        diff does, or raise Unsupported.
+        """
+        todo = path.split('/')
+        done = []
+        hops = 0
+        while todo:
+            part = todo.pop(0)
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if not done:
+                    raise Unsupported('%s leads out of the tree' % path)
+                done.pop()
+                continue
+            done.append(part)
+            current = '/'.join(done)
+            node = self.nodes.get(current)
+            if node is not None and node.kind == 'symlink':
+                hops += 1
+                if hops > 40 or node.linkname.startswith('/'):
+                    raise Unsupported('cannot follow %s' % path)
+                done.pop()
+                todo = node.linkname.split('/') + todo
+            elif todo and not self.isdir(current):
+                raise Unsupported('cannot follow %s' % path)
+
+        current = '/'.join(done)
+        node = self.nodes.get(current)
+        if node is None or node.kind != 'file':
+            raise Unsupported('%s is not a regular file' % path)
+        return node
+
+    def files(self):
+        """Return {path: _Member} for what diff compares as files."""
+        ret = {}
+        for path, node in self.nodes.iteritems():
+            if node.kind == 'file':
+                ret[path] = node
+            elif node.kind == 'symlink':
+                ret[path] = self.resolve(path)
+            elif node.kind != 'dir':
+                raise Unsupported('%s is a special file' % path)
+        return ret
+
+
+def _parts(name):
+    """Split a member name as tar would extract it."""
+    parts = [p for p in name.split('/') if p not in ('', '.')]
+    if '..' in parts:
+        raise Unsupported('%s leads out of the tree' % name)
+    return parts
+
+
+@contextmanager
+def _open_tarball(filename):
+    """Open a compressed tarball for reading as a stream."""
+    ext = _TARBALL_RE.search(filename).group(1)
+    if ext in ('gz', 'bz2'):
+        tar = tarfile.open(filename, 'r|' + ext)
+        try:
+            yield tar
+        finally:
+            tar.close()
+    elif lzma is not None:
+        f = lzma.LZMAFile(filename)
+        try:
+            yield tarfile.open(fileobj=f, mode='r|')
+        finally:
+            f.close()
+    else:
+        with open(filename, 'rb') as f:
+            proc = subprocess.Popen(('xz', '-dc'), stdin=f,
+                                    stdout=subprocess.PIPE)
+        try:
+            yield tarfile.open(fileobj=proc.stdout, mode='r|')
+            # read what tarfile left, so that xz can finish
+            while proc.stdout.read(65536):
+                pass
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise IOError('xz -dc %s failed' % filename)
+
+
+def _mtime(info):
+    """Return (seconds, nanoseconds) of a member's modification time."""
+    value = info.pax_headers.get('mtime')
+    if value is None:
+        return int(info.mtime), 0
+    if '.' in value:
+        seconds, fraction = value.split('.', 1)
+        return int(seconds), int((fraction + '000000000')[:9])
+    return int(value), 0
+
+
+def _list(filename, checksum, hashed):
+    """Read a tarball and return its _Listing, with the SHA-256 of every
+    regular file if hashed is True.
+    """
+    cached = _listings.get((checksum, hashed)) or _listings.get((checksum, True))
+    if cached is not None:
+        return cached
+
+    members = []
+    by_name = {}
+    with _open_tarball(filename) as tar:
+        for info in tar:
+            mtime, nsec = _mtime(info)
+            if info.issparse():
+                raise Unsupported('%s has sparse files' % filename)
+            elif info.isreg():
+                sha = None
+                if hashed:
+                    h = hashlib.sha256()
+                    f = tar.extractfile(info)
+                    for chunk in iter(lambda: f.read(1 << 20), ''):
+                        h.update(chunk)
+                    sha = h.hexdigest()
+                member = _Member('file', info.size, mtime, nsec,
+                                 source=(checksum, info.name), sha=sha)
+            elif info.islnk():
+                target = by_name.get(info.linkname)
+                if target is None or target.kind != 'file':
+                    raise Unsupported('cannot follow hard link %s in %s'
+                                      % (info.name, filename))
+                member = target
+            elif info.issym():
+                member = _Member('symlink', linkname=info.linkname)
+            elif info.isdir():
+                member = _Member('dir')
+            else:
+                member = _Member('other')
+            members.append((info.name, member))
+            by_name[info.name] = member
+
+    listing = _Listing(checksum, members, hashed)
+    if len(_listings) >= _LISTINGS_KEPT:
+        _listings.clear()
+    _listings[(checksum, hashed)] = listing
+    return listing
+
+
+def _extract(tree, listing, dest='', in_place=False, exclude_pc=False):
+    """Add the members of a tarball to tree as Dpkg::Source::Archive
+    would extract them into dest: into a temporary directory first, then
+    either merged into dest, or replacing dest with the single directory
+    at the top, if there is one, or with the whole of it.
+    """
+    extracted = _Tree()
+    for name, member in listing.members:
+        raw = name.split('/')
+        # --anchored --no-wildcards-match-slash --exclude */.pc --exclude .pc
+        if exclude_pc and (raw[0] == '.pc' or raw[1:2] == ['.pc']):
+            continue
+        parts = _parts(name)
+        if parts:
+            extracted.put('/'.join(parts), member)
+
+    paths = set(extracted.nodes) | extracted.dirs
+    prefix = dest + '/' if dest else ''
+    if in_place:
+        # directories are merged, anything else replaces what was there
+        for path in sorted(paths, key=_sort_key):
+            if extracted.isdir(path) and tree.isdir(prefix + path):
+                continue
+            if prefix + path in tree.dirs and tree._children(prefix + path):
+                raise Unsupported('%s replaces a directory' % path)
+            tree.erase(prefix + path)
+            tree.put(prefix + path,
+                     extracted.nodes.get(path) or _Member('dir'))
+        return
+
+    strip = 0
+    tops = set(path.split('/')[0] for path in paths)
+    if len(tops) == 1:
+        top = tops.pop()
+        if extracted.isdir(top):
+            strip = len(top) + 1
+            paths.discard(top)
+    if dest:
+        tree.erase(dest)
+        tree.put(dest, _Member('dir'))
+    for path in sorted(paths, key=_sort_key):
+        tree.put(prefix + path[strip:],
+                 extracted.nodes.get(path) or _Member('dir'))
+
+
+def _read_dsc(dsc_filename):
+    """Return the format of a source package and {name: checksum} for
+    the files that make it up.
+    """
+    dsc = ControlFile(dsc_filename, multi_para=False, signed=True).para
+    fmt = dsc.get('Format', '1.0').strip()
+
+    checksums = {}
+    for field in ('Files', 'Checksums-Sha256'):
+        for line in dsc.get(field, '').strip().splitlines():
+            checksum, size, name = line.split(None, 2)
+            checksums[name] = '%s:%s' % (checksum, size)
+    return fmt, checksums
+
+
+def _layout(dsc_filename):
+    """Return the format of a source package and (role, filename,
+    checksum, destination) for each of its tarballs, in the order
+    dpkg-source extracts them.
+    """
+    fmt, checksums = _read_dsc(dsc_filename)
+
+    orig = None
+    debian = None
+    native = None
+    components = {}
+    for name in sorted(checksums):
+        if name.endswith('.asc'):
+            continue
+        if name.endswith('.diff.gz'):
+            raise Unsupported('%s needs patching' % dsc_filename)
+        if not _TARBALL_RE.search(name):
+            raise Unsupported('%s has unknown file %s' % (dsc_filename, name))
+        match = re.search(r'\.orig-([A-Za-z0-9-]+)\.tar\.', name)
+        if match:
+            components[match.group(1)] = name
+        elif '.orig.tar.' in name:
+            orig = name
+        elif '.debian.tar.' in name:
+            debian = name
+        else:
+            native = name
+
+    if fmt == '3.0 (quilt)' and orig and debian and native is None:
+        steps = [('orig', orig, '')]
+        steps += [('component', components[c], c)
+                  for c in sorted(components)]
+        steps.append(('debian', debian, 'debian'))
+    elif fmt in ('1.0', '3.0 (native)') and native \
+            and not (orig or debian or components):
+        steps = [('native', native, '')]
+    else:
+        raise Unsupported('%s has format %s' % (dsc_filename, fmt))
+
+    directory = os.path.dirname(dsc_filename)
+    return fmt, [(role, os.path.join(directory, name), checksums[name], dest)
+                 for role, name, dest in steps]
+
+
+def _build(fmt, layout, shared):
+    """Return the _Tree for a source package."""
+    tree = _Tree()
+    for role, filename, checksum, dest in layout:
+        listing = _list(filename, checksum, hashed=checksum not in shared)
+        if role == 'orig':
+            _extract(tree, listing, exclude_pc=True)
+        elif role == 'component':
+            _extract(tree, listing, dest=dest)
+        elif role == 'debian':
+            tree.erase('debian')
+            _extract(tree, listing, in_place=True)
+        else:
+            _extract(tree, listing)
+
+    # dpkg-source writes one, as of the time it unpacks the source
+    if fmt != '1.0' and 'debian/source/format' not in tree.nodes:
+        raise Unsupported('%s has no debian/source/format' % fmt)
+    return tree
+
+
+def _fetch(layouts, wanted):
+    """Return {(checksum, member name): contents} for the members in
+    wanted, reading each tarball that holds some of them once.
+    """
+    contents = {}
+    done = set()
+    for layout in layouts:
+        for role, filename, checksum, dest in layout:
+            names = set(name for c, name in wanted if c == checksum)
+            if not names or checksum in done:
+                continue
+            done.add(checksum)
+            with _open_tarball(filename) as tar:
+                for info in tar:
+                    if info.name in names and info.isreg():
+                        contents[(checksum, info.name)] = \
+                            tar.extractfile(info).read()
+    return contents
+
+
+_HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+def _added_by_diff(filename, wanted):
+    """Return {path: contents} for the files for which wanted(path) is
+    true that the .diff.gz of a format 1.0 source package creates, or
+    raise Unsupported if it changes any of them rather than creating them.
+    """
+    found = {}
+    current = None
+    with gzip.open(filename) as f:
+        for line in f:
+            if line.startswith('+++ '):
+                name = line[4:].rstrip('\n').split('\t')[0]
+                path = '/'.join(_parts(name)[1:])
+                current = path if wanted(path) else None
+                continue
+            match = _HUNK_RE.match(line)
+            if match is None:
+                continue
+            old = int(match.group(2) or 1)
+            new = int(match.group(4) or 1)
+            if current is None:
+                # skip the hunk, whose lines might look like anything
+                while old or new:
+                    line = f.next()
+                    if line[:1] in ' -':
+                        old -= 1
+                    if line[:1] in ' +':
+                        new -= 1
+                continue
+            if current in found or old:
+                raise Unsupported('%s changes %s' % (filename, current))
+            lines = found[current] = [f.next()[1:] for i in range(new)]
+            if next(f, '').startswith('\\'):
+                lines[-1] = lines[-1].rstrip('\n')
+            current = None
+    return dict((path, ''.join(lines)) for path, lines in found.iteritems())
+
+
+def _source_tree(dsc_filename, debian_only):
+    """Return the layout of a source package without a .diff.gz and its
+    _Tree; if debian_only is True, only what is under debian/ is sure to
+    be in the tree.
+    """
+    fmt, layout = _layout(dsc_filename)
+    if debian_only and layout[-1][0] == 'debian':
+        # the debian directory comes from the debian tarball alone
+        layout = layout[-1:]
+        tree = _Tree()
+        _extract(tree, _list(layout[0][1], layout[0][2], hashed=False),
+                 in_place=True)
+    else:
+        everything = set(checksum for role, filename, checksum, dest in layout)
+        tree = _build(fmt, layout, everything)
+    return layout, tree
+
+
+def _read_members(layout, members):
+    """Return {path: contents} for {path: _Member} of regular files."""
+    contents = _fetch((layout,), set(m.source for m in members.values()))
+    return dict((path, contents[member.source])
+                for path, member in members.iteritems())
+
+
+def read_files(dsc_filename, paths):
+    """Return {path: contents} for the regular files among paths in the
+    tree "dpkg-source --skip-patches -x" unpacks from the .dsc file
+    dsc_filename, reading as little of the source as it can. Paths that
+    are not in the tree are left out.
+
+    Files under debian/ are all it can read from format 1.0 sources
+    with a .diff.gz, and only if the diff creates them; otherwise, and
+    for files it cannot tell the contents of without unpacking the
+    source, it raises Unsupported.
+    """
+    paths = set(paths)
+    fmt, checksums = _read_dsc(dsc_filename)
+    diffs = [name for name in checksums if name.endswith('.diff.gz')]
+    if diffs:
+        if [path for path in paths if not path.startswith('debian/')]:
+            raise Unsupported('%s needs patching' % dsc_filename)
+        found = _added_by_diff(
+            os.path.join(os.path.dirname(dsc_filename), diffs[0]),
+            paths.__contains__)
+        if set(found) != paths:
+            raise Unsupported('%s does not create %s'
+                              % (diffs[0], ', '.join(paths - set(found))))
+        return found
+
+    layout, tree = _source_tree(
+        dsc_filename, all(path.startswith('debian/') for path in paths))
+    members = {}
+    for path in paths:
+        node = tree.nodes.get(path)
+        if node is None:
+            continue
+        if node.kind != 'file':
+            raise Unsupported('%s is not a regular file' % path)
+        members[path] = node
+    return _read_members(layout, members)
+
+
+def read_tree(dsc_filename, directory):
+    """Return {path: contents} for everything under directory in the
+    tree "dpkg-source --skip-patches -x" unpacks from the .dsc file
+    dsc_filename, with paths relative to directory; it is empty if there
+    is no such directory.
+
+    Only the debian tarball is read for a directory under debian/, and
+    only the .diff.gz of format 1.0 sources that have one, which must
+    create all of the directory. Anything but regular files or
+    directories under it raises Unsupported, as do other directories
+    of format 1.0 sources with a .diff.gz.
+    """
+    prefix = directory.strip('/') + '/'
+    fmt, checksums = _read_dsc(dsc_filename)
+    diffs = [name for name in checksums if name.endswith('.diff.gz')]
+    if diffs:
+        if not prefix.startswith('debian/'):
+            raise Unsupported('%s needs patching' % dsc_filename)
+        found = _added_by_diff(
+            os.path.join(os.path.dirname(dsc_filename), diffs[0]),
+            lambda path: path.startswith(prefix))
+        return dict((path[len(prefix):], contents)
+                    for path, contents in found.iteritems())
+
+    layout, tree = _source_tree(dsc_filename, prefix.startswith('debian/'))
+    members = {}
+    for path, node in tree.nodes.iteritems():
+        if not path.startswith(prefix) or node.kind == 'dir':
+            continue
+        if node.kind != 'file':
+            raise Unsupported('%s is not a regular file' % path)
+        members[path[len(prefix):]] = node
+    return _read_members(layout, members)
+
+
+def _sort_key(path):
+    # diff -r goes through each directory in order of its entries' names
+    return path.split('/')
+
+
+def diff_sources(dsc_a, dsc_b, label_a, label_b, out, blksize=4096):
+    """Write to out what "diff -pruN label_a label_b" prints when label_a
+    and label_b are the sources described by the .dsc files dsc_a and
+    dsc_b, unpacked with "dpkg-source --skip-patches -x". blksize is the
+    block size of the filesystem they would be unpacked on, which decides
+    how much of each file diff checks for being binary.
+
+    Raise Unsupported if this can't be done from the tarballs; nothing
+    has been written to out then.
+    """
+    format_a, layout_a = _layout(dsc_a)
+    format_b, layout_b = _layout(dsc_b)
+    shared = set(c for r, f, c, d in layout_a) \
+        & set(c for r, f, c, d in layout_b)
+
+    files_a = _build(format_a, layout_a, shared).files()
+    files_b = _build(format_b, layout_b, shared).files()
+    _write_diff(files_a, files_b, (layout_a, layout_b), shared,
+                label_a, label_b, out, blksize)
+
+
+def _quilt_layout(dsc_filename):
+    fmt, layout = _layout(dsc_filename)
+    if fmt != '3.0 (quilt)':
+        raise Unsupported('%s has format %s' % (dsc_filename, fmt))
+    return layout
+
+
+def upstream_summary(dsc_a, dsc_b, label_a, label_b):
+    """Return '' if the 3.0 (quilt) sources described by the .dsc files
+    dsc_a and dsc_b have the same upstream tarballs, otherwise a few
+    lines naming them, with their sizes and how many files they hold,
+    to stand in for a diff of everything outside debian/.
+
+    Raise Unsupported for sources of other formats.
+    """
+    layouts = (_quilt_layout(dsc_a), _quilt_layout(dsc_b))
+    upstream = [[(filename, checksum) for role, filename, checksum, dest
+                 in layout if role != 'debian'] for layout in layouts]
+    if set(c for f, c in upstream[0]) == set(c for f, c in upstream[1]):
+        return ''
+
+    lines = ['Upstream sources differ between %s and %s; only debian/ '
+             'is compared.\n' % (label_a, label_b)]
+    for label, tarballs in zip((label_a, label_b), upstream):
+        described = []
+        for filename, checksum in tarballs:
+            listing = _list(filename, checksum, hashed=False)
+            count = len([m for name, m in listing.members
+                         if m.kind == 'file'])
+            described.append('%s (%s bytes, %d files)'
+                             % (os.path.basename(filename),
+                                checksum.split(':')[1], count))
+        lines.append(' %s: %s\n' % (label, ', '.join(described)))
+    return ''.join(lines)
+
+
+def diff_debian(dsc_a, dsc_b, label_a, label_b, out, blksize=4096):
+    """Write to out what "diff -pruN label_a/debian label_b/debian"
+    prints when label_a and label_b are the 3.0 (quilt) sources
+    described by the .dsc files dsc_a and dsc_b, unpacked as for
+    diff_sources(); only their debian tarballs are read.
+
+    Raise Unsupported if this can't be done from the debian tarballs,
+    or the sources have another format; nothing has been written to
+    out then.
+    """
+    layouts = (_quilt_layout(dsc_a)[-1:], _quilt_layout(dsc_b)[-1:])
+    shared = set([layouts[0][0][2]]) & set([layouts[1][0][2]])
+
+    files = []
+    for layout in layouts:
+        role, filename, checksum, dest = layout[0]
+        tree = _Tree()
+        _extract(tree, _list(filename, checksum,
+                             hashed=checksum not in shared),
+                 in_place=True)
+        # dpkg-source writes one, as of the time it unpacks the source
+        if 'debian/source/format' not in tree.nodes:
+            raise Unsupported('%s has no debian/source/format' % filename)
+        files.append(dict((path[len('debian/'):], member)
+                          for path, member in tree.files().iteritems()
+                          if path.startswith('debian/')))
+    _write_diff(files[0], files[1], layouts, shared,
+                label_a + '/debian', label_b + '/debian', out, blksize)
+
+
+def _write_diff(files_a, files_b, layouts, shared, label_a, label_b, out,
+                blksize):
+    """Write the diff of the trees whose files() are files_a and files_b
+    to out, reading what differs from the tarballs in layouts.
+    """
+    changed = []
+    wanted = set()
+    total = 0
+    for path in sorted(set(files_a) | set(files_b), key=_sort_key):
+        a = files_a.get(path)
+        b = files_b.get(path)
+        if a is not None and b is not None:
+            if a.source == b.source and a.source[0] in shared:
+                continue
+            if a.sha is not None and a.sha == b.sha:
+                continue
+        elif (a or b).size == 0:
+            continue
+        changed.append((path, a, b))
+        for member in (a, b):
+            if member is not None:
+                wanted.add(member.source)
+                total += member.size
+    if total > MAX_CHANGED_BYTES:
+        raise Unsupported('%d bytes differ' % total)
+
+    contents = _fetch(layouts, wanted)
+    logger.debug('%d of %d files differ between %s and %s', len(changed),
+                 len(set(files_a) | set(files_b)), label_a, label_b)
+
+    for path, a, b in changed:
+        name_a = '%s/%s' % (label_a, path)
+        name_b = '%s/%s' % (label_b, path)
+        text_a = contents[a.source] if a is not None else ''
+        text_b = contents[b.source] if b is not None else ''
+        if text_a == text_b:
+            continue
+
+        if diff.is_binary(text_a, blksize) or diff.is_binary(text_b, blksize):
+            out.write('Binary files %s and %s differ\n'
+                      % (diff.quote_name(name_a), diff.quote_name(name_b)))
+            continue
+
+        out.write('diff -pruN %s %s\n' % (diff.quote_name(name_a),
+                                          diff.quote_name(name_b)))
+        for mark, name, member in (('---', name_a, a), ('+++', name_b, b)):
+            if member is None:
+                stamp = diff.format_time(0)
+            else:
+                stamp = diff.format_time(member.mtime, member.nsec)
+            out.write('%s %s\t%s\n' % (mark, diff.quote_name(name), stamp))
+        out.write(diff.unified_hunks(text_a, text_b))
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# deb/changes.py - write source .changes files without unpacking sources
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Produce what "dpkg-genchanges -S" prints for a source package, from
+its .dsc and the debian/changelog and debian/control read out of its
+archives by deb.archive.
+
+Changelogs that dpkg-parsechangelog would complain about before it has
+read the entries it needs, and anything else this doesn't reproduce
+exactly, raise deb.archive.Unsupported so that the caller can unpack the
+source and run dpkg-genchanges instead.
+"""
+
+from __future__ import with_statement
+
+import hashlib
+import os
+import re
+import time
+from StringIO import StringIO
+
+from deb.archive import Unsupported, read_files
+from deb.controlfile import ControlFile
+from deb.version import Version
+
+URGENCIES = ('low', 'medium', 'high', 'critical', 'emergency')
+
+# The fields dpkg puts first in a .changes file, in order; any others
+# follow in alphabetical order
+FIELD_ORDER = ('Format', 'Date', 'Source', 'Binary', 'Binary-Only',
+               'Built-For-Profiles', 'Architecture', 'Version',
+               'Distribution', 'Urgency', 'Maintainer', 'Changed-By',
+               'Description', 'Closes', 'Changes', 'Checksums-Md5',
+               'Checksums-Sha1', 'Checksums-Sha256', 'Files')
+
+# Regular expressions from Dpkg::Changelog::Debian
+_NAME = r'[-+0-9a-z.]'
+HEADER_RE = re.compile(r'^(\w%s*) \(([^\(\) \t]+)\)((?:\s+%s+)+)\;(.*?)\s*$'
+                       % (_NAME, _NAME), re.IGNORECASE)
+TRAILER_RE = re.compile(r'^ \-\- (.*) <(.*)>(  ?)(((\w+)\,\s*)?'
+                        r'(\d{1,2}\s+(\w+)\s+\d{4}\s+\d{1,2}:\d\d:\d\d\s+'
+                        r'[-+]\d{4}))\s*$')
+ANCIENT_RE = re.compile(
+    r'^(?:\w+\s+\w+\s+\d{1,2} \d{1,2}:\d{1,2}:\d{1,2}\s+[\w\s]*\d{4}'
+    r'\s+(?:.*)\s+[<\(](?:.*)[\)>]'
+    r'|\w+\s+\w+\s+\d{1,2},?\s*\d{4}\s+(?:.*)\s+[<\(](?:.*)[\)>]'
+    r'|\w[-+0-9a-z.]* \((?:[^\(\) \t]+)\)\;?'
+    r'|[\w.+-]+[- ]\S+ Debian \S+'
+    r'|Changes from version .* to .*:'
+    r'|Changes for [\w.+-]+-[\w.+-]+:?\s*$'
+    r'|Old Changelog:\s*$'
+    r'|(?:\d+:)?\w[\w.+~-]*:?\s*$)', re.IGNORECASE)
+CLOSES_RE = re.compile(r'closes:\s*(?:bug)?\#?\s?\d+'
+                       r'(?:,\s*(?:bug)?\#?\s?\d+)*', re.IGNORECASE)
+LP_CLOSES_RE = re.compile(r'lp:\s+\#\d+(?:,\s*\#\d+)*', re.IGNORECASE)
+BUG_RE = re.compile(r'\#?\s?(\d+)')
+
+WEEK_DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec')
+
+
+class ChangelogEntry(object):
+    """One entry of a debian/changelog.
+
+    Properties:
+      header         Header line
+      source         Source package name
+      version        Version as written
+      distributions  List of distributions
+      urgency        Urgency, without any comment, or None
+      changes        Lines between header and trailer, without the blank
+                     lines around them
+      maintainer     "Name <address>" from the trailer
+      date           Date from the trailer
+    """
+
+    def __init__(self, line, match):
+        self.header = line
+        self.source = match.group(1)
+        self.version = match.group(2)
+        self.distributions = match.group(3).split()
+        self.urgency = None
+        self.changes = []
+        self.maintainer = None
+        self.date = None
+
+        options = match.group(4).lstrip()
+        keys = set()
+        for option in re.split(r'\s*,\s*', options) if options else []:
+            m = re.match(r'^([-0-9a-z]+)\=\s*(.*\S)$', option, re.IGNORECASE)
+            if m is None or m.group(1).lower() in keys:
+                raise Unsupported('bad changelog header: %s' % line)
+            keys.add(m.group(1).lower())
+            if m.group(1).lower() != 'urgency':
+                raise Unsupported('changelog header sets %s' % m.group(1))
+            if not re.match(r'^([-0-9a-z]+)((\s+.*)?)$', m.group(2),
+                            re.IGNORECASE):
+                raise Unsupported('bad urgency: %s' % m.group(2))
+            self.urgency = re.sub(r'\s.*$', '', m.group(2)).lower()
+
+    def closes(self):
+        """Return the bugs closed in the entry's changes."""
+        return _find_bugs(CLOSES_RE, '\n'.join(self.changes))
+
+    def dpkg_changes(self):
+        """Return the entry as it goes in the Changes field."""
+        return '\n%s\n\n%s' % (self.header.rstrip(), '\n'.join(self.changes))
+
+
+def _rank(urgency):
+    if urgency in URGENCIES:
+        return URGENCIES.index(urgency)
+    return -1
+
+
+def _find_bugs(regex, text):
+    bugs = set()
+    for match in regex.finditer(text):
+        bugs.update(BUG_RE.findall(match.group(0)))
+    return sorted(bugs, key=int)
+
+
+def _trailer(line, match):
+    """Check a trailer line the way dpkg-parsechangelog does."""
+    if match.group(3) != '  ':
+        raise Unsupported('bad changelog trailer: %s' % line)
+    if match.group(5) is not None and match.group(6) not in WEEK_DAYS:
+        raise Unsupported('bad week day in changelog: %s' % line)
+    try:
+        time.strptime(match.group(7).rsplit(None, 1)[0], '%d %b %Y %H:%M:%S')
+    except ValueError:
+        raise Unsupported('bad date in changelog: %s' % line)
+    if match.group(8) not in MONTHS:
+        raise Unsupported('bad month in changelog: %s' % line)
+
+
+def parse_changelog(text, enough=None):
+    """Parse the entries of a debian/changelog, as
+    Dpkg::Changelog::Debian does, and return them newest first.
+
+    If enough is given, parsing stops as soon as enough(entries) returns
+    True once an entry is complete, so what follows doesn't have to make
+    sense. Raise Unsupported where dpkg-parsechangelog would report an
+    error before then.
+    """
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    entries = []
+    entry = None
+    blank = []
+    # expecting: 'heading', 'changes' (start), 'more' (changes or
+    # trailer) or 'next' (heading or end of file)
+    expect = 'heading'
+    for line in lines:
+        match = HEADER_RE.match(line)
+        if match:
+            if expect not in ('heading', 'next'):
+                raise Unsupported('changelog entry without a trailer')
+            if entry is not None:
+                entries.append(entry)
+                if enough is not None and enough(entries):
+                    return entries
+            entry = ChangelogEntry(line, match)
+            expect = 'changes'
+            blank = []
+        elif re.match(r'^(?:;;\s*)?Local variables:', line, re.IGNORECASE) \
+                or re.match(r'^vim:', line, re.IGNORECASE):
+            break
+        elif re.match(r'^\$\w+:.*\$', line) or line.startswith('# ') \
+                or re.match(r'^/\*.*\*/', line):
+            continue
+        elif ANCIENT_RE.match(line):
+            # the rest is kept as it is, in the old format
+            break
+        elif re.match(r'^\S', line):
+            raise Unsupported('bad changelog line: %s' % line)
+        elif TRAILER_RE.match(line):
+            if expect != 'more':
+                raise Unsupported('unexpected changelog trailer: %s' % line)
+            match = TRAILER_RE.match(line)
+            _trailer(line, match)
+            entry.maintainer = '%s <%s>' % (match.group(1), match.group(2))
+            entry.date = match.group(4)
+            blank = []
+            expect = 'next'
+        elif line.startswith(' --'):
+            raise Unsupported('bad changelog trailer: %s' % line)
+        elif re.match(r'^\s{2,}\S', line):
+            if expect not in ('changes', 'more'):
+                raise Unsupported('unexpected changelog line: %s' % line)
+            entry.changes.extend(blank + [line])
+            blank = []
+            expect = 'more'
+        elif not line.strip():
+            if expect == 'more':
+                blank.append(line)
+        else:
+            raise Unsupported('bad changelog line: %s' % line)
+
+    if expect != 'next':
+        raise Unsupported('changelog ends in the middle of an entry')
+    if entry is not None:
+        entries.append(entry)
+    return entries
+
+
+def _since(entries, since):
+    """Return the entries dpkg-genchanges -v<since> describes."""
+    if since is None:
+        return entries[:1]
+
+    versions = [entry.version for entry in entries]
+    if since not in versions:
+        earlier = [v for v in versions if Version(v) < Version(since)]
+        if not earlier:
+            return entries
+        since = earlier[0]
+    if versions[0] == since:
+        return entries[:1]
+    for i, entry in enumerate(entries):
+        if Version(entry.version) == Version(since):
+            return entries[:i]
+
+
+def _ubuntu_vendor():
+    """Return True if dpkg runs the Ubuntu vendor hooks here."""
+    origins = os.environ.get('DPKG_ORIGINS_DIR', '/etc/dpkg/origins')
+    name = os.environ.get('DEB_VENDOR', 'default')
+    seen = set()
+    while name and name.lower() not in seen:
+        seen.add(name.lower())
+        if name.lower() == 'ubuntu':
+            return True
+        for candidate in (name, name.lower(), name.capitalize()):
+            filename = os.path.join(origins, candidate)
+            if os.path.exists(filename):
+                break
+        else:
+            return False
+        para = ControlFile(filename).para or {}
+        if name == 'default':
+            name = para.get('Vendor')
+            seen.discard('default')
+            continue
+        name = para.get('Parent')
+    return False
+
+
+def _file_checksums(filename):
+    """Return {'md5': ..., 'sha1': ..., 'sha256': ...} and the size of a
+    file.
+    """
+    sums = dict((alg, hashlib.new(alg)) for alg in ('md5', 'sha1', 'sha256'))
+    size = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            size += len(chunk)
+            for h in sums.itervalues():
+                h.update(chunk)
+    return dict((alg, h.hexdigest()) for alg, h in sums.iteritems()), size
+
+
+def _format_field(name, value):
+    """Format a field as Dpkg::Control::HashCore writes it."""
+    lines = value.split('\n')
+    while len(lines) > 1 and lines[-1] == '':
+        lines.pop()
+    out = name + ':'
+    if lines[0]:
+        out += ' ' + lines[0]
+    out += '\n'
+    for line in lines[1:]:
+        line = line.rstrip()
+        if not line or re.match(r'^\.+$', line):
+            out += ' .%s\n' % line
+        else:
+            out += ' %s\n' % line
+    return out
+
+
+def source_changes(dsc_filename, since=None):
+    """Return what "dpkg-genchanges -S [-v<since>]" prints in the tree
+    unpacked from dsc_filename, next to the source package's files.
+    """
+    files = read_files(dsc_filename, ('debian/changelog', 'debian/control'))
+    if len(files) != 2:
+        raise Unsupported('%s has no debian/changelog or debian/control'
+                          % dsc_filename)
+
+    def enough(entries):
+        # dpkg-genchanges looks at the entry before the newest one too
+        if len(entries) < 2:
+            return False
+        return since is None \
+            or since in [entry.version for entry in entries[1:]]
+    entries = parse_changelog(files['debian/changelog'], enough)
+    if not entries:
+        raise Unsupported('debian/changelog has no entries')
+    selected = _since(entries, since)
+    first = selected[0]
+
+    try:
+        control = ControlFile(fileobj=StringIO(files['debian/control']),
+                              multi_para=True).paras[0]
+    except (IOError, IndexError):
+        raise Unsupported('cannot parse debian/control')
+    if control.get('Source') != first.source or 'Maintainer' not in control:
+        raise Unsupported('debian/control does not match the changelog')
+
+    fields = {
+        'Format': '1.8',
+        'Date': first.date,
+        'Source': first.source,
+        'Architecture': 'source',
+        'Version': first.version,
+        'Distribution': ' '.join(first.distributions),
+        'Urgency': first.urgency or 'unknown',
+        'Maintainer': control['Maintainer'],
+        'Changed-By': first.maintainer,
+        'Changes': first.dpkg_changes(),
+    }
+    for name, value in control.iteritems():
+        match = re.match(r'^X[SBC]*C[SBC]*-(.*)', name, re.IGNORECASE)
+        if match:
+            fields[match.group(1)] = value
+    closes = set(first.closes())
+    for entry in selected[1:]:
+        if _rank(entry.urgency) > _rank(fields['Urgency']):
+            fields['Urgency'] = entry.urgency or ''
+        fields['Changes'] += '\n' + entry.dpkg_changes()
+        closes.update(entry.closes())
+    if closes:
+        fields['Closes'] = ' '.join(sorted(closes, key=int))
+    if _ubuntu_vendor():
+        bugs = _find_bugs(LP_CLOSES_RE, fields['Changes'])
+        if bugs:
+            fields['Launchpad-Bugs-Fixed'] = ' '.join(bugs)
+
+    # The files of the upload
+    version = Version(first.version)
+    dsc_name = '%s_%s.dsc' % (first.source,
+                              re.sub(r'^\d+:', '', first.version))
+    if os.path.basename(dsc_filename) != dsc_name:
+        raise Unsupported('%s is not %s' % (dsc_filename, dsc_name))
+    dsc = ControlFile(dsc_filename, multi_para=False, signed=True).para
+    sums, size = _file_checksums(dsc_filename)
+    names = [dsc_name]
+    checksums = {'md5': {dsc_name: sums['md5']},
+                 'sha1': {dsc_name: sums['sha1']},
+                 'sha256': {dsc_name: sums['sha256']}}
+    sizes = {dsc_name: size}
+    for alg, field in (('md5', 'Files'), ('sha1', 'Checksums-Sha1'),
+                       ('sha256', 'Checksums-Sha256')):
+        for line in dsc.get(field, '').strip().splitlines():
+            checksum, size, name = line.split(None, 2)
+            if name not in sizes:
+                names.append(name)
+                sizes[name] = size
+            checksums[alg][name] = checksum
+
+    if len(entries) > 1:
+        previous = entries[1]
+        include_orig = version.upstream != Version(previous.version).upstream \
+            or first.source != previous.source
+    else:
+        include_orig = True
+    if not include_orig and [filename for filename in names if re.search(
+            r'\.(?:debian\.tar|diff)\.(?:gz|bz2|lzma|xz)$', filename)]:
+        names = [filename for filename in names if not re.search(
+            r'\.orig(-.+)?\.tar\.(?:gz|bz2|lzma|xz)(\.asc)?$', filename)]
+
+    section = control.get('Section', '-')
+    priority = control.get('Priority', '-')
+    for alg in ('sha1', 'sha256'):
+        fields['Checksums-%s' % alg.capitalize()] = ''.join(
+            '\n%s %s %s' % (checksums[alg][name], sizes[name], name)
+            for name in names if name in checksums[alg])
+    fields['Files'] = ''.join(
+        '\n%s %s %s %s %s' % (checksums['md5'][name], sizes[name], section,
+                              priority, name)
+        for name in names if name in checksums['md5'])
+
+    order = [name for name in FIELD_ORDER if name in fields]
+    order += sorted(name for name in fields if name not in FIELD_ORDER)
+    return ''.join(_format_field(name, fields[name]) for name in order
+                   if re.search(r'\S', fields[name]))
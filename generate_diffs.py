@@ -17,11 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
 import logging
 
 from momlib import *
-from util import tree, run
+from util import compress, tree, run
+from util.parallel import run_jobs
 from model.base import (Distro, PackageVersion)
 import config
 
@@ -29,6 +29,11 @@ def options(parser):
     parser.add_option("-t", "--target", type="string", metavar="TARGET",
                       default=None,
                       help="Process only this distribution target")
+    parser.add_option("-j", "--jobs", type="int", default=1, metavar="N",
+                      help="Process up to N packages at once")
+    parser.add_option("--full", action="store_true",
+                      help="Process every package, not just those affected "
+                           "by changes since the last run")
 
 logger = logging.getLogger('generate_diffs')
 
@@ -37,34 +42,33 @@ def main(options, args):
 
     # For latest version of each package in the given distributions, iterate the pool in order
     # and generate a diff from the previous version and a changes file
-    for target in config.targets(args):
-      d = target.distro
-      for pkg in d.packages(target.dist, target.component):
-        if options.package and pkg.name not in options.package:
-          continue
-        if pkg.name in target.blacklist:
-          logger.debug("%s is blacklisted, skipping", source['Package'])
-          continue
+    work = package_work(options, args)
+    results = run_jobs(generate_package_diffs, [pkg for pkg, targets in work],
+                       options.jobs, label=lambda pkg: pkg.name)
+    record_failures(work, results, "generate diffs")
 
-        pvs = pkg.getPoolVersions()
-        pvs.sort()
+def generate_package_diffs(pkg):
+    """Generate the changes and diff files for every version of pkg in
+    the pool.
+    """
+    pvs = pkg.getPoolVersions()
+    pvs.sort()
 
-        last = None
-        try:
-          for pv in pvs:
-            try:
-              generate_diff(last, pv)
-            except model.error.PackageNotFound:
-              logger.exception("Could not find a package to diff against.")
-            except ValueError:
-              logger.exception("Could not find a .dsc file, perhaps it moved components?")
-            finally:
-              if last is not None:
-                cleanup_source(pv)
-            last = pv
-        finally:
-          if last is not None:
-            cleanup_source(pv)
+    last = None
+    for pv in pvs:
+      try:
+        generate_diff(last, pv)
+      except model.error.PackageNotFound:
+        logger.exception("Could not find a package to diff against.")
+      except ValueError:
+        logger.exception("Could not find a .dsc file, perhaps it moved components?")
+      finally:
+        # either may have been unpacked; pv is unpacked again, if need
+        # be, when it is the last one
+        if last is not None:
+          cleanup_source(last)
+          cleanup_source(pv)
+      last = pv
 
 
 def generate_diff(last, this):
@@ -73,27 +77,18 @@ def generate_diff(last, this):
     changes_filename = changes_file(this.package.distro, this)
     if last is None:
       return
-    if not os.path.isfile(changes_filename) \
-            and not os.path.isfile(changes_filename + ".bz2"):
-        try:
-          unpack_source(this)
-        except ValueError:
-          logger.exception("Couldn't unpack %s.", this)
-          return
+    if not compress.exists(changes_filename):
         try:
             save_changes_file(changes_filename, this, last)
             logger.info("Saved changes file: %s",
                           tree.subdir(config.get('ROOT'), changes_filename))
-        except (ValueError, OSError):
+        except (ValueError, EnvironmentError):
             logger.error("dpkg-genchanges for %s failed",
                           tree.subdir(config.get('ROOT'), changes_filename))
 
     logger.debug("Producing diff from %s to %s", this, last)
     diff_filename = diff_file(this.package.distro.name, this)
-    if not os.path.isfile(diff_filename) \
-            and not os.path.isfile(diff_filename + ".bz2"):
-        unpack_source(this)
-        unpack_source(last)
+    if not compress.exists(diff_filename):
         save_patch_file(diff_filename, last, this)
         save_basis(diff_filename, last.version)
         logger.info("Saved diff file: %s", tree.subdir(config.get('ROOT'),
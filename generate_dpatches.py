@@ -18,10 +18,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import stat
 import logging
 
 from momlib import *
+from deb.archive import Unsupported, read_tree
 from util import tree, run
+from util.parallel import run_jobs
 from model import Distro
 import model.error
 import config
@@ -32,30 +35,44 @@ def options(parser):
     parser.add_option("-t", "--target", type="string", metavar="TARGET",
                       default=None,
                       help="Process only this distribution target")
+    parser.add_option("-j", "--jobs", type="int", default=1, metavar="N",
+                      help="Process up to N packages at once")
+    parser.add_option("--full", action="store_true",
+                      help="Process every package, not just those affected "
+                           "by changes since the last run")
 
 def main(options, args):
     logger.info('Extracting debian/patches from packages...')
 
-    for target in config.targets(args):
-      d = target.distro
-      for pkg in d.packages(target.dist, target.component):
-        if options.package and pkg.name not in options.package:
-          continue
-        if pkg.name in target.blacklist:
-          logger.debug("%s is blacklisted,skipping", source['Package'])
-          continue
-
-        pvs = pkg.getPoolVersions()
-        pvs.sort()
-        for pv in pvs:
-          try:
-            generate_dpatch(d.name, pv)
-          except model.error.PackageNotFound:
+    work = package_work(options, args)
+    results = run_jobs(generate_package_dpatches,
+                       [pkg for pkg, targets in work], options.jobs,
+                       label=lambda pkg: pkg.name)
+    record_failures(work, results, "extract patches")
+
+def generate_package_dpatches(pkg):
+    """Generate the extracted patches for every version of pkg in the
+    pool.
+    """
+    pvs = pkg.getPoolVersions()
+    pvs.sort()
+    previous = None
+    for pv in pvs:
+        try:
+            generate_dpatch(pkg.distro.name, pv, previous)
+        except model.error.PackageNotFound:
             logger.exception("Could not find %s/%s for unpacking. How odd.",
-                pkg, version)
+                pkg, pv.version)
+        previous = pv
+
+def generate_dpatch(distro, pv, previous=None):
+    """Generate the extracted patches.
 
-def generate_dpatch(distro, pv):
-    """Generate the extracted patches."""
+    The patches are read straight from the debian tarball, or the
+    .diff.gz, of the source; those the version before, previous, had
+    already are hardlinked to its copies.  Sources they can't be read
+    from that way are unpacked instead.
+    """
     logger.debug("%s: %s", distro, pv)
 
     stamp = "%s/dpatch-stamp-%s" % (pv.package.poolPath, pv.version)
@@ -63,18 +80,71 @@ def generate_dpatch(distro, pv):
     if not os.path.isfile(stamp):
         open(stamp, "w").close()
 
+        dirname = dpatch_directory(distro, pv)
+        try:
+            patches = read_tree("%s/%s" % (pv.package.poolPath, pv.dscPath),
+                                "debian/patches")
+        except (Unsupported, EnvironmentError) as e:
+            logger.debug("Unpacking %s to extract its patches: %s", pv, e)
+        else:
+            olddir = None
+            if previous is not None:
+                olddir = dpatch_directory(distro, previous)
+            save_dpatches(dirname, patches, olddir)
+            logger.info("Saved dpatches: %s", tree.subdir(config.get('ROOT'),
+                                                          dirname))
+            return
+
         try:
             unpack_source(pv)
         except ValueError:
             logger.exception("Could not unpack %s!", pv)
         try:
-            dirname = dpatch_directory(distro, pv)
             extract_dpatches(dirname, pv)
             logger.info("Saved dpatches: %s", tree.subdir(config.get('ROOT'),
                                                           dirname))
         finally:
             cleanup_source(pv)
 
+def is_dpatch(patch):
+    """Return whether a file under debian/patches is worth keeping."""
+    if os.path.basename(patch) in ["00list", "series", "README",
+                                   ".svn", "CVS", ".bzr", ".git"]:
+        return False
+    elif not len(patch):
+        return False
+    else:
+        return True
+
+def save_dpatches(dirname, patches, olddir=None):
+    """Write patches, {path under debian/patches: contents}, into
+    dirname, hardlinking those that are the same in olddir.
+    """
+    for patch in sorted(patches):
+        if not is_dpatch(patch):
+            continue
+
+        logger.debug("%s", patch)
+        contents = patches[patch]
+        dest_filename = "%s/%s" % (dirname, patch)
+        tree.ensure(dest_filename)
+        tree.remove(dest_filename)
+
+        if olddir is not None:
+            old_filename = "%s/%s" % (olddir, patch)
+            try:
+                st = os.lstat(old_filename)
+                if stat.S_ISREG(st.st_mode) and st.st_size == len(contents):
+                    with open(old_filename) as old:
+                        if old.read() == contents:
+                            tree.clone(old_filename, dest_filename)
+                            continue
+            except EnvironmentError:
+                pass
+
+        with open(dest_filename, "w") as dest:
+            dest.write(contents)
+
 def extract_dpatches(dirname, pv):
     """Extract patches from debian/patches."""
     srcdir = unpack_directory(pv)
@@ -85,10 +155,7 @@ def extract_dpatches(dirname, pv):
         return
 
     for patch in tree.walk(patchdir):
-        if os.path.basename(patch) in ["00list", "series", "README",
-                                       ".svn", "CVS", ".bzr", ".git"]:
-            continue
-        elif not len(patch):
+        if not is_dpatch(patch):
             continue
 
         logger.debug("%s", patch)
@@ -96,8 +163,13 @@ def extract_dpatches(dirname, pv):
         dest_filename = "%s/%s" % (dirname, patch)
 
         tree.ensure(dest_filename)
-        tree.copyfile(src_filename, dest_filename)
-
+        if os.path.isfile(src_filename) \
+                and not os.path.islink(src_filename):
+            # the unpacked tree is never modified, so it can be shared
+            tree.remove(dest_filename)
+            tree.clone(src_filename, dest_filename)
+        else:
+            tree.copyfile(src_filename, dest_filename)
 
 if __name__ == "__main__":
     run(main, options, usage="%prog [DISTRO...]",
@@ -21,14 +21,14 @@ import logging
 
 from momlib import *
 from deb.version import Version
-from util import tree, run
+from util import compress, tree, run
 from re import search
 from model import Distro
 import model.error
 import config
 
 def generate_patch(base, distro, ours,
-                   slipped=False, force=False, unpacked=False):
+                   slipped=False, force=False):
     """Generate a patch file for the given comparison."""
     if base.version > ours.version:
         # Allow comparison of source -1 against our -0coX (slipped)
@@ -55,11 +55,7 @@ def generate_patch(base, distro, ours,
         if basis is not None and basis == base.version:
             return
 
-    if not os.path.exists(filename):
-        if not unpacked:
-            unpack_source(base)
-            unpack_source(ours)
-
+    if not compress.exists(filename):
         tree.ensure(filename)
         save_patch_file(filename, base, ours)
         save_basis(filename, base.version)
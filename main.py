@@ -37,6 +37,8 @@ import stats
 import stats_graphs
 import merge_status
 import expire_pool
+from model.delta import Delta
+from momlib import unpack_cache
 
 def options(parser):
     parser.add_option("-f", "--force", action="store_true",
@@ -44,6 +46,11 @@ def options(parser):
     parser.add_option("-t", "--target", type="string", metavar="TARGET",
                       help="Process only this distribution target")
     parser.add_option("-d", "--dry-run", action="store_true", help="Don't actually fiddle with OBS, just print what would've happened.")
+    parser.add_option("-j", "--jobs", type="int", default=1, metavar="N",
+                      help="Process up to N packages at once")
+    parser.add_option("--full", action="store_true",
+                      help="Process every package, not just those affected "
+                           "by changes since the last run")
 
 logger = logging.getLogger('main')
 
@@ -66,6 +73,7 @@ def main(options, args):
     options.version = None
     options.source_distro = None
     options.source_suite = None
+    options.mirror = None
     try:
         os.umask(002)
         try:
@@ -107,7 +115,15 @@ def main(options, args):
         # Expire any old packages from the pool
         expire_pool.main(options, args)
 
-        # ?! untidy
+        # Everything has seen the current Sources, so the next run only
+        # needs to look at what changes from now on. A run limited to
+        # some targets or packages must not hide changes from the rest.
+        current = Delta.load()
+        if current is not None and not args and not options.package:
+            current.commit(config.targets())
+
+        # The unpacked sources are only links into the unpack cache, which
+        # keeps what it can for the next run
         try:
             for entry in os.listdir(unpackeddir):
                 p = "%s/%s" % (unpackeddir, entry)
@@ -115,6 +131,7 @@ def main(options, args):
                 shutil.rmtree(p)
         except Exception as e:
             logger.debug('Cancelling removal of unpacked directories: %r', e)
+        unpack_cache().evict()
 
     finally:
         try:
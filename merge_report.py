@@ -34,7 +34,7 @@ from deb.controlfile import ControlFile
 from deb.version import (Version)
 from model import (Distro, PackageVersion)
 from model.obs import (OBSDistro)
-from momlib import files
+from momlib import diffstat_file, files, read_stats
 from momversion import VERSION
 from util import tree
 from util.jinja import patch_environment
@@ -204,6 +204,8 @@ class MergeReport(object):
             'merged_files',
             'proposed_patch',
             'merged_patch',
+            'truncated_patches',
+            'diffstats',
             'build_metadata_changed',
             'merge_failure_tarball',
             'conflicts',
@@ -223,6 +225,8 @@ class MergeReport(object):
         self.base_files = []
         self.right_files = []
         self.merged_files = []
+        self.truncated_patches = {}
+        self.diffstats = {}
         self.build_metadata_changed = True
         self.conflicts = []
         self.committed = False
@@ -387,6 +391,8 @@ class MergeReport(object):
             right_patch="diff(base version ... right version)",
             proposed_patch="diff(our old version ... our new version) for review",
             merged_patch="diff(their version ... our new version) if the proposed patch is applied",
+            truncated_patches="these patches were cut short for size; the diffstat of each in full",
+            diffstats="how many files, lines and binary files each patch changes",
             genchanges=("Pass these arguments to dpkg-genchanges, " +
                 "dpkg-buildpackage or debuild when you have completed the " +
                 "merge"),
@@ -406,6 +412,11 @@ class MergeReport(object):
                     report['#' + f] = comments[f]
                     # each of these is a Version
                     report[f] = [str(x) for x in v]
+            elif f in ('truncated_patches', 'diffstats'):
+                v = getattr(self, f)
+                if v:
+                    report['#' + f] = comments[f]
+                    report[f] = v
             else:
                 v = getattr(self, f)
                 if v is not None:
@@ -415,8 +426,26 @@ class MergeReport(object):
 
         return report
 
+    def read_diffstats(self, output_dir):
+        """Note what the patches in output_dir change, from the files
+        kept alongside them, and which were cut short.
+        """
+        self.truncated_patches = {}
+        self.diffstats = {}
+        for patch in (self.left_patch, self.right_patch,
+                      self.proposed_patch, self.merged_patch):
+            if not patch:
+                continue
+            filename = output_dir + '/' + patch
+            stats = read_stats(filename)
+            if stats is not None:
+                self.diffstats[patch] = stats
+            if os.path.exists(diffstat_file(filename)):
+                self.truncated_patches[patch] = diffstat_file(patch)
+
     def write_report(self, output_dir):
         self.check()
+        self.read_diffstats(output_dir)
         report = self.to_dict()
 
         filename = "%s/REPORT.json" % output_dir
@@ -19,6 +19,7 @@
 
 from __future__ import with_statement
 
+import json
 import logging
 import os
 import bz2
@@ -322,6 +323,9 @@ def write_status_json(target, merges):
             if merged_version is None:
                 merged_version = '???'
             print >>status, '"merged_version": "%s",' % merged_version,
+            if report['diffstats']:
+                print >>status, '"diffstats": %s,' \
+                    % json.dumps(report['diffstats'], sort_keys=True),
             print >>status, '"result": "%s"' % report['result']
             cur_merge += 1
             if cur_merge < len(merges):
@@ -1,17 +1,16 @@
 import config
 from glob import glob
 from util import tree, pathhash, shell
+from model.mirror import MirrorSet
+from model.indices import IndexFetcher, release_path, sources_path
+from model import baseinfo, prefetch
 import os
 from os import path
 import logging
-import urllib
 from deb.controlfile import ControlFile
 from deb.version import Version
 import gzip
-import json
-
-import apt
-import apt_pkg
+import hashlib
 
 import error
 
@@ -22,6 +21,8 @@ class Distro(object):
   such as "debian" or "ubuntu", and for temporary distribution branches.
   """
   SOURCES_CACHE = {}
+  SOURCES_INDEX = {}
+  MIRRORS_CACHE = {}
 
   @staticmethod
   def all():
@@ -81,11 +82,30 @@ class Distro(object):
     self.parent = parent
     self.name = name
 
+  def mirrors(self):
+    """Return the MirrorSet for this distro's "mirrors" configuration
+    item, or its single "mirror" if that is all that is configured.
+    The set is shared by every Distro object with the same name, so
+    what is learned about each mirror lasts for the whole run.
+    """
+    if self.name not in Distro.MIRRORS_CACHE:
+      urls = self.config("mirrors", default=None)
+      if not urls:
+        urls = [self.config("mirror")]
+      Distro.MIRRORS_CACHE[self.name] = MirrorSet(urls,
+          timeout=config.get("MIRROR_TIMEOUT", default=30),
+          min_rate=config.get("MIRROR_MIN_RATE", default=4096),
+          retry_delay=config.get("MIRROR_RETRY_DELAY", default=300),
+          local_paths=config.get("MIRROR_LOCAL_PATHS", default={}))
+    return Distro.MIRRORS_CACHE[self.name]
+
   def mirrorURL(self):
-    """Return the absolute URL of the top of the mirror"""
-    return self.config("mirror")
+    """Return the absolute URL of the top of the mirror we currently
+    expect to be fastest"""
+    return self.mirrors().best()
 
-  def downloadPackage(self, dist, component, package=None, version=None):
+  def downloadPackage(self, dist, component, package=None, version=None,
+                      packages=None):
     """Populate the 'pool' directory by downloading Debian source packages
     from the given release and component.
 
@@ -93,51 +113,86 @@ class Distro(object):
     :param str component: a component (archive area) such as "main" or "contrib"
     :param package: a source package name, or None to download all of them
     :type package: str or None
+    :param packages: if package is None, only download the source packages
+      with these names
+    :type packages: set or None
     :return: True if anything actually changed, False otherwise
     :rtype: bool
     """
-    if package is None:
+    if package is None and packages is not None:
+      logger.debug('Downloading %d selected packages from %s/%s/%s into '
+          '%s pool', len(packages), self, dist, component, self)
+    elif package is None:
       logger.debug('Downloading all packages from %s/%s/%s into %s pool',
           self, dist, component, self)
     else:
       logger.debug('Downloading package "%s" from %s/%s/%s into %s pool',
           package, self, dist, component, self)
 
-    mirror = self.mirrorURL()
-    sources = self.getSources(dist, component)
+    mirrors = self.mirrors()
+    prefetcher = prefetch.active()
 
     changed = False
 
-    for source in sources:
-      if package != source["Package"] and not (package is None):
+    if package is None and packages is not None:
+      todo = []
+      for name in sorted(packages):
+        todo.extend(self.poolFiles(dist, component, name))
+      skipped = sum(f[2] for f in self.poolFiles(dist, component)) - \
+          sum(f[2] for f in todo)
+      logger.info('Mirroring %d packages from %s/%s/%s, skipping %d bytes '
+                  'that no target needs', len(packages), self, dist,
+                  component, skipped)
+    else:
+      todo = self.poolFiles(dist, component, package, version)
+
+    for relpath, filename, size in todo:
+      if prefetcher is not None and prefetcher.wait(filename):
+        logger.debug("Saved %s in the background",
+                     tree.subdir(config.get('ROOT'), filename))
+        changed = True
         continue
+
+      if os.path.isfile(filename):
+        if os.path.getsize(filename) == size:
+          logger.debug("Skipping %s, already downloaded.", filename)
+          continue
+
+      changed = True
+      try:
+        mirrors.retrieve(relpath, filename)
+      except IOError:
+        logger.error("Downloading %s failed", relpath)
+        raise
+      logger.debug("Saved %s", tree.subdir(config.get('ROOT'), filename))
+
+    return changed
+
+  def poolFiles(self, dist, component, package=None, version=None):
+    """Return (relpath, filename, size) for each file of the source
+    packages in (dist, component), where relpath is the file's location
+    relative to the top of the mirror and filename is where it belongs
+    in the pool.
+
+    :param package: a source package name, or None for all of them
+    :param version: if not None, only include this version of package
+    """
+    if package is None:
+      sources = self.getSources(dist, component)
+    else:
+      sources = self.getSourcesFor(dist, component, package)
+
+    ret = []
+    for source in sources:
       if package is not None and version is not None \
           and source["Version"] != str(version):
         continue
 
-      sourcedir = source["Directory"]
-
-      pkg = self.package(dist, component, source['Package'])
+      pkg = Package(self, dist, component, source['Package'])
       for md5sum, size, name in files(source):
-          url = "%s/%s/%s" % (mirror, sourcedir, name)
-          filename = "%s/%s" % (pkg.poolPath, name)
-
-          if os.path.isfile(filename):
-              if os.path.getsize(filename) == int(size):
-                  logger.debug("Skipping %s, already downloaded.", filename)
-                  continue
-
-          logger.debug("Downloading %s", url)
-          changed = True
-          tree.ensure(filename)
-          try:
-              urllib.URLopener().retrieve(url, filename)
-          except IOError:
-              logger.error("Downloading %s failed", url)
-              raise
-          logger.debug("Saved %s", tree.subdir(config.get('ROOT'), filename))
-
-    return changed
+        ret.append(("%s/%s" % (source["Directory"], name),
+                    "%s/%s" % (pkg.poolPath, name), int(size)))
+    return ret
 
   def findPackage(self, name, searchDist=None, searchComponent=None, version=None):
     """Return a list of the available versions of the given package
@@ -184,10 +239,8 @@ class Distro(object):
     @param component a component (archive area) like "universe"
     @param name the name of a source package
     """
-    source = None
-    for s in self.getSources(dist, component):
-      if s['Package'] == name:
-        return Package(self, dist, component, name)
+    if self.getSourcesFor(dist, component, name):
+      return Package(self, dist, component, name)
     raise error.PackageNotFound(name, dist, component)
 
   def branch(self, name):
@@ -246,18 +299,9 @@ class Distro(object):
     if self.parent:
       return self.parent.sourcesFile(dist, component)
 
-    # We use python-apt to download the sources file. Unfortunately it
-    # doesn't offer an API to find the path of the downloaded file.
-    # The closest thing would be to use apt_pkg.SourceList(),
-    # .read_main_list() then check the resultant .list.index_files.
-    # The filename is listed there in the "describe" property in addition to
-    # other bits of information.
-    # That doesn't seem great, so just attempt to find the file directly.
-    path = self.getDistDir(dist)
-    file_match = '*_%s_%s_source_Sources' % (dist, component)
-    files = glob(os.path.join(path, 'var/lib/apt/lists', file_match))
-    if len(files) == 1:
-        return files[0]
+    filename = sources_path(self.getDistDir(dist), component)
+    if os.path.exists(filename):
+      return filename
 
     # If there are no Sources then no file was downloaded.
     return None
@@ -277,28 +321,100 @@ class Distro(object):
 
     return Distro.SOURCES_CACHE[filename].paras
 
+  def getSourcesFor(self, dist, component, name):
+    """Return the stanzas of a cached Sources file that describe the
+    given source package, without searching the whole file.
+    """
+    filename = self.sourcesFile(dist, component)
+    if filename is None:
+      return []
+
+    if filename not in Distro.SOURCES_INDEX:
+      index = {}
+      for source in self.getSources(dist, component):
+        index.setdefault(source['Package'], []).append(source)
+      Distro.SOURCES_INDEX[filename] = index
+
+    return Distro.SOURCES_INDEX[filename].get(name, [])
+
+  def forgetSources(self, dist):
+    """Discard anything parsed from the Sources files of dist, so that
+    they are read again next time they are needed.
+    """
+    for component in self.components():
+      filename = self.sourcesFile(dist, component)
+      Distro.SOURCES_CACHE.pop(filename, None)
+      Distro.SOURCES_INDEX.pop(filename, None)
+
+  def releaseFile(self, dist):
+    """Return the absolute filename of the cached InRelease or Release
+    file for the given release, or None if there is none.
+    """
+    if self.parent:
+      return self.parent.releaseFile(dist)
+
+    filename = release_path(self.getDistDir(dist))
+    if os.path.exists(filename):
+      return filename
+    return None
+
+  def releaseHash(self, dist):
+    """Return the SHA-256 of the cached InRelease or Release file, or
+    None if there is none.
+    """
+    filename = self.releaseFile(dist)
+    if filename is None:
+      return None
+    with open(filename) as f:
+      return hashlib.sha256(f.read()).hexdigest()
+
+  def _releaseStamp(self, dist):
+    return os.path.join(self.getDistDir(dist), 'release.sha256')
+
+  def releaseChanged(self, dist):
+    """Return True if the cached InRelease or Release file differs from
+    the one recorded by saveReleaseStamp(), or if nothing was recorded.
+    """
+    try:
+      with open(self._releaseStamp(dist)) as f:
+        previous = f.read().strip()
+    except IOError:
+      return True
+    current = self.releaseHash(dist)
+    return current is None or current != previous
+
+  def saveReleaseStamp(self, dist):
+    """Record the current InRelease or Release file as processed, so that
+    releaseChanged() returns False until it changes again.
+    """
+    current = self.releaseHash(dist)
+    if current is None:
+      return
+    stamp = self._releaseStamp(dist)
+    with open(stamp + '.tmp', 'w') as f:
+      f.write(current + '\n')
+    os.rename(stamp + '.tmp', stamp)
+
   def updateSources(self, dist):
+    """Download the Sources indices for every component of dist.
+
+    :return: True if the release changed since saveReleaseStamp() was
+      last called
+    :rtype: bool
+    """
     path = self.getDistDir(dist)
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    # Create needed directories
-    for d in ['etc/apt/apt.conf.d', 'etc/apt/preferences.d',
-              'var/lib/apt/lists/partial',
-              'var/cache/apt/archives/partial', 'var/lib/dpkg']:
-        repo_dir = os.path.join(path, d)
-        if not os.path.exists(repo_dir):
-            os.makedirs(repo_dir)
-
-    # Create sources.list
-    sources_list = os.path.join(path, 'etc/apt/sources.list')
-    with open(sources_list, 'w') as f:
-        f.write('deb-src [trusted=yes] %s %s %s\n' % (self.mirrorURL(), dist, " ".join(self.components())))
-
-    # Setup configuration
-    apt_pkg.config.set('Dir', path)
-    cache = apt.Cache(rootdir=path)
-    cache.update()
+    fetcher = IndexFetcher(self.mirrors(), path, dist, self.components(),
+                           pdiffs=self.config('pdiffs', default=False))
+    fetcher.update()
+
+    # left behind by the apt-based updates of earlier versions
+    for d in ('etc', 'var'):
+      tree.remove(os.path.join(path, d))
+
+    changed = self.releaseChanged(dist)
+    if changed:
+      self.forgetSources(dist)
+    return changed
 
   def getPoolPath(self, component):
     """Return the absolute path to the pool for a given component
@@ -356,11 +472,8 @@ class Package(object):
     available in (self.distro, self.dist, self.component), with
     the oldest version first.
     """
-    sources = self.distro.getSources(self.dist, self.component)
-    matches = []
-    for source in sources:
-      if source['Package'] == self.name:
-        matches.append(source)
+    matches = list(self.distro.getSourcesFor(self.dist, self.component,
+                                             self.name))
     matches.sort(key=lambda x:Version(x['Version']))
     return matches
 
@@ -405,9 +518,8 @@ class Package(object):
     They are in no particular order.
     """
     versions = []
-    for s in self.distro.getSources(self.dist, self.component):
-      if s['Package'] == self.name:
-        versions.append(PackageVersion(self, Version(s['Version'])))
+    for s in self.distro.getSourcesFor(self.dist, self.component, self.name):
+      versions.append(PackageVersion(self, Version(s['Version'])))
     return versions
 
   def newestVersion(self):
@@ -458,15 +570,42 @@ class PackageVersion(object):
     self.package.download(self.version)
 
 class UpdateInfo(object):
-  def __init__(self, package):
+  """What update_sources found out about a package: our version, the
+  upstream version to update to and the base version of ours.
+  """
+
+  def __init__(self, package, data=None):
     self.package = package
-    self.path = os.path.join(config.get('ROOT'), 'baseinfo',
-                             package.distro.name, package.name)
+    if data is None:
+      data = UpdateInfo.store().get(package.distro.name, package.name)
+    self.data = data or {}
 
-    if os.path.exists(self.path):
-      self.data = json.load(open(self.path, 'r'))
-    else:
-      self.data = {}
+  @staticmethod
+  def store():
+    """Return the BaseInfoStore for the current ROOT."""
+    return baseinfo.store(config.get('ROOT'))
+
+  @staticmethod
+  def batch():
+    """Return a context manager that groups the save() calls made inside
+    it into a few transactions.
+    """
+    return UpdateInfo.store().batch()
+
+  @staticmethod
+  def forPackages(packages):
+    """Return {name: UpdateInfo} for each of packages, reading all those
+    of the same distro at once.
+    """
+    ret = {}
+    records = {}
+    for package in packages:
+      name = package.distro.name
+      if name not in records:
+        records[name] = UpdateInfo.store().getAll(name)
+      ret[package.name] = UpdateInfo(package,
+                                     records[name].get(package.name, {}))
+    return ret
 
   def __unicode__(self):
     return '%s (version=%s base=%s upstream=%s)' % \
@@ -477,11 +616,8 @@ class UpdateInfo(object):
     return self.__unicode__()
 
   def save(self):
-    base_path = os.path.dirname(self.path)
-    if not os.path.exists(base_path):
-      os.makedirs(base_path)
-
-    json.dump(self.data, open(self.path, 'w'))
+    UpdateInfo.store().put(self.package.distro.name, self.package.name,
+                           self.data)
 
   @property
   def version(self):
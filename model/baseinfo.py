@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# model/baseinfo.py - database of what update_sources found for each package
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+
+logger = logging.getLogger('model.baseinfo')
+
+# Writes made inside batch() are committed this many at a time
+BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS update_info (
+  distro TEXT NOT NULL,
+  package TEXT NOT NULL,
+  data TEXT NOT NULL,
+  PRIMARY KEY (distro, package)
+);
+CREATE TABLE IF NOT EXISTS base_resolution (
+  package TEXT NOT NULL,
+  version TEXT NOT NULL,
+  upstream TEXT NOT NULL,
+  base TEXT,
+  PRIMARY KEY (package, version, upstream)
+);
+CREATE TABLE IF NOT EXISTS meta (
+  key TEXT PRIMARY KEY,
+  value TEXT
+);
+"""
+
+_stores = {}
+
+def store(root):
+  """Return the BaseInfoStore for the given ROOT directory."""
+  path = os.path.join(root, 'baseinfo.db')
+  if path not in _stores:
+    _stores[path] = BaseInfoStore(path,
+                                  legacy_dir=os.path.join(root, 'baseinfo'))
+  return _stores[path]
+
+
+class BaseInfoStore(object):
+  """UpdateInfo records for every package of every distro, as JSON
+  objects in one SQLite database. Records used to be kept in a file per
+  package; those are imported the first time the database is opened.
+
+  Each process opens its own connection when it first needs one, so a
+  store can be shared with processes forked from this one.
+  """
+
+  def __init__(self, path, legacy_dir=None):
+    self.path = path
+    self.legacy_dir = legacy_dir
+    self._pid = None
+    self._conn = None
+    self._depth = 0
+    self._pending = 0
+
+  @property
+  def conn(self):
+    if self._pid != os.getpid():
+      self._conn = sqlite3.connect(self.path, timeout=300)
+      self._conn.execute('PRAGMA journal_mode=WAL')
+      self._conn.execute('PRAGMA synchronous=NORMAL')
+      self._conn.executescript(SCHEMA)
+      self._pid = os.getpid()
+      self._depth = 0
+      self._pending = 0
+      self._migrate()
+    return self._conn
+
+  def get(self, distro, package):
+    """Return the record for (distro, package) as a dictionary, or None."""
+    row = self.conn.execute(
+        'SELECT data FROM update_info WHERE distro = ? AND package = ?',
+        (distro, package)).fetchone()
+    if row is None:
+      return None
+    return json.loads(row[0])
+
+  def getAll(self, distro):
+    """Return {package: record} for every package of distro."""
+    return dict((package, json.loads(data)) for package, data in
+                self.conn.execute(
+                    'SELECT package, data FROM update_info WHERE distro = ?',
+                    (distro,)))
+
+  def put(self, distro, package, data):
+    """Replace the record for (distro, package)."""
+    self.conn.execute(
+        'INSERT OR REPLACE INTO update_info (distro, package, data) '
+        'VALUES (?, ?, ?)', (distro, package, json.dumps(data)))
+    self._written()
+
+  def getResolution(self, package, version, upstream):
+    """Return (True, base) if the base version of package at version,
+    being updated to upstream, was resolved before, or (False, None).
+    base is None if no base could be found.
+    """
+    row = self.conn.execute(
+        'SELECT base FROM base_resolution '
+        'WHERE package = ? AND version = ? AND upstream = ?',
+        (package, str(version), str(upstream))).fetchone()
+    if row is None:
+      return False, None
+    return True, row[0]
+
+  def putResolution(self, package, version, upstream, base):
+    """Record the base version found for package at version, being
+    updated to upstream, or None if there was none.
+    """
+    self.conn.execute(
+        'INSERT OR REPLACE INTO base_resolution '
+        '(package, version, upstream, base) VALUES (?, ?, ?, ?)',
+        (package, str(version), str(upstream),
+         None if base is None else str(base)))
+    self._written()
+
+  def _written(self):
+    self._pending += 1
+    if self._depth == 0 or self._pending >= BATCH_SIZE:
+      self.conn.commit()
+      self._pending = 0
+
+  @contextmanager
+  def batch(self):
+    """Group the writes made in the with block into a few transactions
+    instead of one each. They are all committed when the block ends.
+    """
+    conn = self.conn
+    self._depth += 1
+    try:
+      yield self
+    finally:
+      self._depth -= 1
+      if self._depth == 0:
+        conn.commit()
+        self._pending = 0
+
+  def _migrate(self):
+    """Import the per-package files written by earlier versions."""
+    done = self._conn.execute(
+        "SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+    if done is not None or self.legacy_dir is None \
+        or not os.path.isdir(self.legacy_dir):
+      return
+
+    count = 0
+    for distro in os.listdir(self.legacy_dir):
+      distro_dir = os.path.join(self.legacy_dir, distro)
+      if not os.path.isdir(distro_dir):
+        continue
+      for package in os.listdir(distro_dir):
+        try:
+          with open(os.path.join(distro_dir, package)) as f:
+            data = json.load(f)
+        except (IOError, ValueError) as e:
+          logger.warning('Not importing %s/%s: %s', distro, package, e)
+          continue
+        self._conn.execute(
+            'INSERT OR IGNORE INTO update_info (distro, package, data) '
+            'VALUES (?, ?, ?)', (distro, package, json.dumps(data)))
+        count += 1
+    self._conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')")
+    self._conn.commit()
+    logger.info('Imported %d records from %s into %s; the old files are no '
+                'longer used', count, self.legacy_dir, self.path)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# model/delta.py - work out which packages changed since the last run
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import logging
+import os
+
+import config
+from deb.version import Version
+from util import tree
+
+logger = logging.getLogger('model.delta')
+
+# {path: (mtime, Delta)} of what wanted() read last
+_loaded = {}
+
+
+def index_versions(distro, dist, component):
+  """Return {package: [version, ...]} for a Sources index, with each
+  list of versions sorted.
+  """
+  ret = {}
+  for source in distro.getSources(dist, component):
+    ret.setdefault(source['Package'], []).append(source['Version'])
+  for versions in ret.itervalues():
+    versions.sort(key=Version)
+  return ret
+
+def compare(old, new):
+  """Compare two results of index_versions(). Return a dictionary with
+  the packages that are "new", "removed" or whose versions "changed",
+  each mapped to its versions (for "changed", the old and new lists).
+  """
+  ret = {"new": {}, "removed": {}, "changed": {}}
+  for name, versions in new.iteritems():
+    if name not in old:
+      ret["new"][name] = versions
+    elif old[name] != versions:
+      ret["changed"][name] = [old[name], versions]
+  for name, versions in old.iteritems():
+    if name not in new:
+      ret["removed"][name] = versions
+  return ret
+
+def _key(distro, dist, component):
+  return "%s/%s/%s" % (distro.name, dist, component)
+
+def _snapshot_path(distro, dist, component):
+  return os.path.join(distro.getDistDir(dist), component, "snapshot.json")
+
+def _indices(target):
+  """Return (distro, dist, component) for the target's own Sources and
+  for each Sources of its upstreams.
+  """
+  ret = [(target.distro, target.dist, target.component)]
+  for srclist in target.getAllSourceLists():
+    for source in srclist:
+      for component in source.distro.components():
+        ret.append((source.distro, source.dist, component))
+  return ret
+
+def _fingerprint(target):
+  """Return a digest of what decides which packages of target are
+  processed: its configuration, the Sources it merges from, and its
+  blacklists and package lists.
+  """
+  root = config.get("ROOT")
+  files = ["blacklist.txt", "blacklist-%s.txt" % target.name,
+           "%s.ignore.txt" % target.name, "%s.list.txt" % target.name]
+  files.extend("%s-%s.list.txt" % (target.name, src)
+               for src in target.config("sources", default=[]))
+  contents = {}
+  for filename in files:
+    try:
+      with open(os.path.join(root, filename)) as f:
+        contents[filename] = f.read()
+    except IOError:
+      contents[filename] = None
+  data = {
+      "config": target.config(),
+      "indices": [_key(*index) for index in _indices(target)],
+      "files": contents,
+  }
+  return hashlib.sha1(json.dumps(data, sort_keys=True)).hexdigest()
+
+def _write_json(filename, data):
+  tree.ensure(filename)
+  with open(filename + ".new", "w") as f:
+    json.dump(data, f, sort_keys=True)
+  os.rename(filename + ".new", filename)
+
+
+class Delta(object):
+  """The packages whose versions changed in any Sources index since the
+  last complete run, and which packages of each target are affected.
+
+  update_sources computes it and saves it in ROOT/delta.json, the later
+  stages only look at the affected packages, and once the whole run is
+  over commit() makes the current indices the base for the next one.
+  """
+
+  def __init__(self, changes, affected, failed=None, committed=None):
+    # {"distro/dist/component": compare() result}
+    self.changes = changes
+    # {target name: set of package names}
+    self.affected = affected
+    # {target name: set of package names} to be retried next time
+    self.failed = failed or {}
+    # {target name: _fingerprint()} of the targets last committed
+    self.committed = committed or {}
+
+  @staticmethod
+  def path():
+    return os.path.join(config.get("ROOT"), "delta.json")
+
+  @staticmethod
+  def compute(targets):
+    """Compare the Sources used by targets with the snapshots taken when
+    they were last committed. Packages that failed last time are treated
+    as affected again, and so is every package of a target that was not
+    committed with its current configuration, since the snapshots say
+    nothing about it.
+    """
+    previous = Delta._read() or {}
+    retry = previous.get("failed", {})
+    committed = previous.get("targets", {})
+
+    changes = {}
+    affected = {}
+    for target in targets:
+      names = set(retry.get(target.name, []))
+      for distro, dist, component in _indices(target):
+        key = _key(distro, dist, component)
+        if key not in changes:
+          try:
+            with open(_snapshot_path(distro, dist, component)) as f:
+              old = json.load(f)
+          except (IOError, ValueError):
+            old = {}
+          changes[key] = compare(old,
+                                 index_versions(distro, dist, component))
+        # a package gone from an upstream can change which upstream
+        # version our package merges with
+        for kind in ("new", "changed", "removed"):
+          names.update(changes[key][kind])
+
+      ours = set(index_versions(target.distro, target.dist,
+                                target.component))
+      if committed.get(target.name) != _fingerprint(target):
+        logger.info("%s is new or was reconfigured, all of its %d packages "
+                    "are affected", target, len(ours))
+        affected[target.name] = ours
+        continue
+      affected[target.name] = names & ours
+      logger.info("%d of %d packages in %s are affected by changes",
+                  len(affected[target.name]), len(ours), target)
+
+    return Delta(changes, affected, committed=committed)
+
+  @staticmethod
+  def _read():
+    try:
+      with open(Delta.path()) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  @staticmethod
+  def load():
+    """Return the Delta saved by this run's update_sources, or None if
+    there is none, in which case everything should be processed.
+    """
+    data = Delta._read()
+    if data is None or data.get("committed"):
+      return None
+    return Delta(data["changes"],
+                 dict((k, set(v)) for k, v in data["affected"].iteritems()),
+                 dict((k, set(v)) for k, v in data["failed"].iteritems()),
+                 data.get("targets"))
+
+  def save(self):
+    _write_json(Delta.path(), {
+        "committed": False,
+        "changes": self.changes,
+        "affected": dict((k, sorted(v))
+                         for k, v in self.affected.iteritems()),
+        "failed": dict((k, sorted(v)) for k, v in self.failed.iteritems()),
+        # kept until commit() replaces it, so that computing the delta
+        # again before then still knows what was committed
+        "targets": self.committed,
+    })
+
+  def packages(self, target):
+    """Return the names of the packages in target to process, or None if
+    target was not considered, in which case all of them should be.
+    """
+    return self.affected.get(target.name)
+
+  def fail(self, target, name):
+    """Record that processing name in target failed, so that it is
+    affected again in the next run. Call save() afterwards.
+    """
+    self.failed.setdefault(target.name, set()).add(name)
+
+  def commit(self, targets):
+    """Snapshot every Sources index of targets, so that the next run
+    only sees what changes from now on, and record the configuration
+    they were committed with.
+    """
+    done = set()
+    committed = dict(self.committed)
+    for target in targets:
+      committed[target.name] = _fingerprint(target)
+      for distro, dist, component in _indices(target):
+        key = _key(distro, dist, component)
+        if key in done:
+          continue
+        done.add(key)
+        _write_json(_snapshot_path(distro, dist, component),
+                    index_versions(distro, dist, component))
+
+    _write_json(Delta.path(), {
+        "committed": True,
+        "failed": dict((k, sorted(v)) for k, v in self.failed.iteritems()),
+        "targets": committed,
+    })
+
+
+def wanted(options, target):
+  """Return the names of the packages in target that a stage should
+  process, or None if it should process all of them: when --full or
+  --package was given, or when there is no Delta for this run.
+  """
+  if options.full or options.package:
+    return None
+
+  # stages ask once per target, so only read the file again if it changed
+  try:
+    mtime = os.stat(Delta.path()).st_mtime
+  except OSError:
+    return None
+  if _loaded.get(Delta.path(), (None,))[0] != mtime:
+    _loaded[Delta.path()] = (mtime, Delta.load())
+  delta = _loaded[Delta.path()][1]
+  if delta is None:
+    return None
+  return delta.packages(target)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# model/indices.py - download Release and Sources indices from an archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+import gzip
+import hashlib
+import logging
+import os
+import re
+import shutil
+from cStringIO import StringIO
+
+from deb.controlfile import ControlFile
+from model.mirror import is_not_found
+from util import shell, tree
+
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+logger = logging.getLogger('model.indices')
+
+# Compressed variants of Sources we can use, best first
+COMPRESSIONS = ('.xz', '.bz2', '.gz', '')
+
+# Commands of an ed script as written by "diff --ed": an optional line
+# or range of lines, then append, change or delete
+ED_COMMAND = re.compile(r'^(\d*)(?:,(\d+))?([acd])$')
+
+
+def release_path(distdir):
+  """Return where the Release (or InRelease) file of a release is kept."""
+  return os.path.join(distdir, 'Release')
+
+def sources_path(distdir, component):
+  """Return where the uncompressed Sources file of a component is kept."""
+  return os.path.join(distdir, component, 'Sources')
+
+def sha256_file(filename):
+  """Return the SHA-256 of a file, or None if it does not exist."""
+  try:
+    f = open(filename, 'rb')
+  except IOError:
+    return None
+  with f:
+    h = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), ''):
+      h.update(chunk)
+  return h.hexdigest()
+
+def _have_xz():
+  if lzma is not None:
+    return True
+  for directory in os.environ.get('PATH', '').split(os.pathsep):
+    if os.access(os.path.join(directory, 'xz'), os.X_OK):
+      return True
+  return False
+
+def strip_signature(text):
+  """Return the signed text of a clearsigned message such as InRelease,
+  or the text unchanged if it is not signed. The signature itself is not
+  checked, just as the archives were always marked trusted for apt.
+  """
+  lines = text.splitlines(True)
+  if not lines or not lines[0].startswith('-----BEGIN PGP SIGNED MESSAGE'):
+    return text
+
+  # skip the armour headers, which end at the first blank line
+  start = 1
+  while start < len(lines) and lines[start].strip():
+    start += 1
+
+  body = []
+  for line in lines[start + 1:]:
+    if line.startswith('-----BEGIN PGP SIGNATURE'):
+      break
+    # undo dash-escaping
+    if line.startswith('- '):
+      line = line[2:]
+    body.append(line)
+  return ''.join(body)
+
+def apply_ed(lines, script):
+  """Apply an ed script, as written by "diff --ed" and published in
+  pdiffs, to a list of lines. Return the new list of lines.
+
+  Raise ValueError for anything but the a, c and d commands and the
+  s/.// that diff uses to write a line consisting of a single dot.
+  """
+  lines = list(lines)
+  script = iter(script)
+  current = len(lines)
+  for command in script:
+    command = command.rstrip('\n')
+    if command == 's/.//':
+      lines[current - 1] = lines[current - 1][1:]
+      continue
+
+    match = ED_COMMAND.match(command)
+    if match is None:
+      raise ValueError('Unsupported ed command %r' % command)
+    first = int(match.group(1) or current)
+    last = int(match.group(2) or first)
+    op = match.group(3)
+
+    text = []
+    if op in 'ac':
+      for line in script:
+        if line.rstrip('\n') == '.':
+          break
+        text.append(line)
+      else:
+        raise ValueError('Unterminated text after ed command %r' % command)
+
+    if op == 'a':
+      lines[first:first] = text
+      current = first + len(text)
+    else:
+      lines[first - 1:last] = text
+      current = first - 1 + len(text)
+  return lines
+
+
+class ReleaseIndex(object):
+  """The contents of a Release or InRelease file."""
+
+  def __init__(self, text):
+    self.text = text
+    control = ControlFile(fileobj=StringIO(strip_signature(text)),
+                          multi_para=False, signed=False)
+    self.fields = control.para or {}
+    self.by_hash = self.fields.get('Acquire-By-Hash', '').lower() == 'yes'
+
+    self.files = {}
+    for line in self.fields.get('Sha256', '').splitlines():
+      parts = line.split()
+      if len(parts) == 3:
+        self.files[parts[2]] = (parts[0], int(parts[1]))
+
+  def entry(self, path):
+    """Return the (sha256, size) listed for path, relative to the
+    release's directory, or None if it is not listed.
+    """
+    return self.files.get(path)
+
+
+class Mismatch(IOError):
+  """A file does not match the checksum its Release lists."""
+  pass
+
+
+class IndexFetcher(object):
+  """Keeps the Release file and the uncompressed Sources files of one
+  release of an archive up to date in a local directory.
+
+  Only files whose checksums changed are downloaded. If pdiffs is True,
+  a Sources file that is only a little out of date is patched rather
+  than downloaded again.
+  """
+
+  def __init__(self, mirrors, distdir, dist, components, pdiffs=False):
+    self.mirrors = mirrors
+    self.distdir = distdir
+    self.dist = dist
+    self.components = components
+    self.pdiffs = pdiffs
+
+  def _relpath(self, path):
+    return 'dists/%s/%s' % (self.dist, path)
+
+  def update(self):
+    """Download whatever changed since the last update. The Release
+    file is replaced last, so an interrupted update is redone in full.
+
+    The Release and the Sources it lists are all taken from the same
+    mirror, since mirrors synced at different times disagree about the
+    checksums. If a file does not match, that mirror is avoided for a
+    while and the update is done again from the next one.
+    """
+    last_error = None
+    for mirror in self.mirrors.ordered():
+      try:
+        self._update(self.mirrors.only(mirror))
+        return
+      except (IOError, OSError, ValueError) as e:
+        if isinstance(e, Mismatch):
+          self.mirrors.failed(mirror, 'dists/%s' % self.dist, e)
+        # otherwise the mirror set has already recorded what went wrong
+        if last_error is None or not is_not_found(last_error):
+          last_error = e
+    raise last_error
+
+  def _update(self, mirrors):
+    release = self._fetchRelease(mirrors)
+    for component in self.components:
+      self._updateSources(mirrors, release, component)
+
+    filename = release_path(self.distdir)
+    tree.ensure(filename)
+    with open(filename + '.new', 'wb') as f:
+      f.write(release.text)
+    os.rename(filename + '.new', filename)
+
+  def _fetchRelease(self, mirrors):
+    try:
+      return ReleaseIndex(mirrors.fetch(self._relpath('InRelease')))
+    except IOError as e:
+      if not is_not_found(e):
+        raise
+    return ReleaseIndex(mirrors.fetch(self._relpath('Release')))
+
+  def _updateSources(self, mirrors, release, component):
+    base = '%s/source/Sources' % component
+    filename = sources_path(self.distdir, component)
+    target = release.entry(base)
+
+    if target is not None and sha256_file(filename) == target[0]:
+      logger.debug('%s/%s is up to date', self.dist, base)
+      return
+
+    if self.pdiffs and target is not None and os.path.exists(filename):
+      try:
+        if self._patch(mirrors, release, component, filename, target[0]):
+          return
+      except (IOError, OSError, ValueError) as e:
+        logger.info('Could not patch %s/%s, downloading it instead: %s',
+                    self.dist, base, e)
+
+    last_error = None
+    for ext in COMPRESSIONS:
+      entry = release.entry(base + ext)
+      if entry is None or (ext == '.xz' and not _have_xz()):
+        continue
+      try:
+        self._download(mirrors, release, base + ext, entry, filename,
+                       target)
+        return
+      except (IOError, OSError, ValueError) as e:
+        logger.warning('Could not use %s/%s: %s', self.dist, base + ext, e)
+        # a mismatch is what update() needs to hear about
+        if not isinstance(last_error, Mismatch):
+          last_error = e
+
+    if last_error is not None:
+      raise last_error
+
+    # the release does not have this component
+    logger.debug('%s/%s has no Sources', self.dist, component)
+    tree.remove(filename)
+
+  def _download(self, mirrors, release, path, entry, filename, target):
+    sha256, size = entry
+    paths = [path]
+    if release.by_hash:
+      paths.insert(0, '%s/by-hash/SHA256/%s' % (os.path.dirname(path), sha256))
+
+    compressed = filename + '.download'
+    try:
+      for i, p in enumerate(paths):
+        try:
+          mirrors.retrieve(self._relpath(p), compressed)
+          break
+        except IOError as e:
+          if i + 1 == len(paths) or not is_not_found(e):
+            raise
+      if sha256_file(compressed) != sha256:
+        raise Mismatch('%s/%s does not match its checksum' % (self.dist, p))
+
+      _decompress(compressed, filename + '.new', os.path.splitext(path)[1])
+      if target is not None and sha256_file(filename + '.new') != target[0]:
+        raise Mismatch('%s/%s does not decompress to the listed checksum' %
+                      (self.dist, p))
+      os.rename(filename + '.new', filename)
+      logger.info('Downloaded %s/%s (%d bytes)', self.dist, p, size)
+    finally:
+      tree.remove(compressed)
+      tree.remove(filename + '.new')
+
+  def _patch(self, mirrors, release, component, filename, wanted):
+    """Bring filename up to date by applying pdiffs. Return False if
+    there is no pdiff path from what we have to what we want.
+    """
+    index_path = '%s/source/Sources.diff/Index' % component
+    index_entry = release.entry(index_path)
+    if index_entry is None:
+      return False
+    text = mirrors.fetch(self._relpath(index_path))
+    if hashlib.sha256(text).hexdigest() != index_entry[0]:
+      raise Mismatch('%s/%s does not match its checksum' %
+                    (self.dist, index_path))
+    index = ControlFile(fileobj=StringIO(text), multi_para=False,
+                        signed=False).para
+
+    def listing(field):
+      ret = []
+      for line in index.get(field, '').splitlines():
+        parts = line.split()
+        if len(parts) == 3:
+          ret.append((parts[2], parts[0]))
+      return ret
+
+    history = listing('Sha256-History')
+    patches = dict(listing('Sha256-Patches'))
+    downloads = dict(listing('Sha256-Download'))
+
+    have = sha256_file(filename)
+    names = [name for name, sha256 in history]
+    starts = [i for i, (name, sha256) in enumerate(history) if sha256 == have]
+    if not starts:
+      return False
+    if index.get('X-Patch-Precedence') == 'merged':
+      # each merged patch goes straight to the current version
+      names = names[starts[0]:starts[0] + 1]
+    else:
+      names = names[starts[0]:]
+
+    with open(filename) as f:
+      lines = f.readlines()
+    for name in names:
+      data = mirrors.fetch(self._relpath(
+          '%s/source/Sources.diff/%s.gz' % (component, name)))
+      if (name + '.gz' in downloads and
+          hashlib.sha256(data).hexdigest() != downloads[name + '.gz']):
+        raise Mismatch('pdiff %s does not match its checksum' % name)
+      script = gzip.GzipFile(fileobj=StringIO(data)).read()
+      if (name in patches and
+          hashlib.sha256(script).hexdigest() != patches[name]):
+        raise Mismatch('pdiff %s does not match its checksum' % name)
+      lines = apply_ed(lines, script.splitlines(True))
+
+    text = ''.join(lines)
+    if hashlib.sha256(text).hexdigest() != wanted:
+      raise ValueError('patched Sources does not match its checksum')
+    with open(filename + '.new', 'wb') as f:
+      f.write(text)
+    os.rename(filename + '.new', filename)
+    logger.info('Patched %s/%s/source/Sources with %d pdiffs',
+                self.dist, component, len(names))
+    return True
+
+
+def _decompress(compressed, filename, ext):
+  if ext == '.xz' and lzma is None:
+    with open(compressed, 'rb') as src:
+      with open(filename, 'wb') as dst:
+        shell.run(('xz', '-dc'), stdin=src, stdout=dst)
+    return
+
+  if ext == '.xz':
+    src = lzma.LZMAFile(compressed)
+  elif ext == '.bz2':
+    src = bz2.BZ2File(compressed)
+  elif ext == '.gz':
+    src = gzip.open(compressed, 'rb')
+  else:
+    src = open(compressed, 'rb')
+  try:
+    with open(filename, 'wb') as dst:
+      shutil.copyfileobj(src, dst, 1024 * 1024)
+  finally:
+    src.close()
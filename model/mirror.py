@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# model/mirror.py - choose between several mirrors of the same archive
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import errno
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urllib2
+from cStringIO import StringIO
+
+from util import tree
+
+logger = logging.getLogger('model.mirror')
+
+# Size of the reads we do while downloading, and the transfer size we
+# use to turn (latency, throughput) into a single expected cost
+CHUNK_SIZE = 64 * 1024
+NOMINAL_SIZE = 1024 * 1024
+
+# Weight given to the newest sample in the moving averages
+SMOOTHING = 0.3
+
+
+class Stalled(IOError):
+  """A transfer was aborted because it was going too slowly."""
+  pass
+
+
+class Mirror(object):
+  """One URL at which a distro's archive can be found, together with
+  what we have learned about it during this run.
+  """
+
+  def __init__(self, url, local_path=None):
+    self.url = url.rstrip('/')
+    # where the same files can be found on this machine, if they can
+    self.local_path = local_path
+    # moving averages; None until we have made a request
+    self.latency = None
+    self.throughput = None
+    self.failures = 0
+    self.benched_until = 0
+
+  def __repr__(self):
+    return '<Mirror %s latency=%s throughput=%s failures=%d>' % (
+        self.url, self.latency, self.throughput, self.failures)
+
+  @property
+  def healthy(self):
+    return time.time() >= self.benched_until
+
+  def cost(self):
+    """Return the expected number of seconds to fetch NOMINAL_SIZE bytes.
+    Mirrors we have not measured yet cost nothing, so that each of them
+    is tried once before we settle on the fastest.
+    """
+    if self.latency is None:
+      return 0.0
+    if not self.throughput:
+      return self.latency
+    return self.latency + float(NOMINAL_SIZE) / self.throughput
+
+  def record_latency(self, latency):
+    self.latency = _smooth(self.latency, latency)
+
+  def record_success(self, latency, size, duration):
+    self.failures = 0
+    self.benched_until = 0
+    self.record_latency(latency)
+    # tiny files tell us about latency, not throughput
+    if size >= CHUNK_SIZE and duration > 0:
+      self.throughput = _smooth(self.throughput, size / duration)
+
+  def record_failure(self, retry_delay):
+    self.failures += 1
+    # back off exponentially for mirrors that keep failing
+    self.benched_until = time.time() + retry_delay * min(self.failures, 8)
+
+
+def _smooth(old, sample):
+  if old is None:
+    return float(sample)
+  return (1 - SMOOTHING) * old + SMOOTHING * sample
+
+
+def is_not_found(e):
+  """Return True if the exception means the file is absent, as opposed
+  to the mirror being broken.
+  """
+  if isinstance(e, urllib2.HTTPError):
+    return e.code == 404
+  if isinstance(e, urllib2.URLError):
+    return isinstance(e.reason, OSError) and e.reason.errno == errno.ENOENT
+  if isinstance(e, EnvironmentError):
+    return e.errno == errno.ENOENT
+  return False
+
+def local_path(url, local_paths):
+  """Return the directory on this machine that has the same contents as
+  url, or None. file:// URLs are their own local path; otherwise
+  local_paths maps URL prefixes to the directories they serve.
+  """
+  url = url.rstrip('/')
+  if url.startswith('file://'):
+    return url[len('file://'):]
+  for prefix, path in local_paths.iteritems():
+    prefix = prefix.rstrip('/')
+    if url == prefix or url.startswith(prefix + '/'):
+      return path.rstrip('/') + url[len(prefix):]
+  return None
+
+
+def _worst(previous, e):
+  """Choose which of two errors to report if every mirror fails. If any
+  mirror said the file does not exist, callers should hear that.
+  """
+  if previous is not None and is_not_found(previous):
+    return previous
+  return e
+
+
+class MirrorSet(object):
+  """The mirrors configured for a distro. Requests go to the mirror
+  that is expected to be fastest; if it fails or stalls, the next one
+  is tried, and the failed mirror is avoided for a while.
+  """
+
+  def __init__(self, urls, timeout=30, min_rate=4096, grace=10,
+               retry_delay=300, local_paths=None):
+    """Constructor.
+
+    @param urls the mirror URLs, in order of preference
+    @param timeout seconds to wait for a connection or for any data
+    @param min_rate abort transfers slower than this many bytes per second
+    @param grace only apply min_rate after this many seconds
+    @param retry_delay seconds to avoid a mirror after it fails
+    @param local_paths maps URL prefixes to local directories with the
+    same contents, which are used directly instead of downloading
+    """
+    assert len(urls), urls
+    if local_paths is None:
+      local_paths = {}
+    self.mirrors = [Mirror(u, local_path(u, local_paths)) for u in urls]
+    self.timeout = timeout
+    self.min_rate = min_rate
+    self.grace = grace
+    self.retry_delay = retry_delay
+    self._lock = threading.Lock()
+
+  def ordered(self):
+    """Return the mirrors in the order they should be tried: healthy
+    mirrors fastest first, then benched mirrors as a last resort.
+    """
+    with self._lock:
+      # sorted() is stable, so ties keep the configured order
+      healthy = sorted([m for m in self.mirrors if m.healthy],
+                       key=lambda m: m.cost())
+      benched = sorted([m for m in self.mirrors if not m.healthy],
+                       key=lambda m: m.benched_until)
+    return healthy + benched
+
+  def best(self):
+    """Return the URL of the mirror we would use next."""
+    return self.ordered()[0].url
+
+  def only(self, mirror):
+    """Return a MirrorSet that only uses mirror, for files that must
+    all come from the same place. What it learns about mirror is shared
+    with this one.
+    """
+    ret = copy.copy(self)
+    ret.mirrors = [mirror]
+    return ret
+
+  def retrieve(self, relpath, filename):
+    """Download relpath, relative to the top of the archive, into
+    filename. The file only appears once it is complete.
+
+    :return: the number of bytes downloaded
+    """
+    tree.ensure(filename)
+    tmp = '%s.part' % filename
+    last_error = None
+    for mirror in self.ordered():
+      try:
+        if mirror.local_path is not None:
+          size = self._clone(mirror, relpath, tmp)
+        else:
+          with open(tmp, 'wb') as output:
+            size = self._transfer(mirror, relpath, output)
+        os.rename(tmp, filename)
+        return size
+      except (IOError, OSError, socket.error, httplib.HTTPException) as e:
+        last_error = _worst(last_error, e)
+        self.failed(mirror, relpath, e)
+      finally:
+        tree.remove(tmp)
+    raise last_error
+
+  def fetch(self, relpath):
+    """Return the contents of relpath, relative to the top of the
+    archive, as a string.
+    """
+    last_error = None
+    for mirror in self.ordered():
+      buf = StringIO()
+      try:
+        self._transfer(mirror, relpath, buf)
+        return buf.getvalue()
+      except (IOError, OSError, socket.error, httplib.HTTPException) as e:
+        last_error = _worst(last_error, e)
+        self.failed(mirror, relpath, e)
+    raise last_error
+
+  def failed(self, mirror, relpath, e):
+    """Record that fetching relpath from mirror raised e."""
+    if is_not_found(e):
+      # mirrors legitimately lag behind each other, so try the others,
+      # but a missing file says nothing about the mirror's health
+      logger.debug('%s/%s not found', mirror.url, relpath)
+      return
+
+    logger.warning('%s/%s failed: %s', mirror.url, relpath, e)
+    with self._lock:
+      mirror.record_failure(self.retry_delay)
+
+  def _clone(self, mirror, relpath, filename):
+    """Make filename a hardlink, reflink or copy of relpath from a mirror
+    on the local filesystem.
+    """
+    source = os.path.join(mirror.local_path, relpath)
+    start = time.time()
+    tree.remove(filename)
+    how = tree.clone(source, filename)
+    size = os.path.getsize(filename)
+    logger.debug('Made %s of %s', how, source)
+    self.succeeded(mirror, time.time() - start, size, time.time() - start)
+    return size
+
+  def _transfer(self, mirror, relpath, output):
+    if mirror.local_path is not None:
+      url = 'file://%s' % os.path.join(mirror.local_path, relpath)
+    else:
+      url = '%s/%s' % (mirror.url, relpath)
+    logger.debug('Downloading %s', url)
+
+    start = time.time()
+    try:
+      fd = urllib2.urlopen(url, timeout=self.timeout)
+    except urllib2.HTTPError:
+      # the mirror answered, so we still learn its latency, but whether
+      # the error counts against it is for failed() to decide
+      with self._lock:
+        mirror.record_latency(time.time() - start)
+      raise
+
+    try:
+      latency = time.time() - start
+      size = 0
+      while True:
+        chunk = fd.read(CHUNK_SIZE)
+        if not chunk:
+          break
+        output.write(chunk)
+        size += len(chunk)
+
+        elapsed = time.time() - start
+        if elapsed > self.grace and size / elapsed < self.min_rate:
+          raise Stalled('%s stalled at %d bytes/s' %
+                        (url, size / elapsed))
+    finally:
+      fd.close()
+
+    self.succeeded(mirror, latency, size, time.time() - start)
+    return size
+
+  def succeeded(self, mirror, latency, size=0, duration=0):
+    """Record a successful transfer of size bytes from mirror."""
+    with self._lock:
+      mirror.record_success(latency, size, duration)
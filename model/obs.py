@@ -141,9 +141,8 @@ class OBSDistro(Distro):
 
   def package(self, dist, component, name):
     try:
-      for s in self.getSources(dist, component):
-        if s['Package'] == name:
-          return OBSPackage(self, dist, component, name)
+      if self.getSourcesFor(dist, component, name):
+        return OBSPackage(self, dist, component, name)
       raise error.PackageNotFound(name, dist, component)
     except KeyError:
       raise error.PackageNotFound(name, dist, component)
@@ -177,10 +176,6 @@ class OBSDistro(Distro):
     """
     return OBSDistro(name, self)
 
-  def mirrorURL(self, dist, component):
-    mirror = self.config("mirror")
-    return mirror
-
 class OBSPackage(Package):
   def __init__(self, distro, dist, component, name):
     super(OBSPackage, self).__init__(distro, dist, component, name)
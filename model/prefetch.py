@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# model/prefetch.py - download pool files in the background
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import logging
+import os
+import socket
+import threading
+
+from util.parallel import flocked
+
+logger = logging.getLogger('model.prefetch')
+
+# The Prefetcher that downloadPackage() should coordinate with, if any
+_active = None
+
+def active():
+  """Return the running Prefetcher, or None."""
+  return _active
+
+
+class _Item(object):
+  def __init__(self, mirrors, relpath, filename, size, lock):
+    self.mirrors = mirrors
+    self.relpath = relpath
+    self.filename = filename
+    self.size = size
+    self.lock = lock
+    # queued -> running -> done, or queued -> taken if the foreground
+    # wanted the file before any worker got to it
+    self.state = 'queued'
+    self.done = threading.Event()
+
+
+class Prefetcher(object):
+  """Downloads a planned set of files with a pool of threads while the
+  caller works through its packages. The largest files are started
+  first, so that the small ones fill in around them at the end.
+
+  Before using a file the caller should call wait(), which either
+  blocks until the file has been downloaded or, if no worker has
+  started on it yet, takes it off the queue for the caller to download
+  itself.
+  """
+
+  def __init__(self, jobs=4):
+    self.jobs = jobs
+    self._queue = []
+    self._items = {}
+    self._seq = 0
+    self._lock = threading.Lock()
+    self._wakeup = threading.Condition(self._lock)
+    self._threads = []
+    self._closing = False
+    self.fetched = 0
+    self.failed = 0
+
+  def add(self, mirrors, relpath, filename, size, lock=None):
+    """Queue relpath, relative to the top of mirrors, for download into
+    filename. Files that are already queued are ignored.
+
+    If lock is given, the file is only downloaded while holding it, as
+    util.parallel.flocked() does; it is left alone if someone else, such
+    as another process, holds the lock, and so may be downloading it.
+    """
+    with self._lock:
+      if filename in self._items:
+        return
+      item = _Item(mirrors, relpath, filename, size, lock)
+      self._items[filename] = item
+      self._seq += 1
+      heapq.heappush(self._queue, (-size, self._seq, item))
+      self._wakeup.notify()
+
+  def __len__(self):
+    return len(self._items)
+
+  def start(self):
+    """Start the worker threads and make this the active Prefetcher."""
+    global _active
+    for i in range(self.jobs):
+      t = threading.Thread(target=self._work, name='prefetch-%d' % i)
+      t.daemon = True
+      t.start()
+      self._threads.append(t)
+    _active = self
+
+  def wait(self, filename):
+    """Make sure no worker is, or will be, writing filename. Return
+    True if a worker downloaded it, False if the caller has to.
+    """
+    with self._lock:
+      item = self._items.get(filename)
+      if item is None:
+        return False
+      if item.state == 'queued':
+        item.state = 'taken'
+        item.done.set()
+        return False
+    item.done.wait()
+    return item.state == 'done'
+
+  def close(self, cancel=True):
+    """Stop the workers. Unless cancel is False, the files no worker has
+    started on are abandoned first, since nobody asked for them;
+    otherwise they are all downloaded before this returns.
+    """
+    global _active
+    with self._lock:
+      self._closing = True
+      if cancel:
+        for size, seq, item in self._queue:
+          if item.state == 'queued':
+            item.state = 'taken'
+            item.done.set()
+        self._queue = []
+      self._wakeup.notify_all()
+    for t in self._threads:
+      t.join()
+    self._threads = []
+    if _active is self:
+      _active = None
+    logger.info('Prefetched %d files, %d failed', self.fetched, self.failed)
+
+  def _next(self):
+    with self._lock:
+      while True:
+        while self._queue:
+          item = heapq.heappop(self._queue)[2]
+          if item.state == 'queued':
+            item.state = 'running'
+            return item
+        if self._closing:
+          return None
+        self._wakeup.wait()
+
+  def _work(self):
+    while True:
+      item = self._next()
+      if item is None:
+        return
+      try:
+        item.state = self._fetch(item)
+      except (IOError, OSError, socket.error) as e:
+        # the caller will try again, and report the error if it sticks
+        logger.warning('Prefetching %s failed: %s', item.relpath, e)
+        item.state = 'failed'
+      finally:
+        with self._lock:
+          if item.state == 'done':
+            self.fetched += 1
+          elif item.state == 'failed':
+            self.failed += 1
+        item.done.set()
+
+  def _fetch(self, item):
+    """Download item, and return its new state."""
+    if item.lock is None:
+      item.mirrors.retrieve(item.relpath, item.filename)
+      return 'done'
+    with flocked(item.lock, wait=False) as locked:
+      if not locked:
+        # whoever holds the lock downloads it if they need it
+        return 'taken'
+      if not (os.path.isfile(item.filename)
+              and os.path.getsize(item.filename) == item.size):
+        item.mirrors.retrieve(item.relpath, item.filename)
+      return 'done'
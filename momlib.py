@@ -22,19 +22,16 @@ from __future__ import with_statement
 import os
 import re
 import sys
-try:
-    from hashlib import md5
-except ImportError:
-    import md5 as _mod_md5
-    md5 = _mod_md5.new
 import time
 import fcntl
 import gzip
 import errno
 import logging
 import datetime
+import json
 import shutil
 import stat
+import threading
 import time
 import osc.core
 import osc.conf
@@ -43,11 +40,19 @@ from cgi import escape
 from optparse import OptionParser
 
 import config
+from deb.archive import Unsupported, diff_debian, diff_sources, \
+    upstream_summary
+from deb.changes import source_changes
 from deb.controlfile import ControlFile
 from deb.version import Version
-from util import shell, tree, pathhash
-
-from model import Distro
+from util import compress, shell, tree, pathhash
+from util.diffsink import DiffSink, format_diffstat
+from util.manifest import Manifest
+from util.scratch import Scratch
+from util.unpackcache import UnpackCache
+
+from model import Distro, delta
+from model.indices import sha256_file
 import model.error
 
 try:
@@ -66,8 +71,10 @@ logger = logging.getLogger('momlib')
 # --------------------------------------------------------------------------- #
 
 def cleanup(path):
-    """Remove the path and any empty directories up to ROOT."""
-    tree.remove(path)
+    """Remove the path and any empty directories up to ROOT, and the
+    scratch space it is a link to, if it is.
+    """
+    scratch_space().remove(path)
 
     (dirname, basename) = os.path.split(path)
     while dirname != config.get('ROOT'):
@@ -80,10 +87,6 @@ def cleanup(path):
 
         (dirname, basename) = os.path.split(dirname)
 
-def md5sum(filename):
-    """Return an md5sum."""
-    return md5(open(filename).read()).hexdigest()
-
 
 # --------------------------------------------------------------------------- #
 # Location functions
@@ -133,6 +136,18 @@ def patch_file(distro, pv, slipped=False):
     else:
         return path + ".patch"
 
+def store_compression():
+    """Return how diff, patch and changes files are compressed."""
+    return config.get('STORE_COMPRESSION', default='xz')
+
+def diffstat_file(filename):
+    """Return where the diffstat of a patch that was cut short is kept."""
+    return filename + ".diffstat"
+
+def stats_file(filename):
+    """Return where the totals of what a patch changes are kept."""
+    return filename + ".diffstat.json"
+
 def published_file(distro, pv):
     """Return the location where published patches should be placed."""
     return "%s/published/%s/%s/%s_%s.patch" \
@@ -172,11 +187,10 @@ def files(source):
 def read_basis(filename):
     """Read the basis version of a patch from a file."""
     basis_file = filename + "-basis"
-    if not os.path.isfile(basis_file):
+    if not compress.exists(basis_file):
         return None
 
-    with open(basis_file) as basis:
-        return Version(basis.read().strip())
+    return Version(compress.read(basis_file).strip())
 
 def save_basis(filename, version):
     """Save the basis version of a patch to a file."""
@@ -189,63 +203,225 @@ def save_basis(filename, version):
 # Unpacked source handling
 # --------------------------------------------------------------------------- #
 
-def unpack_source(pv):
-    """Unpack the given source and return location."""
-    destdir = unpack_directory(pv)
-    if os.path.isdir(destdir):
-        return destdir
-
+# {ROOT: UnpackCache}
+_unpack_caches = {}
+
+# {ROOT: Scratch}
+_scratch_spaces = {}
+
+# {unpack_directory(pv): key in the unpack cache} for the sources this
+# process has unpacked and not cleaned up
+_unpacked = {}
+
+def unpack_cache():
+    """Return the cache of unpacked sources for the current ROOT."""
+    root = config.get('ROOT')
+    if root not in _unpack_caches:
+        _unpack_caches[root] = UnpackCache(
+            "%s/unpack-cache" % root,
+            budget=config.get('UNPACK_CACHE_SIZE', default=20 << 30),
+            slots=config.get('UNPACK_JOBS', default=4))
+    return _unpack_caches[root]
+
+def scratch_space():
+    """Return the scratch space for short-lived trees under the current
+    ROOT, which is in SCRATCH_DIR, if that is set, up to SCRATCH_SIZE.
+    """
+    root = config.get('ROOT')
+    if root not in _scratch_spaces:
+        _scratch_spaces[root] = Scratch(
+            config.get('SCRATCH_DIR', default=None),
+            budget=config.get('SCRATCH_SIZE', default=1 << 30))
+    return _scratch_spaces[root]
+
+def _cache_key(pv):
+    """Return the key of a source in the unpack cache."""
+    dsc_file = "%s/%s" % (pv.package.poolPath, pv.dscPath)
+    key = sha256_file(dsc_file)
+    if key is None:
+        raise ValueError("%s does not exist" % dsc_file)
+    return key
+
+def _unpack_into(pv, path):
+    """Unpack a source into path, for the unpack cache, and return its
+    manifest.
+    """
     srcdir = pv.package.poolPath
     dsc_file = pv.dscPath
-
     logger.info("Unpacking %s from %s/%s", pv, srcdir, dsc_file)
+    tree.ensure(path)
+    shell.run(("dpkg-source", "--skip-patches", "-x", dsc_file, path), chdir=srcdir, stdout=sys.stdout, stderr=sys.stderr)
+    # Make sure we can at least read everything under .pc, which isn't
+    # automatically true with dpkg-dev 1.15.4.
+    manifest = Manifest.scan(path)
+    for filename in manifest.walk():
+        if not tree.under(".pc", filename):
+            continue
+        if stat.S_IMODE(manifest.entries[filename].st_mode) == 0:
+            pc_filename = os.path.join(path, filename)
+            os.chmod(pc_filename, 0400)
+            manifest.entries[filename] = Manifest.entry(pc_filename)
+    return manifest
+
+def unpack_source(pv):
+    """Unpack the given source and return location.
+
+    Sources are unpacked into the unpack cache, keyed by the SHA-256 of
+    their .dsc, so each version is only unpacked once until it is evicted;
+    the location returned is a symlink to the cached tree. The tree must
+    not be modified, and cleanup_source() should be called once it is no
+    longer needed.
+    """
+    destdir = unpack_directory(pv)
+    key = _cache_key(pv)
+
+    cache = unpack_cache()
+    cached = cache.acquire(key, lambda path: _unpack_into(pv, path))
+    if destdir in _unpacked:
+        cache.release(_unpacked[destdir])
+    _unpacked[destdir] = key
 
-    tree.ensure(destdir)
     try:
-        # output directory for "dpkg-source -x" must not exist
-        if (os.path.isdir(destdir)):
-            os.rmdir(destdir)
-        shell.run(("dpkg-source", "--skip-patches", "-x", dsc_file, destdir), chdir=srcdir, stdout=sys.stdout, stderr=sys.stderr)
-        # Make sure we can at least read everything under .pc, which isn't
-        # automatically true with dpkg-dev 1.15.4.
-        pc_dir = os.path.join(destdir, ".pc")
-        for filename in tree.walk(pc_dir):
-            pc_filename = os.path.join(pc_dir, filename)
-            pc_stat = os.lstat(pc_filename)
-            if pc_stat is not None and stat.S_IMODE(pc_stat.st_mode) == 0:
-                os.chmod(pc_filename, 0400)
+        if not os.path.islink(destdir) or os.readlink(destdir) != cached:
+            # replace whatever is there, including a directory unpacked
+            # by earlier versions, in one step for anyone else looking
+            tree.remove(destdir)
+            tree.ensure(destdir)
+            link = "%s.new.%d" % (destdir, os.getpid())
+            tree.remove(link)
+            os.symlink(cached, link)
+            os.rename(link, destdir)
     except:
-        cleanup(destdir)
+        cache.release(_unpacked.pop(destdir))
         raise
 
     return destdir
 
 def cleanup_source(pv):
-    """Cleanup the given source's unpack location."""
-    cleanup(unpack_directory(pv))
+    """Cleanup the given source's unpack location.
+
+    The unpacked tree stays in the unpack cache, from which it is evicted
+    once it has not been used for a while.
+    """
+    key = _unpacked.pop(unpack_directory(pv), None)
+    if key is not None:
+        unpack_cache().release(key)
+
+def _in_threads(func, items, name):
+    """Call func(item) for each of items in a thread of its own. Return
+    the threads and a list that will hold the exception raised for each
+    item, or None.
+    """
+    errors = [None] * len(items)
+
+    def work(index):
+        try:
+            func(items[index])
+        except Exception as e:
+            errors[index] = e
+
+    threads = []
+    for i in range(len(items)):
+        t = threading.Thread(target=work, args=(i,), name="%s-%d" % (name, i))
+        t.start()
+        threads.append(t)
+    return threads, errors
+
+def unpack_sources(pvs):
+    """Unpack several sources at once, as unpack_source() does, and
+    return their locations in the same order. Each must be cleaned up
+    with cleanup_source() as usual.
+
+    How many are unpacked at the same time is limited by UNPACK_JOBS,
+    across every process sharing the unpack cache.
+    """
+    unique = dict((unpack_directory(pv), pv) for pv in pvs).values()
+
+    threads, errors = _in_threads(unpack_source, unique, "unpack")
+    for t in threads:
+        t.join()
+    failed = [e for e in errors if e is not None]
+    if failed:
+        for pv, e in zip(unique, errors):
+            if e is None:
+                cleanup_source(pv)
+        raise failed[0]
+    return [unpack_directory(pv) for pv in pvs]
+
+# Threads unpacking sources into the cache for later
+_prefetching = []
+
+def prefetch_sources(pvs):
+    """Start unpacking sources into the unpack cache in the background,
+    so that unpack_source() finds them there later on.
+    """
+    def warm(pv):
+        try:
+            key = _cache_key(pv)
+            cache = unpack_cache()
+            cache.acquire(key, lambda path: _unpack_into(pv, path))
+            cache.release(key)
+        except Exception as e:
+            # unpack_source() will try again and report it
+            logger.debug("Could not unpack %s in advance: %s", pv, e)
+
+    _prefetching[:] = [t for t in _prefetching if t.is_alive()]
+    threads, errors = _in_threads(warm, pvs, "prefetch")
+    _prefetching.extend(threads)
+
+def finish_prefetch():
+    """Wait for the sources being unpacked in the background."""
+    while _prefetching:
+        _prefetching.pop().join()
 
 def save_changes_file(filename, pv, previous=None):
-    """Save a changes file for the given source."""
-    srcdir = unpack_directory(pv)
+    """Save a changes file for the given source.
 
+    The changes file is written from the source's .dsc and the changelog
+    and control file in its archives; the source is only unpacked, and
+    dpkg-genchanges run, if that can't be done.  It is stored compressed
+    with store_compression().
+    """
     tree.ensure(filename)
-    with open(filename, "w") as changes:
+    try:
+        text = source_changes(
+            "%s/%s" % (pv.package.poolPath, pv.dscPath),
+            None if previous is None else str(previous.version))
+    except (Unsupported, EnvironmentError) as e:
+        logger.debug("Unpacking %s to write its changes file: %s", pv, e)
+
+        srcdir = unpack_source(pv)
         cmd = ("dpkg-genchanges", "-S", "-u%s" % pv.package.poolPath)
         orig_cmd = cmd
         if previous is not None:
             cmd += ("-v%s" % previous.version,)
 
         try:
-            shell.run(cmd, chdir=srcdir, stdout=changes)
+            text = shell.get(cmd, chdir=srcdir, strip=False)
         except (ValueError, OSError):
-            shell.run(orig_cmd, chdir=srcdir, stdout=changes)
+            text = shell.get(orig_cmd, chdir=srcdir, strip=False)
 
+    with compress.open_write(filename, store_compression()) as changes:
+        changes.write(text)
     return filename
 
 def save_patch_file(filename, last, this):
-    """Save a diff or patch file for the difference between two versions."""
+    """Save a diff or patch file for the difference between two versions.
+
+    Unless both are unpacked already, the diff is worked out from their
+    source archives, and they are only unpacked if that can't be done.
+    It is stored compressed with store_compression().
+
+    If DEBIAN_ONLY_DIFFS is set and both are 3.0 (quilt) sources, only
+    debian/ is compared; if their upstream tarballs differ, the diff
+    starts with a summary of them instead.
+
+    The diff is cut short as diff_sink() does, and what it changes is
+    saved alongside by save_diffstat().
+    """
     lastdir = unpack_directory(last)
     thisdir = unpack_directory(this)
+    unpacked = lastdir in _unpacked and thisdir in _unpacked
 
     diffdir = os.path.commonprefix((lastdir, thisdir))
     diffdir = diffdir[:diffdir.rindex("/")]
@@ -253,10 +429,137 @@ def save_patch_file(filename, last, this):
     lastdir = tree.subdir(diffdir, lastdir)
     thisdir = tree.subdir(diffdir, thisdir)
 
+    last_dsc = "%s/%s" % (last.package.poolPath, last.dscPath)
+    this_dsc = "%s/%s" % (this.package.poolPath, this.dscPath)
+    summary = None
+    if config.get('DEBIAN_ONLY_DIFFS', default=True):
+        try:
+            summary = upstream_summary(last_dsc, this_dsc, lastdir, thisdir)
+        except (Unsupported, EnvironmentError) as e:
+            logger.debug("Comparing all of %s and %s: %s", last, this, e)
+
     tree.ensure(filename)
-    with open(filename, "w") as diff:
-        shell.run(("diff", "-pruN", lastdir, thisdir),
-                  chdir=diffdir, stdout=diff, okstatus=(0, 1, 2))
+    if not unpacked:
+        try:
+            with compress.open_write(filename, store_compression()) as out:
+                diff = diff_sink(out)
+                blksize = os.stat(config.get('ROOT')).st_blksize
+                if summary is None:
+                    diff_sources(last_dsc, this_dsc, lastdir, thisdir, diff,
+                                 blksize=blksize)
+                else:
+                    diff.write(summary)
+                    diff_debian(last_dsc, this_dsc, lastdir, thisdir, diff,
+                                blksize=blksize)
+                diff.close()
+            save_diffstat(filename, diff)
+            return
+        except (Unsupported, EnvironmentError) as e:
+            logger.debug("Unpacking %s and %s to compare them: %s",
+                         last, this, e)
+        unpack_source(last)
+        unpack_source(this)
+
+    if summary is not None:
+        lastdir = "%s/debian" % lastdir
+        thisdir = "%s/debian" % thisdir
+    with compress.open_write(filename, store_compression()) as out:
+        diff = diff_sink(out)
+        if summary is not None:
+            diff.write(summary)
+        p = shell.open(("diff", "-pruN", lastdir, thisdir),
+                       chdir=diffdir, okstatus=(0, 1, 2))
+        try:
+            shutil.copyfileobj(p, diff, 1024 * 1024)
+        finally:
+            p.close()
+        diff.close()
+    save_diffstat(filename, diff)
+
+def diff_sink(out):
+    """Return a DiffSink writing a diff to out, which is cut short once
+    it is DIFF_MAX_BYTES long or has DIFF_MAX_HUNKS hunks.
+    """
+    return DiffSink(out, config.get('DIFF_MAX_BYTES', default=None),
+                    config.get('DIFF_MAX_HUNKS', default=None))
+
+def save_diffstat(filename, sink):
+    """Save the totals of what the patch filename, which sink wrote,
+    changes to stats_file(), and its diffstat if it was cut short;
+    otherwise remove any diffstat there was from before.
+    """
+    with open(stats_file(filename) + ".new", "w") as f:
+        json.dump(sink.stats(), f, sort_keys=True)
+    os.rename(stats_file(filename) + ".new", stats_file(filename))
+
+    diffstat = diffstat_file(filename)
+    if sink.truncated:
+        logger.info("Truncated %s, after %d bytes",
+                    tree.subdir(config.get('ROOT'), filename), sink.written)
+        with open(diffstat + ".new", "w") as f:
+            f.write(format_diffstat(sink.files))
+        os.rename(diffstat + ".new", diffstat)
+    elif os.path.exists(diffstat):
+        os.unlink(diffstat)
+
+def read_stats(filename):
+    """Return what save_diffstat() saved for the patch filename, or None
+    if it has not been.
+    """
+    try:
+        with open(stats_file(filename)) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+# --------------------------------------------------------------------------- #
+# Packages to process in each stage
+# --------------------------------------------------------------------------- #
+
+def package_work(options, args):
+    """Return (package, targets) for the packages of the targets in args
+    that a stage should process, in order.  Each pool is only in there
+    once, however many targets share it, so that the packages can be
+    processed at the same time.
+    """
+    work = []
+    by_pool = {}
+    for target in config.targets(args):
+        affected = delta.wanted(options, target)
+        for pkg in target.distro.packages(target.dist, target.component):
+            if options.package and pkg.name not in options.package:
+                continue
+            if affected is not None and pkg.name not in affected:
+                continue
+            if pkg.name in target.blacklist:
+                logger.debug("%s is blacklisted, skipping", pkg.name)
+                continue
+            if pkg.poolPath not in by_pool:
+                by_pool[pkg.poolPath] = (pkg, [])
+                work.append(by_pool[pkg.poolPath])
+            by_pool[pkg.poolPath][1].append(target)
+    return work
+
+def record_failures(work, results, what):
+    """Log the packages of work that run_jobs() returned as failed in
+    results, and have them processed again in the next run.
+    """
+    failed = set(pkg.poolPath for pkg, result, error in results if error)
+    if not failed:
+        return
+
+    logger.error("Could not %s for %d packages: %s", what, len(failed),
+                 " ".join(pkg.name for pkg, targets in work
+                          if pkg.poolPath in failed))
+    current = delta.Delta.load()
+    if current is not None:
+        for pkg, targets in work:
+            if pkg.poolPath in failed:
+                for target in targets:
+                    current.fail(target, pkg.name)
+        current.save()
 
 # --------------------------------------------------------------------------- #
 # Blacklist and whitelist handling
@@ -423,6 +726,33 @@ class PackageLists(object):
 
         return True
 
+def needed_packages(distro, dist, targets=None):
+    """Return the names of the source packages in (distro, dist) that
+    some target needs: those in each target that is (distro, dist) or
+    merges from it, less anything the target's blacklist or package
+    lists leave out. Their base versions have the same names, so this
+    covers those too.
+    """
+    if targets is None:
+        targets = config.targets()
+    lists = PackageLists()
+
+    names = set()
+    for target in targets:
+        wanted = [(target.distro.name, target.dist)]
+        for srclist in target.getAllSourceLists():
+            wanted.extend((s.distro.name, s.dist) for s in srclist)
+        if (distro.name, dist) not in wanted:
+            continue
+
+        for pkg in target.distro.packages(target.dist, target.component):
+            if pkg.name in target.blacklist:
+                continue
+            if not lists.check_target(target.name, None, pkg.name):
+                continue
+            names.add(pkg.name)
+    return names
+
 def get_target_distro_dist_component(target):
     """Return the distro, dist, and component for a given distribution target"""
     distro_targets = config.get('DISTRO_TARGETS')
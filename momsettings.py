@@ -67,7 +67,13 @@ DISTROS = {
     },
     # Debian, another upstream project
     "debian": {
-        "mirror": "http://ftp.debian.org/debian",
+        # Several mirrors can be listed instead of a single "mirror";
+        # each request goes to whichever one has been fastest so far,
+        # moving on to the next if it fails or stalls
+        "mirrors": [
+            "http://ftp.debian.org/debian",
+            "http://httpredir.debian.org/debian",
+        ],
         "dists": [
             "squeeze", "squeeze-updates",
             "wheezy", "wheezy-updates",
@@ -75,6 +81,9 @@ DISTROS = {
             "unstable", "experimental",
         ],
         "components": [ "main", "contrib", "non-free" ],
+        # Bring Sources files up to date by applying the archive's pdiffs
+        # instead of downloading them again, where possible
+        "pdiffs": True,
         "expire": True,
     },
     # Debian's security updates are in a separate apt repository, so we
@@ -87,6 +96,59 @@ DISTROS = {
     },
 }
 
+# Give up on a mirror if it takes more than MIRROR_TIMEOUT seconds to
+# respond, or sends less than MIRROR_MIN_RATE bytes per second; it is then
+# avoided for MIRROR_RETRY_DELAY seconds (longer if it keeps failing)
+MIRROR_TIMEOUT = 30
+MIRROR_MIN_RATE = 4096
+MIRROR_RETRY_DELAY = 300
+
+# Mirrors that are also on this machine, such as the OBS master's own
+# repositories, mapped to the directories they serve. Files are then
+# hardlinked (or reflinked, or copied) into the pool instead of being
+# downloaded; file:// mirrors are always treated this way
+MIRROR_LOCAL_PATHS = {
+    # "http://obs:82/shared": "/srv/obs/repos/shared",
+}
+
+# How many distro releases to download Sources indices for at once
+REFRESH_JOBS = 4
+
+# How many pool files to download in the background while update_sources
+# works through the packages (0 to download each one when it is needed)
+PREFETCH_JOBS = 4
+
+# How much disk space, in bytes, unpacked sources may take up between
+# runs; the least recently used ones are removed first (None to keep
+# everything)
+UNPACK_CACHE_SIZE = 20 << 30
+
+# How many sources may be unpacked at the same time, by all the processes
+# sharing the unpack cache
+UNPACK_JOBS = 4
+
+# How diffs, patches and changes files are compressed as they are written:
+# "xz", "bz2", "gzip" or "none"; files compressed any of these ways, as
+# pack-archive.sh does, can be read whatever this is set to
+STORE_COMPRESSION = "xz"
+
+# Whether diffs and patches between two 3.0 (quilt) sources only compare
+# debian/, with a summary of the upstream tarballs if they differ instead
+# of a diff of everything else
+DEBIAN_ONLY_DIFFS = True
+
+# How large diffs and patches may get: past this many bytes or hunks only
+# a diffstat of the rest is written, and kept next to the patch as well
+# (None for no limit)
+DIFF_MAX_BYTES = 64 * 1024 * 1024
+DIFF_MAX_HUNKS = None
+
+# Where merges are produced and source packages built, ideally on a tmpfs
+# of its own, and how many bytes of it may be used at once; whatever
+# doesn't fit is done under ROOT instead (None to always use ROOT)
+SCRATCH_DIR = None
+SCRATCH_SIZE = 1 << 30
+
 # Sets of sources of upstream packages
 DISTRO_SOURCES = {
     # Ubuntu 'raring' and its updates
@@ -19,12 +19,13 @@
 
 from __future__ import with_statement
 
+import errno
 import os
 import re
 import time
 import logging
+import shutil
 import subprocess
-import tempfile
 
 from stat import *
 
@@ -32,9 +33,10 @@ from momlib import *
 from deb.controlfile import ControlFile
 from deb.version import Version
 from generate_patches import generate_patch
-from util import tree, shell, run
+from util import compress, manifest, merge3, tree, shell, run
 from merge_report import (MergeResult, MergeReport, read_report, write_report)
 from model.base import (PackageVersion, Package, UpdateInfo)
+from model import delta
 from momversion import VERSION
 import config
 import model.error
@@ -47,6 +49,9 @@ class NoBase(Exception):
 def options(parser):
     parser.add_option("-f", "--force", action="store_true",
                       help="Force creation of merges")
+    parser.add_option("--full", action="store_true",
+                      help="Process every package, not just those affected "
+                           "by changes since the last run")
 
     parser.add_option("-D", "--source-distro", type="string", metavar="DISTRO",
                       default=None,
@@ -71,8 +76,9 @@ def options(parser):
 
 # Handle the merge of a specific package, returning the new merge report,
 # or None if there was already a merge report that is still valid.
-def handle_package(output_dir, target, pkg, our_version):
-  update_info = UpdateInfo(pkg)
+def handle_package(output_dir, target, pkg, our_version, update_info=None):
+  if update_info is None:
+    update_info = UpdateInfo(pkg)
 
   if update_info.version is None:
     logger.error('UpdateInfo version %s does not match our version %s"',
@@ -101,14 +107,7 @@ def handle_package(output_dir, target, pkg, our_version):
     report.result = MergeResult.NO_BASE
     return report
 
-  upstream = None
-  base = None
-  pool_versions = target.getAllPoolVersions(pkg.name)
-  for pv in pool_versions:
-    if pv.version == update_info.upstream_version:
-      upstream = pv
-    if pv.version == update_info.base_version:
-      base = pv
+  upstream, base = find_pool_versions(target, pkg, update_info)
 
   if upstream is None:
     logger.error('Could not find upstream version %s in pool',
@@ -181,6 +180,33 @@ def handle_package(output_dir, target, pkg, our_version):
     report.message = 'Could not produce merge: %s' % e
     return report
 
+# Find the upstream and base versions named by update_info in the pool,
+# returning (upstream, base) with None for those that aren't there.
+def find_pool_versions(target, pkg, update_info):
+  upstream = None
+  base = None
+  pool_versions = target.getAllPoolVersions(pkg.name)
+  for pv in pool_versions:
+    if pv.version == update_info.upstream_version:
+      upstream = pv
+    if pv.version == update_info.base_version:
+      base = pv
+  return upstream, base
+
+# Return the sources handle_package() will unpack to merge our_version,
+# as far as can be told without doing it.
+def merge_sources(target, pkg, our_version, update_info):
+  if update_info.version is None \
+      or update_info.upstream_version is None \
+      or our_version.version >= update_info.upstream_version \
+      or update_info.base_version is None \
+      or pkg.name in target.sync_upstream_packages:
+    return []
+  upstream, base = find_pool_versions(target, pkg, update_info)
+  if upstream is None or base is None:
+    return []
+  return [our_version, upstream, base]
+
 def main(options, args):
     logger.info('Producing merges...')
 
@@ -199,12 +225,21 @@ def main(options, args):
     # For each package in the destination distribution, locate the latest in
     # the source distribution; calculate the base from the destination and
     # produce a merge combining both sets of changes
+    failed = []
     for target in config.targets(args):
         logger.info('considering target %s', target)
         our_dist = target.dist
         our_component = target.component
         d = target.distro
-        for pkg in d.packages(target.dist, target.component):
+        packages = d.packages(target.dist, target.component)
+        affected = delta.wanted(options, target)
+        if affected is not None:
+          packages = [pkg for pkg in packages if pkg.name in affected]
+          logger.info('%d packages affected by changes since the last run',
+                      len(packages))
+        update_infos = UpdateInfo.forPackages(packages)
+        todo = []
+        for pkg in packages:
           if options.package is not None and pkg.name not in options.package:
             continue
           if len(includes) and pkg.name not in includes:
@@ -216,6 +251,9 @@ def main(options, args):
           if pkg.name in target.blacklist:
             logger.info("%s is blacklisted, skipping", pkg.name)
             continue
+          todo.append(pkg)
+
+        for i, pkg in enumerate(todo):
           logger.info('considering package %s', pkg.name)
           if options.version:
             our_version = PackageVersion(pkg, Version(options.version))
@@ -224,13 +262,40 @@ def main(options, args):
             our_version = pkg.newestVersion()
             logger.debug('our version: %s', our_version)
 
+          # Unpack what the next package needs while this one is merged
+          if i + 1 < len(todo) and not options.version:
+            prefetch_next(target, todo[i + 1], update_infos)
+
           output_dir = result_dir(target.name, pkg.name)
           try:
-            report = handle_package(output_dir, target, pkg, our_version)
+            report = handle_package(output_dir, target, pkg, our_version,
+                                    update_infos[pkg.name])
             if report is not None:
               report.write_report(output_dir)
           except Exception:
             logging.exception('Failed handling merge for %s', pkg)
+            failed.append((target, pkg.name))
+
+    finish_prefetch()
+    scratch_space().report()
+
+    # Try the failed packages again next time, even if nothing changes
+    current = delta.Delta.load()
+    if failed and current is not None:
+      for target, name in failed:
+        current.fail(target, name)
+      current.save()
+
+# Start unpacking the sources a merge of pkg will need in the background.
+def prefetch_next(target, pkg, update_infos):
+  try:
+    sources = merge_sources(target, pkg, pkg.newestVersion(),
+                            update_infos[pkg.name])
+  except Exception:
+    # handle_package() will run into it again, and report it
+    logger.debug('Not unpacking %s in advance', pkg, exc_info=True)
+    return
+  prefetch_sources(sources)
 
 def is_build_metadata_changed(left_source, right_source):
     """Return true if the two sources have different build-time metadata."""
@@ -262,6 +327,48 @@ class MergeData(object):
     return len(self.added_files) + len(self.removed_files) + \
            len(self.modified_files)
 
+def classify_paths(base_files, left_files, right_files, both_formats_quilt):
+    """Sort out what do_merge() has to do with each path in the trees
+    whose manifests are given, in one pass over them all, before any
+    file is read.  Return three lists:
+
+    - (path, base stat, left stat, right stat) for the files in the base,
+    - (path, left stat, right stat) for the files new in the left tree,
+    - (path, whether it is new) for the files to copy from the right
+      tree, which is everything outside debian/ if both_formats_quilt.
+
+    A stat is None if there is nothing at the path in that tree.  Quilt
+    metadata is left out, as is everything outside debian/ of the base
+    and the left tree if both_formats_quilt.
+    """
+    in_base = []
+    new_in_left = []
+    new_in_right = []
+    for path, listed, stats in manifest.join((base_files, left_files,
+                                               right_files)):
+        top = path.split('/', 1)[0]
+        if top == ".pc":
+            # Not interested in merging quilt metadata
+            continue
+        # only the debian directory of 3.0 (quilt) packages is merged
+        upstream = both_formats_quilt and top != "debian"
+
+        # what util.tree.walk() would find in each tree: not directories
+        walked = [listed[i] and not S_ISDIR(stats[i].st_mode)
+                  for i in range(3)]
+        base_stat, left_stat, right_stat = stats
+
+        if walked[0] and not upstream:
+            in_base.append((path, base_stat, left_stat, right_stat))
+        if walked[1] and not upstream and base_stat is None:
+            new_in_left.append((path, left_stat, right_stat))
+        if walked[2] and upstream:
+            # Always copy right version for quilt non-debian files
+            new_in_right.append((path, left_stat is None))
+        elif walked[2] and base_stat is None and left_stat is None:
+            new_in_right.append((path, True))
+    return in_base, new_in_left, new_in_right
+
 def do_merge(left_dir, left_name, left_format, left_distro, base_dir,
              right_dir, right_name, right_format, right_distro, merged_dir):
     """Do the heavy lifting of comparing and merging."""
@@ -274,30 +381,19 @@ def do_merge(left_dir, left_name, left_format, left_distro, base_dir,
         logger.debug("Only merging debian directory since both "
                      "formats 3.0 (quilt)")
 
-    # Look for files in the base and merge them if they're in both new
-    # files (removed files get removed)
-    for filename in tree.walk(base_dir):
-        # If both packages are 3.0 (quilt), ignore everything except the
-        # debian directory
-        if both_formats_quilt and not tree.under("debian", filename):
-            continue
-
-        if tree.under(".pc", filename):
-            # Not interested in merging quilt metadata
-            continue
-
-        base_stat = os.lstat("%s/%s" % (base_dir, filename))
-
-        try:
-            left_stat = os.lstat("%s/%s" % (left_dir, filename))
-        except OSError:
-            left_stat = None
+    # The trees are not modified while merging, so what is in them only
+    # needs working out once; for unpacked sources that was done when
+    # they were unpacked
+    base_files = manifest.for_tree(base_dir, fresh=True)
+    left_files = manifest.for_tree(left_dir, fresh=True)
+    right_files = manifest.for_tree(right_dir, fresh=True)
 
-        try:
-            right_stat = os.lstat("%s/%s" % (right_dir, filename))
-        except OSError:
-            right_stat = None
+    in_base, new_in_left, new_in_right = classify_paths(
+        base_files, left_files, right_files, both_formats_quilt)
 
+    # Merge the files in the base if they're in both new trees (removed
+    # files get removed)
+    for filename, base_stat, left_stat, right_stat in in_base:
         if left_stat is None and right_stat is None:
             # Removed on both sides
             pass
@@ -349,32 +445,16 @@ def do_merge(left_dir, left_name, left_format, left_distro, base_dir,
             # all three differ, mark a conflict
             result.conflicts.add(filename)
 
-    # Look for files in the left hand side that aren't in the base,
-    # conflict if new on both sides or copy into the tree
-    for filename in tree.walk(left_dir):
-        # If both packages are 3.0 (quilt), ignore everything except the
-        # debian directory
-        if both_formats_quilt and not tree.under("debian", filename):
-            continue
-
-        if tree.under(".pc", filename):
-            # Not interested in merging quilt metadata
-            continue
-
-        if tree.exists("%s/%s" % (base_dir, filename)):
-            continue
-
-        if not tree.exists("%s/%s" % (right_dir, filename)):
+    # Files in the left hand side that aren't in the base conflict if
+    # new on both sides, or are copied into the tree
+    for filename, left_stat, right_stat in new_in_left:
+        if right_stat is None:
             logger.debug("new in %s: %s", left_distro, filename)
             tree.copyfile("%s/%s" % (left_dir, filename),
                           "%s/%s" % (merged_dir, filename))
             result.added_files.add(filename)
-            continue
 
-        left_stat = os.lstat("%s/%s" % (left_dir, filename))
-        right_stat = os.lstat("%s/%s" % (right_dir, filename))
-
-        if S_ISREG(left_stat.st_mode) and S_ISREG(right_stat.st_mode):
+        elif S_ISREG(left_stat.st_mode) and S_ISREG(right_stat.st_mode):
             # Common case: left and right are both files
             handle_file(left_stat, left_dir, left_name, left_distro,
                         right_dir, right_stat, right_name, right_distro,
@@ -391,24 +471,9 @@ def do_merge(left_dir, left_name, left_format, left_distro, base_dir,
             result.conflicts.add(filename)
 
     # Copy new files on the right hand side only into the tree
-    for filename in tree.walk(right_dir):
-        if tree.under(".pc", filename):
-            # Not interested in merging quilt metadata
-            continue
-
-        if both_formats_quilt and not tree.under("debian", filename):
-            # Always copy right version for quilt non-debian files
-            if not tree.exists("%s/%s" % (left_dir, filename)):
-                logger.debug("new in %s: %s", right_distro, filename)
-        else:
-            if tree.exists("%s/%s" % (base_dir, filename)):
-                continue
-
-            if tree.exists("%s/%s" % (left_dir, filename)):
-                continue
-
+    for filename, new in new_in_right:
+        if new:
             logger.debug("new in %s: %s", right_distro, filename)
-
         tree.copyfile("%s/%s" % (right_dir, filename),
                       "%s/%s" % (merged_dir, filename))
 
@@ -505,8 +570,8 @@ def same_file(left_stat, left_dir, right_stat, right_dir, filename):
         # Files with the same size and MD5sum are the same
         if left_stat.st_size != right_stat.st_size:
             return False
-        elif md5sum("%s/%s" % (left_dir, filename)) \
-                 != md5sum("%s/%s" % (right_dir, filename)):
+        elif manifest.for_tree(left_dir).digest(filename) \
+                 != manifest.for_tree(right_dir).digest(filename):
             return False
         else:
             return True
@@ -522,8 +587,8 @@ def same_file(left_stat, left_dir, right_stat, right_dir, filename):
             return True
     elif S_ISLNK(left_stat.st_mode):
         # Symbolic links are the same if they have the same target
-        if os.readlink("%s/%s" % (left_dir, filename)) \
-               != os.readlink("%s/%s" % (right_dir, filename)):
+        if manifest.for_tree(left_dir).readlink(filename) \
+               != manifest.for_tree(right_dir).readlink(filename):
             return False
         else:
             return True
@@ -606,35 +671,47 @@ def find_closest_pot(po_file):
 
 def diff3_merge(left_dir, left_name, left_distro, base_dir,
                 right_dir, right_name, right_distro, merged_dir, filename):
-    """Merge a file using diff3."""
+    """Merge a file as diff3 does, running it only on files that
+    util.merge3 leaves to it."""
     dest = "%s/%s" % (merged_dir, filename)
     tree.ensure(dest)
+    left = "%s/%s" % (left_dir, filename)
+    base = "%s/%s" % (base_dir, filename)
+    right = "%s/%s" % (right_dir, filename)
 
     with open(dest, "w") as output:
-        status = shell.run(("diff3", "-E", "-m",
-                            "-L", left_name, "%s/%s" % (left_dir, filename),
-                            "-L", "BASE", "%s/%s" % (base_dir, filename),
-                            "-L", right_name, "%s/%s" % (right_dir, filename)),
-                           stdout=output, okstatus=(0,1,2))
+        try:
+            status = int(merge3.merge_files(left, base, right, left_name,
+                                            right_name, output))
+        except merge3.Binary:
+            # diff3 refuses these, leaving nothing in dest
+            status = 2
+        except merge3.Unsupported as e:
+            logger.debug("Merging %s with diff3: %s", filename, e)
+            status = shell.run(("diff3", "-E", "-m",
+                                "-L", left_name, left,
+                                "-L", "BASE", base,
+                                "-L", right_name, right),
+                               stdout=output, okstatus=(0,1,2))
 
     if status != 0:
         if not tree.exists(dest) or os.stat(dest).st_size == 0:
             # Probably binary
-            if same_file(os.stat("%s/%s" % (left_dir, filename)), left_dir,
-                         os.stat("%s/%s" % (right_dir, filename)), right_dir,
+            base_stat = manifest.for_tree(base_dir).lstat(filename)
+            left_stat = manifest.for_tree(left_dir).lstat(filename)
+            right_stat = manifest.for_tree(right_dir).lstat(filename)
+            if same_file(left_stat, left_dir, right_stat, right_dir,
                          filename):
                 logger.debug("binary files are the same: %s", filename)
                 tree.copyfile("%s/%s" % (left_dir, filename),
                               "%s/%s" % (merged_dir, filename))
-            elif same_file(os.stat("%s/%s" % (base_dir, filename)), base_dir,
-                           os.stat("%s/%s" % (left_dir, filename)), left_dir,
+            elif same_file(base_stat, base_dir, left_stat, left_dir,
                            filename):
                 logger.debug("preserving binary change in %s: %s",
                               right_distro, filename)
                 tree.copyfile("%s/%s" % (right_dir, filename),
                               "%s/%s" % (merged_dir, filename))
-            elif same_file(os.stat("%s/%s" % (base_dir, filename)), base_dir,
-                           os.stat("%s/%s" % (right_dir, filename)), right_dir,
+            elif same_file(base_stat, base_dir, right_stat, right_dir,
                            filename):
                 logger.debug("preserving binary change in %s: %s",
                               left_distro, filename)
@@ -653,8 +730,7 @@ def diff3_merge(left_dir, left_name, left_distro, base_dir,
 def merge_attr(base_dir, left_dir, right_dir, merged_dir, filename, result):
     """Set initial and merge changed attributes."""
     if base_dir is not None \
-           and os.path.isfile("%s/%s" % (base_dir, filename)) \
-           and not os.path.islink("%s/%s" % (base_dir, filename)):
+           and manifest.for_tree(base_dir).isfile(filename):
         set_attr(base_dir, merged_dir, filename)
         apply_attr(base_dir, left_dir, merged_dir, filename, result)
         apply_attr(base_dir, right_dir, merged_dir, filename, result)
@@ -664,13 +740,13 @@ def merge_attr(base_dir, left_dir, right_dir, merged_dir, filename, result):
 
 def set_attr(src_dir, dest_dir, filename):
     """Set the initial attributes."""
-    mode = os.stat("%s/%s" % (src_dir, filename)).st_mode & 0777
+    mode = manifest.for_tree(src_dir).lstat(filename).st_mode & 0777
     os.chmod("%s/%s" % (dest_dir, filename), mode)
 
 def apply_attr(base_dir, src_dir, dest_dir, filename, result):
     """Apply attribute changes from one side to a file."""
-    src_stat = os.stat("%s/%s" % (src_dir, filename))
-    base_stat = os.stat("%s/%s" % (base_dir, filename))
+    src_stat = manifest.for_tree(src_dir).lstat(filename)
+    base_stat = manifest.for_tree(base_dir).lstat(filename)
     changed = False
 
     for shift in range(0, 9):
@@ -776,10 +852,14 @@ def copy_in(output_dir, pkgver):
           logger.exception("File not found: %s", src)
 
     patch = patch_file(pkg.distro, pkgver)
-    if os.path.isfile(patch):
+    if compress.exists(patch):
         output = "%s/%s" % (output_dir, os.path.basename(patch))
         if not os.path.exists(output):
-            os.link(patch, output)
+            compress.copy(patch, output)
+        for sidecar in (diffstat_file, stats_file):
+            if os.path.exists(sidecar(patch)) \
+                    and not os.path.exists(sidecar(output)):
+                os.link(sidecar(patch), sidecar(output))
         return os.path.basename(patch)
     else:
         return None
@@ -791,8 +871,9 @@ def create_tarball(package, version, output_dir, merged_dir):
                                         version.without_epoch)
     contained = "%s-%s" % (package, version.without_epoch)
 
-    tree.ensure("%s/tmp/" % config.get('ROOT'))
-    parent = tempfile.mkdtemp(dir="%s/tmp/" % config.get('ROOT'))
+    scratch = scratch_space()
+    parent = scratch.mkdtemp(scratch.reserved(merged_dir),
+                             "%s/tmp" % config.get('ROOT'))
     try:
         tree.copytree(merged_dir, "%s/%s" % (parent, contained))
 
@@ -805,15 +886,18 @@ def create_tarball(package, version, output_dir, merged_dir):
         logger.info("Created %s", tree.subdir(config.get('ROOT'), filename))
         return os.path.basename(filename)
     finally:
-        tree.remove(parent)
+        scratch.remove(parent)
 
 def create_source(package, version, since, output_dir, merged_dir):
     """Create a source package without conflicts."""
     contained = "%s-%s" % (package, version.upstream)
     dsc_filename = "%s_%s.dsc" % (package, version.without_epoch)
 
-    tree.ensure("%s/tmp/" % config.get('ROOT'))
-    parent = tempfile.mkdtemp(dir="%s/tmp/" % config.get('ROOT'))
+    # the copy, and the tarball dpkg-source builds from it
+    scratch = scratch_space()
+    size = scratch.reserved(merged_dir)
+    parent = scratch.mkdtemp(size * 2 if size is not None else None,
+                             "%s/tmp" % config.get('ROOT'))
     try:
         tree.copytree(merged_dir, "%s/%s" % (parent, contained))
 
@@ -867,25 +951,36 @@ def create_source(package, version, since, output_dir, merged_dir):
                     "unable to build merged source package (%s)" % message,
                 create_tarball(package, version, output_dir, merged_dir))
     finally:
-        tree.remove(parent)
+        scratch.remove(parent)
 
 def create_patch(version, filename, merged_dir, basis, basis_dir):
     """Create the merged patch."""
 
-    parent = tempfile.mkdtemp()
+    scratch = scratch_space()
+    parent = scratch.mkdtemp(0, "%s/tmp" % config.get('ROOT'))
     try:
-        tree.copytree(merged_dir, "%s/%s" % (parent, version))
-        tree.copytree(basis_dir, "%s/%s" % (parent, basis.version))
-
-        with open(filename, "w") as diff:
-            shell.run(("diff", "-pruN",
-                       str(basis.version), str(version)),
-                      chdir=parent, stdout=diff, okstatus=(0, 1, 2))
+        # diff follows the links it is given, so the trees need not be
+        # copied to give them these names
+        os.symlink(os.path.abspath(merged_dir), "%s/%s" % (parent, version))
+        os.symlink(os.path.abspath(basis_dir),
+                   "%s/%s" % (parent, basis.version))
+
+        with open(filename, "w") as out:
+            diff = diff_sink(out)
+            p = shell.open(("diff", "-pruN",
+                            str(basis.version), str(version)),
+                           chdir=parent, okstatus=(0, 1, 2))
+            try:
+                shutil.copyfileobj(p, diff, 1024 * 1024)
+            finally:
+                p.close()
+            diff.close()
             logger.info("Created %s", tree.subdir(config.get('ROOT'), filename))
+        save_diffstat(filename, diff)
 
         return os.path.basename(filename)
     finally:
-        tree.remove(parent)
+        scratch.remove(parent)
 
 def read_package_list(filename):
     """Read a list of packages from the given file."""
@@ -930,11 +1025,18 @@ def save_changelog(output_dir, cl_versions, pv, bases, limit=None):
   return name
 
 def produce_merge(target, base, left, upstream, output_dir):
-
-  left_dir = unpack_source(left)
-  upstream_dir = unpack_source(upstream)
-  base_dir = unpack_source(base)
-
+  left_dir, upstream_dir, base_dir = unpack_sources((left, upstream, base))
+  try:
+    return merge_unpacked(target, base, left, upstream, output_dir,
+                          left_dir, upstream_dir, base_dir)
+  finally:
+    # however the merge ends, so that the unpack cache can evict them
+    cleanup_source(upstream)
+    cleanup_source(base)
+    cleanup_source(left)
+
+def merge_unpacked(target, base, left, upstream, output_dir,
+                   left_dir, upstream_dir, base_dir):
   report = MergeReport(left=left, right=upstream)
   report.target = target.name
   report.mom_version = str(VERSION)
@@ -961,10 +1063,9 @@ def produce_merge(target, base, left, upstream, output_dir):
   report.set_base(base)
   logger.info('base version: %s', base.version)
 
-  generate_patch(base, left.package.distro, left, slipped=False, force=False,
-          unpacked=True)
+  generate_patch(base, left.package.distro, left, slipped=False, force=False)
   generate_patch(base, upstream.package.distro, upstream, slipped=False,
-          force=False, unpacked=True)
+          force=False)
 
   report.merged_version = Version(str(upstream.version)+config.get('LOCAL_SUFFIX')+'1')
 
@@ -1004,19 +1105,38 @@ def produce_merge(target, base, left, upstream, output_dir):
         merged_dir=None)
     return report
 
-  merged_dir = work_dir(left.package.name, report.merged_version)
+  def merge_into(merged_dir):
+    return do_merge(left_dir, left.package.name,
+                    left.getDscContents()['Format'],
+                    left.package.distro.name,
+                    base_dir,
+                    upstream_dir, upstream.package.name,
+                    upstream.getDscContents()['Format'],
+                    upstream.package.distro.name,
+                    merged_dir)
+
+  # Each file of the merge comes from one side, or is made from both, as
+  # are conflicts, so the merge holds little more than the two sides
+  # together; but files take up whole blocks, so a merge that still runs
+  # out of scratch space is done again on disk.
+  scratch = scratch_space()
+  merged_dir = scratch.place(
+      work_dir(left.package.name, report.merged_version),
+      manifest.for_tree(left_dir).size()
+      + manifest.for_tree(upstream_dir).size())
 
   logger.info("Merging %s..%s onto %s", upstream, base, left)
 
   try:
-    merge_data = do_merge(left_dir, left.package.name,
-                          left.getDscContents()['Format'],
-                          left.package.distro.name,
-                          base_dir,
-                          upstream_dir, upstream.package.name,
-                          upstream.getDscContents()['Format'],
-                          upstream.package.distro.name,
-                          merged_dir)
+    try:
+      merge_data = merge_into(merged_dir)
+    except EnvironmentError as e:
+      if e.errno != errno.ENOSPC or scratch.reserved(merged_dir) is None:
+        raise
+      logger.info("Out of scratch space merging %s, merging on disk "
+                  "instead", left)
+      merged_dir = scratch.place(merged_dir, None)
+      merge_data = merge_into(merged_dir)
   except OSError as e:
     cleanup(merged_dir)
     logger.exception("Could not merge %s, probably bad files?", left)
@@ -1053,9 +1173,6 @@ def produce_merge(target, base, left, upstream, output_dir):
                    merged_dir=None)
 
       cleanup(merged_dir)
-      cleanup_source(upstream)
-      cleanup_source(base)
-      cleanup_source(left)
 
       return report
 
@@ -1068,6 +1185,7 @@ def produce_merge(target, base, left, upstream, output_dir):
       report.result = MergeResult.FAILED
       report.message = 'Could not update changelog: %s' % e
       report.write_report(output_dir)
+      cleanup(merged_dir)
       return report
 
   if not os.path.isdir(output_dir):
@@ -1121,9 +1239,6 @@ def produce_merge(target, base, left, upstream, output_dir):
                merged_dir=merged_dir)
   logger.info("Wrote output to %s", src_file)
   cleanup(merged_dir)
-  cleanup_source(upstream)
-  cleanup_source(base)
-  cleanup_source(left)
   return report
 
 if __name__ == "__main__":
@@ -21,7 +21,7 @@ import os
 import logging
 
 from momlib import *
-from util import tree, run
+from util import compress, tree, run
 from model import Distro
 
 logger = logging.getLogger('publish_patches')
@@ -61,9 +61,9 @@ def main(options, args):
                 slip_filename = patch_file(our_distro, pv, True)
                 filename = patch_file(our_distro, pv, False)
 
-                if os.path.isfile(slip_filename):
+                if compress.exists(slip_filename):
                     publish_patch(our_distro, pv, slip_filename, list_file)
-                elif os.path.isfile(filename):
+                elif compress.exists(filename):
                     publish_patch(our_distro, pv, filename, list_file)
                 else:
                     unpublish_patch(our_distro, pv)
@@ -81,7 +81,7 @@ def publish_patch(distro, pv, filename, list_file):
     tree.ensure(publish_filename)
     if os.path.isfile(publish_filename):
         os.unlink(publish_filename)
-    os.link(filename, publish_filename)
+    compress.copy(filename, publish_filename)
 
     logger.info("Published %s", tree.subdir(config.get('ROOT'),
                                             publish_filename))
@@ -62,8 +62,10 @@ def main(options, args):
       stats["needs-merge"] = 0
       stats["repackaged"] = 0
       stats["modified"] = 0
-      for pkg in target.distro.packages(target.dist, target.component):
-        update_info = UpdateInfo(pkg)
+      packages = target.distro.packages(target.dist, target.component)
+      update_infos = UpdateInfo.forPackages(packages)
+      for pkg in packages:
+        update_info = update_infos[pkg.name]
         upstream = update_info.upstream_version
         base = update_info.base_version
 
@@ -0,0 +1,259 @@
+import hashlib
+import os
+import shutil
+import subprocess
+import tarfile
+import unittest
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+from deb.archive import Unsupported, diff_debian, diff_sources, read_tree, \
+  upstream_summary
+from util import diff
+
+def have(program):
+  return any(os.access(os.path.join(d, program), os.X_OK)
+             for d in os.environ.get('PATH', '').split(os.pathsep))
+
+def tarball(path, members):
+  """Write a .tar.gz holding members, (name, contents) for a file,
+  (name, None) for a directory or (name, '->target') for a symlink.
+  """
+  with tarfile.open(path, 'w:gz') as tar:
+    for name, contents in members:
+      info = tarfile.TarInfo(name)
+      info.mtime = 1500000000 + len(name)
+      if contents is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0755
+        tar.addfile(info)
+      elif contents.startswith('->'):
+        info.type = tarfile.SYMTYPE
+        info.linkname = contents[2:]
+        tar.addfile(info)
+      else:
+        info.size = len(contents)
+        info.mode = 0644
+        tar.addfile(info, StringIO(contents))
+
+def write_dsc(directory, package, version, fmt, files):
+  lines = {'md5': [], 'sha256': []}
+  for name in files:
+    with open(os.path.join(directory, name)) as f:
+      data = f.read()
+    lines['md5'].append(' %s %d %s' % (hashlib.md5(data).hexdigest(),
+                                       len(data), name))
+    lines['sha256'].append(' %s %d %s' % (hashlib.sha256(data).hexdigest(),
+                                          len(data), name))
+  path = os.path.join(directory, '%s_%s.dsc' % (package, version))
+  with open(path, 'w') as f:
+    f.write('Format: %s\nSource: %s\nVersion: %s\n' % (fmt, package, version))
+    f.write('Checksums-Sha256:\n%s\n' % '\n'.join(lines['sha256']))
+    f.write('Files:\n%s\n' % '\n'.join(lines['md5']))
+  return path
+
+ORIG = [
+  ('hello-1.0/', None),
+  ('hello-1.0/README', 'Hello\n'),
+  ('hello-1.0/src/', None),
+  ('hello-1.0/src/main.c', ''.join('line %d\n' % i for i in range(40))),
+  ('hello-1.0/src/data.bin', 'a\0b'),
+  ('hello-1.0/.pc/', None),
+  ('hello-1.0/.pc/applied-patches', 'x\n'),
+  ('hello-1.0/link', '->README'),
+]
+
+class DiffSourcesTest(unittest.TestCase):
+  def setUp(self):
+    if not have('dpkg-source') or not have('diff'):
+      self.skipTest('dpkg-source and diff are needed')
+    self.dir = mkdtemp(prefix='momtest.archive.')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def quilt(self, version, debian, upstream='1.0', members=ORIG):
+    orig = 'hello_%s.orig.tar.gz' % upstream
+    if not os.path.exists(os.path.join(self.dir, orig)):
+      tarball(os.path.join(self.dir, orig), members)
+    name = 'hello_%s.debian.tar.gz' % version
+    tarball(os.path.join(self.dir, name), debian)
+    return write_dsc(self.dir, 'hello', version, '3.0 (quilt)', [orig, name])
+
+  def native(self, version, members):
+    name = 'hello_%s.tar.gz' % version
+    tarball(os.path.join(self.dir, name), members)
+    return write_dsc(self.dir, 'hello', version, '3.0 (native)', [name])
+
+  def unpacked_diff(self, dsc_a, dsc_b, subdir=''):
+    """Return what diff prints for subdir of the unpacked sources."""
+    labels = []
+    for dsc in (dsc_a, dsc_b):
+      label = os.path.basename(dsc)[:-4]
+      with open('/dev/null', 'w') as devnull:
+        subprocess.check_call(['dpkg-source', '--skip-patches', '-x',
+                               os.path.basename(dsc), label], cwd=self.dir,
+                              stdout=devnull, stderr=devnull)
+      labels.append(label)
+    env = dict(os.environ, LC_ALL='C')
+    p = subprocess.Popen(['diff', '-pruN'] + [l + subdir for l in labels],
+                         cwd=self.dir, env=env, stdout=subprocess.PIPE)
+    return labels, p.communicate()[0]
+
+  def check(self, dsc_a, dsc_b):
+    labels, expected = self.unpacked_diff(dsc_a, dsc_b)
+    out = StringIO()
+    diff_sources(dsc_a, dsc_b, labels[0], labels[1], out,
+                 blksize=os.statvfs(self.dir).f_bsize)
+    self.assertEqual(out.getvalue(), expected)
+    return expected
+
+  def test_quilt(self):
+    a = self.quilt('1.0-1', [
+      ('debian/', None),
+      ('debian/control', 'Source: hello\n'),
+      ('debian/rules', 'old\nrules\n'),
+      ('debian/source/', None),
+      ('debian/source/format', '3.0 (quilt)\n'),
+    ])
+    b = self.quilt('1.0-2', [
+      ('debian/', None),
+      ('debian/control', 'Source: hello\n'),
+      ('debian/rules', 'new\nrules'),
+      ('debian/source/', None),
+      ('debian/source/format', '3.0 (quilt)\n'),
+      ('debian/patches/', None),
+      ('debian/patches/series', 'fix.patch\n'),
+      ('debian/data.bin', '\0'),
+      ('debian/link', '->control'),
+    ])
+    expected = self.check(a, b)
+    self.assertIn('+new\n', expected)
+    self.assertIn('Binary files', expected)
+
+  def test_native(self):
+    a = self.native('1.0', [
+      ('hello/', None),
+      ('hello/main.c', ''.join('line %d\n' % i for i in range(40))),
+      ('hello/gone', 'bye\n'),
+      ('hello/debian/source/format', '3.0 (native)\n'),
+    ])
+    b = self.native('1.1', [
+      ('hello/', None),
+      ('hello/main.c', ''.join('line %d\n' % (i * (i != 20))
+                               for i in range(40))),
+      ('hello/with space', 'new\n'),
+      ('hello/debian/source/format', '3.0 (native)\n'),
+    ])
+    self.check(a, b)
+
+  def test_debian_only(self):
+    debian = [
+      ('debian/', None),
+      ('debian/rules', 'old\nrules\n'),
+      ('debian/source/', None),
+      ('debian/source/format', '3.0 (quilt)\n'),
+    ]
+    a = self.quilt('1.0-1', debian)
+    b = self.quilt('1.1-1', debian[:1] + [('debian/rules', 'new\nrules\n')]
+                   + debian[2:], upstream='1.1',
+                   members=ORIG + [('hello-1.0/NEWS', 'News\n')])
+    c = self.quilt('1.1-2', debian, upstream='1.1')
+    labels, expected = self.unpacked_diff(b, c, '/debian')
+    self.assertIn('+old\n', expected)
+    out = StringIO()
+    diff_debian(b, c, labels[0], labels[1], out,
+                blksize=os.statvfs(self.dir).f_bsize)
+    self.assertEqual(out.getvalue(), expected)
+    self.assertEqual(upstream_summary(b, c, 'b', 'c'), '')
+
+    summary = upstream_summary(a, b, 'a', 'b')
+    self.assertIn(' a: hello_1.0.orig.tar.gz (%d bytes, 4 files)\n'
+                  % os.path.getsize(os.path.join(self.dir,
+                                                 'hello_1.0.orig.tar.gz')),
+                  summary)
+    self.assertIn('hello_1.1.orig.tar.gz', summary)
+    self.assertIn('5 files', summary)
+
+    native = self.native('1.0', [('hello/debian/source/format',
+                                  '3.0 (native)\n')])
+    self.assertRaises(Unsupported, upstream_summary, a, native, 'a', 'n')
+
+  def test_unsupported(self):
+    fmt = ('hello/debian/source/format', '3.0 (native)\n')
+    a = self.native('1.0', [('hello/x', '->/etc/passwd'), fmt])
+    b = self.native('1.1', [('hello/x', 'x\n'), fmt])
+    with self.assertRaises(Unsupported):
+      diff_sources(a, b, 'a', 'b', StringIO())
+
+class ReadTreeTest(unittest.TestCase):
+  def setUp(self):
+    if not have('dpkg-source'):
+      self.skipTest('dpkg-source is needed')
+    self.dir = mkdtemp(prefix='momtest.archive.')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def build(self, fmt, files):
+    """Build a source package from an orig tarball and the files under
+    debian/, returning the .dsc.
+    """
+    srcdir = os.path.join(self.dir, 'hello-1.0')
+    tarball(os.path.join(self.dir, 'hello_1.0.orig.tar.gz'), ORIG)
+    subprocess.check_call(['tar', 'xzf', 'hello_1.0.orig.tar.gz'],
+                          cwd=self.dir)
+    files = dict(files)
+    files['source/format'] = fmt + '\n'
+    files['changelog'] = ('hello (1.0-1) unstable; urgency=low\n\n'
+                          '  * Initial.\n\n'
+                          ' -- Bob <bob@example.com>  '
+                          'Sun, 01 Jan 2023 10:00:00 +0000\n')
+    files['control'] = ('Source: hello\nMaintainer: Bob <bob@example.com>\n'
+                        '\nPackage: hello\nArchitecture: all\n')
+    for name, contents in files.items():
+      path = os.path.join(srcdir, 'debian', name)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as f:
+        f.write(contents)
+    with open('/dev/null', 'w') as devnull:
+      subprocess.check_call(['dpkg-source', '--no-preparation', '-b',
+                             'hello-1.0'], cwd=self.dir,
+                            stdout=devnull, stderr=devnull)
+    shutil.rmtree(srcdir)
+    return os.path.join(self.dir, 'hello_1.0-1.dsc')
+
+  def test_patches(self):
+    patches = {
+      'patches/series': 'fix.patch\n',
+      'patches/fix.patch': '--- a/README\n+++ b/README\n',
+      'patches/more/other.patch': 'no newline',
+      'rules': 'rules\n',
+    }
+    for fmt in ('3.0 (quilt)', '1.0'):
+      dsc = self.build(fmt, patches)
+      self.assertEqual(read_tree(dsc, 'debian/patches'), {
+        'series': 'fix.patch\n',
+        'fix.patch': '--- a/README\n+++ b/README\n',
+        'more/other.patch': 'no newline',
+      })
+      self.assertEqual(read_tree(dsc, 'debian/missing'), {})
+
+  def test_unsupported(self):
+    dsc = self.build('1.0', {'rules': 'rules\n'})
+    self.assertRaises(Unsupported, read_tree, dsc, 'src')
+
+class UnifiedHunksTest(unittest.TestCase):
+  def test_function(self):
+    a = 'int main()\n{\n' + ''.join('  %d;\n' % i for i in range(10)) + '}'
+    b = a.replace('  5;', '  five;') + '\n'
+    self.assertEqual(diff.unified_hunks(a, b),
+                     '@@ -5,9 +5,9 @@ int main()\n'
+                     '   2;\n   3;\n   4;\n-  5;\n+  five;\n'
+                     '   6;\n   7;\n   8;\n   9;\n'
+                     '-}\n\\ No newline at end of file\n+}\n')
+
+  def test_quote_name(self):
+    self.assertEqual(diff.quote_name('a/b'), 'a/b')
+    self.assertEqual(diff.quote_name('a b\t\x80'), '"a b\\t\\200"')
@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from model.baseinfo import BaseInfoStore
+
+class BaseInfoStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.root = mkdtemp(prefix='momtest.baseinfo.')
+    self.path = os.path.join(self.root, 'baseinfo.db')
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def test_putGet(self):
+    store = BaseInfoStore(self.path)
+    with store.batch():
+      store.put('debian', 'foo', {'version': '1.0'})
+      store.put('debian', 'bar', {'version': '2.0'})
+      store.put('ubuntu', 'foo', {'version': '1.0ubuntu1'})
+    self.assertEqual(store.get('debian', 'foo'), {'version': '1.0'})
+    self.assertEqual(store.get('debian', 'baz'), None)
+    self.assertEqual(sorted(store.getAll('debian').keys()), ['bar', 'foo'])
+
+    # another connection sees the committed batch
+    other = BaseInfoStore(self.path)
+    self.assertEqual(other.get('ubuntu', 'foo'), {'version': '1.0ubuntu1'})
+
+  # Records kept as one file per package by earlier versions are imported
+  # the first time the database is opened
+  def test_migrate(self):
+    legacy = os.path.join(self.root, 'baseinfo')
+    os.makedirs(os.path.join(legacy, 'debian'))
+    with open(os.path.join(legacy, 'debian', 'foo'), 'w') as f:
+      json.dump({'version': '1.0', 'base_version': '0.9'}, f)
+
+    store = BaseInfoStore(self.path, legacy_dir=legacy)
+    self.assertEqual(store.get('debian', 'foo'),
+                     {'version': '1.0', 'base_version': '0.9'})
+
+    # and only then, so that later changes to the files are ignored
+    with open(os.path.join(legacy, 'debian', 'bar'), 'w') as f:
+      json.dump({'version': '2.0'}, f)
+    store = BaseInfoStore(self.path, legacy_dir=legacy)
+    self.assertEqual(store.get('debian', 'bar'), None)
+
+  # Base versions are remembered per (package, version, upstream), and so
+  # is finding none
+  def test_resolution(self):
+    store = BaseInfoStore(self.path)
+    self.assertEqual(store.getResolution('foo', '1.0-1ubuntu1', '1.0-2'),
+                     (False, None))
+    store.putResolution('foo', '1.0-1ubuntu1', '1.0-2', '1.0-1')
+    store.putResolution('foo', '1.0-1ubuntu1', None, None)
+    other = BaseInfoStore(self.path)
+    self.assertEqual(other.getResolution('foo', '1.0-1ubuntu1', '1.0-2'),
+                     (True, '1.0-1'))
+    self.assertEqual(other.getResolution('foo', '1.0-1ubuntu1', None),
+                     (True, None))
+    self.assertEqual(other.getResolution('foo', '1.0-1ubuntu2', '1.0-2'),
+                     (False, None))
@@ -0,0 +1,116 @@
+import os
+import shutil
+import subprocess
+import unittest
+from tempfile import mkdtemp
+
+from deb.archive import Unsupported
+from deb.changes import parse_changelog, source_changes
+
+def have(program):
+  return any(os.access(os.path.join(d, program), os.X_OK)
+             for d in os.environ.get('PATH', '').split(os.pathsep))
+
+CONTROL = """Source: hello
+Section: devel
+Priority: optional
+Maintainer: Jane Doe <jane@example.com>
+XSBC-Original-Maintainer: John Doe <john@example.com>
+Build-Depends: debhelper-compat (= 13)
+
+Package: hello
+Architecture: any
+Description: say hello
+ Says hello.
+"""
+
+def entry(version, text, urgency='low', who='Bob Smith <bob@example.com>',
+          day=1):
+  return ('hello (%s) unstable; urgency=%s\n\n%s\n\n'
+          ' -- %s  Sun, %02d Jan 2023 10:00:00 +0000\n\n'
+          % (version, urgency, text, who, day))
+
+CHANGELOG = (
+  entry('1.1-2', '  * Fix it. Closes: #12, #3\n  * LP: #999', day=5) +
+  entry('1.1-1', '  * New upstream.\n\n    More text.\n  ..',
+        urgency='high', day=4) +
+  entry('1.0-2', '  * Second.  closes: bug#7', urgency='medium', day=3) +
+  entry('1.0-1', '  * Initial.', who='Jane Doe <jane@example.com>', day=2) +
+  'Old Changelog:\n  anything goes here\n')
+
+class SourceChangesTest(unittest.TestCase):
+  def setUp(self):
+    if not have('dpkg-source') or not have('dpkg-genchanges'):
+      self.skipTest('dpkg-source and dpkg-genchanges are needed')
+    self.dir = mkdtemp(prefix='momtest.changes.')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def build(self, version, fmt, changelog=CHANGELOG):
+    """Build a source package, returning the .dsc and the tree."""
+    upstream = version.split('-')[0]
+    srcdir = os.path.join(self.dir, 'hello-%s' % upstream)
+    shutil.rmtree(srcdir, True)
+    os.makedirs(os.path.join(srcdir, 'debian', 'source'))
+    with open(os.path.join(srcdir, 'README'), 'w') as f:
+      f.write('hello\n')
+    orig = os.path.join(self.dir, 'hello_%s.orig.tar.gz' % upstream)
+    if fmt != '3.0 (native)' and not os.path.exists(orig):
+      subprocess.check_call(['tar', 'czf', orig, '--exclude', 'debian',
+                             os.path.basename(srcdir)], cwd=self.dir)
+    for name, text in (('control', CONTROL), ('changelog', changelog),
+                       ('source/format', fmt + '\n')):
+      with open(os.path.join(srcdir, 'debian', name), 'w') as f:
+        f.write(text)
+    with open('/dev/null', 'w') as devnull:
+      subprocess.check_call(['dpkg-source', '-b', os.path.basename(srcdir)],
+                            cwd=self.dir, stdout=devnull, stderr=devnull)
+    return os.path.join(self.dir, 'hello_%s.dsc' % version), srcdir
+
+  def check(self, dsc, srcdir, since):
+    args = ['dpkg-genchanges', '-S', '-u..']
+    if since is not None:
+      args.append('-v%s' % since)
+    with open('/dev/null', 'w') as devnull:
+      p = subprocess.Popen(args, cwd=srcdir, stdout=subprocess.PIPE,
+                           stderr=devnull)
+    expected = p.communicate()[0]
+    self.assertEqual(p.returncode, 0)
+    self.assertEqual(source_changes(dsc, since), expected)
+
+  def test_quilt(self):
+    dsc, srcdir = self.build('1.1-2', '3.0 (quilt)')
+    for since in (None, '1.1-1', '1.0-2', '1.0-1', '1.0-1.5', '0.1'):
+      self.check(dsc, srcdir, since)
+
+  def test_new_upstream(self):
+    dsc, srcdir = self.build('1.1-1', '3.0 (quilt)',
+                             CHANGELOG[CHANGELOG.index('hello (1.1-1)'):])
+    self.check(dsc, srcdir, '1.0-2')
+
+  def test_native(self):
+    changelog = CHANGELOG.replace('-1)', ')').replace('-2)', '.1)')
+    dsc, srcdir = self.build('1.1.1', '3.0 (native)', changelog)
+    self.check(dsc, srcdir, '1.0.1')
+
+  def test_diff(self):
+    dsc, srcdir = self.build('1.1-2', '1.0')
+    self.check(dsc, srcdir, '1.0-2')
+
+  def test_bad_changelog(self):
+    changelog = CHANGELOG.replace('  * Fix it.', ' * Fix it.')
+    dsc, srcdir = self.build('1.1-2', '3.0 (quilt)', changelog)
+    with self.assertRaises(Unsupported):
+      source_changes(dsc, '1.1-1')
+
+class ParseChangelogTest(unittest.TestCase):
+  # Parsing stops once there are enough entries, so that anything after
+  # them doesn't matter
+  def test_enough(self):
+    changelog = CHANGELOG.replace('  * Initial.', 'rubbish')
+    self.assertRaises(Unsupported, parse_changelog, changelog)
+    entries = parse_changelog(changelog, lambda entries: len(entries) == 2)
+    self.assertEqual([e.version for e in entries], ['1.1-2', '1.1-1'])
+    self.assertEqual(entries[1].urgency, 'high')
+    self.assertEqual(entries[0].closes(), ['3', '12'])
@@ -0,0 +1,44 @@
+import bz2
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from util import compress
+
+class CompressTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = mkdtemp(prefix='momtest.compress.')
+    self.filename = os.path.join(self.dir, 'hello_1.0-1.patch')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_methods(self):
+    text = ''.join('line %d\n' % i for i in range(10000))
+    for method, ext in compress.METHODS.items():
+      with compress.open_write(self.filename, method) as f:
+        f.write(text[:100])
+        f.write(text[100:])
+      # writing one variant replaces any other
+      self.assertEqual(os.listdir(self.dir),
+                       [os.path.basename(self.filename) + ext])
+      self.assertTrue(compress.exists(self.filename))
+      self.assertEqual(compress.read(self.filename), text)
+
+  # Files compressed by pack-archive.sh are read all the same
+  def test_bzip2(self):
+    with open(self.filename + '.bz2', 'w') as f:
+      f.write(bz2.compress('hello\n'))
+    copy = os.path.join(self.dir, 'copy')
+    compress.copy(self.filename, copy)
+    self.assertEqual(open(copy).read(), 'hello\n')
+
+  def test_failure(self):
+    with self.assertRaises(RuntimeError):
+      with compress.open_write(self.filename, 'gzip') as f:
+        f.write('partial')
+        raise RuntimeError()
+    self.assertEqual(os.listdir(self.dir), [])
+    self.assertFalse(compress.exists(self.filename))
+    self.assertRaises(IOError, compress.read, self.filename)
@@ -0,0 +1,90 @@
+import imp
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+import config
+from model.delta import Delta, compare
+
+class CompareTest(unittest.TestCase):
+  def test_compare(self):
+    old = {'foo': ['1.0'], 'bar': ['1.0', '1.1'], 'gone': ['0.1']}
+    new = {'foo': ['1.0'], 'bar': ['1.1'], 'baz': ['2.0']}
+    self.assertEqual(compare(old, new), {
+        'new': {'baz': ['2.0']},
+        'removed': {'gone': ['0.1']},
+        'changed': {'bar': [['1.0', '1.1'], ['1.1']]},
+    })
+
+  # Without a snapshot, everything is new
+  def test_firstRun(self):
+    self.assertEqual(compare({}, {'foo': ['1.0']})['new'], {'foo': ['1.0']})
+
+class FakeDistro(object):
+  def __init__(self, root, name, sources):
+    self.root = root
+    self.name = name
+    self.sources = sources
+
+  def getSources(self, dist, component):
+    return [{'Package': name, 'Version': version}
+            for name, version in self.sources]
+
+  def getDistDir(self, dist):
+    return os.path.join(self.root, 'dists', self.name, dist)
+
+class FakeTarget(object):
+  def __init__(self, name, distro):
+    self.name = name
+    self.distro = distro
+    self.dist = 'sid'
+    self.component = 'main'
+
+  def config(self, *args, **kwargs):
+    return config.get('DISTRO_TARGETS', self.name, *args, **kwargs)
+
+  def getAllSourceLists(self):
+    return []
+
+  def __str__(self):
+    return self.name
+
+class ComputeTest(unittest.TestCase):
+  def setUp(self):
+    self.root = mkdtemp(prefix='momtest.delta.')
+    self.configdb = config.configdb
+    config.loadConfig(imp.new_module('testconfig'))
+    config.configdb.ROOT = self.root
+    config.configdb.DISTRO_TARGETS = {
+        'one': {'distro': 'ours', 'dist': 'sid', 'component': 'main'},
+        'two': {'distro': 'ours', 'dist': 'sid', 'component': 'main'},
+    }
+    distro = FakeDistro(self.root, 'ours', [('foo', '1.0'), ('bar', '1.0')])
+    self.one = FakeTarget('one', distro)
+    self.two = FakeTarget('two', distro)
+
+  def tearDown(self):
+    config.loadConfig(self.configdb)
+    shutil.rmtree(self.root)
+
+  # A target added after its Sources were snapshotted, or whose package
+  # lists changed since, has all of its packages affected
+  def test_newTarget(self):
+    delta = Delta.compute([self.one])
+    self.assertEqual(delta.affected, {'one': set(['foo', 'bar'])})
+    delta.save()
+    Delta.load().commit([self.one])
+
+    delta = Delta.compute([self.one, self.two])
+    self.assertEqual(delta.affected, {'one': set(),
+                                      'two': set(['foo', 'bar'])})
+    delta.save()
+    Delta.load().commit([self.one, self.two])
+    self.assertEqual(Delta.compute([self.one, self.two]).affected,
+                     {'one': set(), 'two': set()})
+
+    with open(os.path.join(self.root, 'two.ignore.txt'), 'w') as f:
+      f.write('bar\n')
+    self.assertEqual(Delta.compute([self.one, self.two]).affected,
+                     {'one': set(), 'two': set(['foo', 'bar'])})
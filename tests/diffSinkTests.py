@@ -0,0 +1,79 @@
+import unittest
+from StringIO import StringIO
+
+from util.diffsink import DiffSink
+
+FIRST = '''diff -pruN a/README b/README
+--- a/README\t2017-07-14 02:40:00.000000000 +0000
++++ b/README\t2017-07-14 02:40:00.000000000 +0000
+@@ -1,2 +1,2 @@
+ Hello
+--- old
++++ new
+'''
+SECOND = '''@@ -10 +10,2 @@ main
+-x
++y
++z
+\\ No newline at end of file
+'''
+BINARY = 'Binary files a/data and b/x and b/data and b/x differ\n'
+THIRD = '''diff -pruN a/src/main.c b/src/main.c
+--- a/src/main.c\t2017-07-14 02:40:00.000000000 +0000
++++ b/src/main.c\t2017-07-14 02:40:00.000000000 +0000
+@@ -1 +1 @@
+-int main;
++int main();
+'''
+DIFF = 'Upstream sources differ\n' + FIRST + SECOND + BINARY + THIRD
+
+class DiffSinkTest(unittest.TestCase):
+  def sink(self, max_bytes=None, max_hunks=None, chunk=7):
+    out = StringIO()
+    sink = DiffSink(out, max_bytes, max_hunks)
+    for i in range(0, len(DIFF), chunk):
+      sink.write(DIFF[i:i + chunk])
+    sink.close()
+    return sink, out.getvalue()
+
+  def test_unlimited(self):
+    sink, out = self.sink()
+    self.assertEqual(out, DIFF)
+    self.assertFalse(sink.truncated)
+    self.assertEqual(sink.hunks, 3)
+    self.assertEqual([(s.name, s.insertions, s.deletions, s.binary)
+                      for s in sink.files],
+                     [('README', 3, 2, False),
+                      ('data and b/x', 0, 0, True),
+                      ('src/main.c', 1, 1, False)])
+    self.assertEqual(sink.stats(), {'files': 3, 'insertions': 4,
+                                    'deletions': 3, 'binary': 1,
+                                    'truncated': False})
+
+  def test_bytes(self):
+    # the second hunk doesn't fit, so nothing after it is written
+    limit = len('Upstream sources differ\n' + FIRST + SECOND) - 1
+    sink, out = self.sink(max_bytes=limit)
+    self.assertTrue(sink.truncated)
+    self.assertEqual(sink.hunks, 1)
+    self.assertTrue(out.startswith('Upstream sources differ\n' + FIRST
+                                   + 'Diff truncated after %d bytes and 1 '
+                                   'hunks; changes to 3 files are left out:\n'
+                                   % (limit - len(SECOND) + 1)))
+    self.assertIn(' README       | 5 +3 -2\n', out)
+    self.assertIn(' data and b/x | Bin\n', out)
+    self.assertTrue(out.endswith(' 3 files changed, 4 insertions(+), '
+                                 '3 deletions(-)\n'))
+    # the totals count what was left out too
+    self.assertEqual(sink.stats()['insertions'], 4)
+    self.assertTrue(sink.stats()['truncated'])
+
+  def test_hunks(self):
+    sink, out = self.sink(max_hunks=2, chunk=1)
+    self.assertTrue(sink.truncated)
+    self.assertEqual(sink.hunks, 2)
+    # the header of a file none of whose hunks fit is left out too
+    self.assertTrue(out.startswith('Upstream sources differ\n' + FIRST
+                                   + SECOND + BINARY + 'Diff truncated'))
+    self.assertEqual([s.name for s in sink.files if s.omitted],
+                     ['src/main.c'])
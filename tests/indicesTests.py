@@ -0,0 +1,109 @@
+import gzip
+import hashlib
+import os
+import shutil
+import subprocess
+import unittest
+from tempfile import mkdtemp
+
+from model.indices import IndexFetcher, ReleaseIndex, apply_ed, \
+    sources_path, strip_signature
+from model.mirror import MirrorSet
+
+SOURCES = 'Package: a\nVersion: 1\n\nPackage: b\nVersion: 1\n'
+
+class EdTest(unittest.TestCase):
+  # Compare against what diff itself writes, including the awkward
+  # case of a line consisting of a single dot
+  def test_diffEd(self):
+    tmpdir = mkdtemp(prefix='momtest.ed.')
+    try:
+      old = ['1\n', '2\n', '3\n', '4\n', '5\n']
+      new = ['0\n', '1\n', '3\n', '.\n', 'x\n', '5\n', '6\n']
+      for name, lines in (('old', old), ('new', new)):
+        with open(os.path.join(tmpdir, name), 'w') as f:
+          f.writelines(lines)
+      p = subprocess.Popen(['diff', '--ed', 'old', 'new'], cwd=tmpdir,
+                           stdout=subprocess.PIPE)
+      script = p.communicate()[0]
+      self.assertEqual(apply_ed(old, script.splitlines(True)), new)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_unsupported(self):
+    with self.assertRaises(ValueError):
+      apply_ed(['1\n'], ['1,$s/1/2/\n'])
+
+class ReleaseIndexTest(unittest.TestCase):
+  def test_clearsigned(self):
+    text = ('-----BEGIN PGP SIGNED MESSAGE-----\n'
+            'Hash: SHA256\n'
+            '\n'
+            'Codename: sid\n'
+            'Acquire-By-Hash: yes\n'
+            'SHA256:\n'
+            ' %s 10 main/source/Sources\n'
+            '-----BEGIN PGP SIGNATURE-----\n'
+            'xxxx\n'
+            '-----END PGP SIGNATURE-----\n') % ('0' * 64)
+    release = ReleaseIndex(text)
+    self.assertTrue(release.by_hash)
+    self.assertEqual(release.entry('main/source/Sources'), ('0' * 64, 10))
+    self.assertEqual(release.entry('main/source/Sources.gz'), None)
+    self.assertEqual(strip_signature('Codename: sid\n'), 'Codename: sid\n')
+
+class IndexFetcherTest(unittest.TestCase):
+  def setUp(self):
+    self.archive = mkdtemp(prefix='momtest.archive.')
+    self.output = mkdtemp(prefix='momtest.dists.')
+    self.publish(SOURCES)
+
+  def tearDown(self):
+    shutil.rmtree(self.archive)
+    shutil.rmtree(self.output)
+
+  def publish(self, sources):
+    dist = os.path.join(self.archive, 'dists/sid')
+    source = os.path.join(dist, 'main/source')
+    if not os.path.isdir(source):
+      os.makedirs(source)
+    with gzip.open(os.path.join(source, 'Sources.gz'), 'wb') as f:
+      f.write(sources)
+    entries = []
+    for name, data in (('Sources', sources),
+                       ('Sources.gz',
+                        open(os.path.join(source, 'Sources.gz')).read())):
+      entries.append(' %s %d main/source/%s\n' %
+                     (hashlib.sha256(data).hexdigest(), len(data), name))
+    with open(os.path.join(dist, 'Release'), 'w') as f:
+      f.write('Codename: sid\nSHA256:\n' + ''.join(entries))
+
+  def test_update(self):
+    fetcher = IndexFetcher(MirrorSet(['file://' + self.archive]),
+                           self.output, 'sid', ['main', 'contrib'])
+    fetcher.update()
+    self.assertEqual(open(sources_path(self.output, 'main')).read(), SOURCES)
+    self.assertFalse(os.path.exists(sources_path(self.output, 'contrib')))
+
+    self.publish(SOURCES + '\nPackage: c\nVersion: 1\n')
+    fetcher.update()
+    self.assertTrue('Package: c' in
+                    open(sources_path(self.output, 'main')).read())
+
+  # A mirror whose Sources do not match its Release is avoided, and the
+  # update is done again from the next mirror
+  def test_mismatch(self):
+    broken = mkdtemp(prefix='momtest.archive.')
+    try:
+      shutil.rmtree(broken)
+      shutil.copytree(self.archive, broken)
+      with gzip.open(os.path.join(broken, 'dists/sid/main/source/Sources.gz'),
+                     'wb') as f:
+        f.write('Package: a\nVersion: 2\n')
+      mirrors = MirrorSet(['file://' + broken, 'file://' + self.archive])
+      IndexFetcher(mirrors, self.output, 'sid', ['main']).update()
+    finally:
+      shutil.rmtree(broken)
+    self.assertEqual(open(sources_path(self.output, 'main')).read(), SOURCES)
+    self.assertEqual(mirrors.best(), 'file://' + self.archive)
+    self.assertEqual(mirrors.ordered()[-1].failures, 1)
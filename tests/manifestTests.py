@@ -0,0 +1,81 @@
+import os
+import shutil
+import unittest
+from hashlib import md5
+from tempfile import mkdtemp
+
+from util import manifest, tree
+from util.manifest import Manifest
+
+class ManifestTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = mkdtemp(prefix='momtest.manifest.')
+    self.root = os.path.join(self.dir, 'tree')
+    for name, contents in (('README', 'hello\n'),
+                           ('src/main.c', 'int main;\n'),
+                           ('odd name\n-', ''),
+                           ('debian/rules', '#!/usr/bin/make -f\n')):
+      path = os.path.join(self.root, name)
+      tree.ensure(path)
+      with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(os.path.join(self.root, 'debian/rules'), 0755)
+    os.symlink('src', os.path.join(self.root, 'source'))
+    os.symlink('a target', os.path.join(self.root, 'dangling'))
+    os.symlink('-', os.path.join(self.root, 'dash'))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def check(self, m):
+    self.assertEqual(m.walk(), list(tree.walk(self.root)))
+    for path in m.walk() + ['src', 'debian']:
+      st = os.lstat(os.path.join(self.root, path))
+      entry = m.lstat(path)
+      self.assertEqual((entry.st_mode, entry.st_size),
+                       (st.st_mode, st.st_size))
+    self.assertEqual(m.digest('README'), md5('hello\n').hexdigest())
+    self.assertEqual(m.readlink('dangling'), 'a target')
+    self.assertEqual(m.readlink('dash'), '-')
+    self.assertTrue(m.isfile('odd name\n-'))
+    self.assertFalse(m.isfile('source'))
+    self.assertIsNone(m.lstat('missing'))
+    self.assertFalse(m.exists('README/x'))
+    # paths through symlinks are looked up in the tree
+    self.assertTrue(m.exists('source/main.c'))
+    self.assertFalse(m.exists('source/missing'))
+    self.assertEqual(m.digest('source/main.c'), m.digest('src/main.c'))
+
+  def test_scan(self):
+    self.check(Manifest.scan(self.root))
+
+  def test_saved(self):
+    Manifest.scan(self.root).save(manifest.manifest_file(self.root))
+    os.symlink(self.root, os.path.join(self.dir, 'link'))
+    m = manifest.for_tree(os.path.join(self.dir, 'link'), fresh=True)
+    self.check(m)
+    self.assertEqual(m.size(), Manifest.scan(self.root).size())
+    # the saved manifest is believed over the tree
+    os.unlink(os.path.join(self.root, 'README'))
+    self.assertTrue(manifest.for_tree(self.root).exists('README'))
+
+  def test_join(self):
+    other = os.path.join(self.dir, 'other')
+    for name in ('README', 'src/main.c/x', 'source/main.c', 'src-old'):
+      tree.ensure(os.path.join(other, name))
+      with open(os.path.join(other, name), 'w') as f:
+        f.write('')
+    joined = list(manifest.join((Manifest.scan(self.root),
+                                 Manifest.scan(other))))
+    paths = [path for path, listed, entries in joined]
+    # what is under a directory comes straight after it
+    self.assertEqual(paths, sorted(paths, key=lambda p: p.split('/')))
+    self.assertLess(paths.index('src/main.c/x'), paths.index('src-old'))
+    found = dict((path, (listed, [e is not None for e in entries]))
+                 for path, listed, entries in joined)
+    self.assertEqual(found['README'], ([True, True], [True, True]))
+    self.assertEqual(found['src/main.c/x'], ([False, True], [False, True]))
+    self.assertEqual(found['debian/rules'], ([True, False], [True, False]))
+    # source is a symlink to src in the first tree, so main.c is found
+    # through it
+    self.assertEqual(found['source/main.c'], ([False, True], [True, True]))
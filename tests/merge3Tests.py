@@ -0,0 +1,101 @@
+import os
+import random
+import shutil
+import subprocess
+import unittest
+from tempfile import mkdtemp
+
+from util import merge3
+
+def have(program):
+  return any(os.access(os.path.join(d, program), os.X_OK)
+             for d in os.environ.get('PATH', '').split(os.pathsep))
+
+BASE = ''.join('line %d\n' % i for i in range(10))
+
+class MergeTest(unittest.TestCase):
+  def test_clean(self):
+    mine = BASE.replace('line 2\n', 'line two\n')
+    yours = BASE.replace('line 7\n', 'line seven\n') + 'line 10\n'
+    self.assertEqual(merge3.merge(mine, BASE, yours, 'mine', 'yours'),
+                     (mine.replace('line 7\n', 'line seven\n') + 'line 10\n',
+                      False))
+    # the same change on both sides
+    self.assertEqual(merge3.merge(mine, BASE, mine, 'mine', 'yours'),
+                     (mine, False))
+
+  def test_conflict(self):
+    mine = BASE.replace('line 5\n', 'line five\n')
+    yours = BASE.replace('line 5\n', 'LINE 5\n')
+    self.assertEqual(merge3.merge(mine, BASE, yours, 'mine', 'yours'),
+                     (BASE.replace('line 5\n', '<<<<<<< mine\nline five\n'
+                                   '=======\nLINE 5\n>>>>>>> yours\n'),
+                      True))
+
+  def test_unsupported(self):
+    self.assertRaises(merge3.Binary, merge3.merge,
+                      BASE + '\0', BASE, BASE, 'mine', 'yours')
+    self.assertRaises(merge3.Binary, merge3.merge,
+                      BASE, BASE, BASE.encode('utf-16'), 'mine', 'yours')
+    self.assertRaises(merge3.Unsupported, merge3.merge,
+                      BASE, BASE, BASE + 'no newline', 'mine', 'yours')
+
+class Diff3Test(unittest.TestCase):
+  """Compare merges of random changes with those diff3 makes."""
+
+  def setUp(self):
+    if not have('diff3'):
+      self.skipTest('diff3 is needed')
+    self.dir = mkdtemp(prefix='momtest.merge3.')
+    self.random = random.Random(3)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def diff3(self, mine, older, yours):
+    paths = []
+    for name, text in (('mine', mine), ('older', older), ('yours', yours)):
+      path = os.path.join(self.dir, name)
+      with open(path, 'w') as f:
+        f.write(text)
+      paths.append(path)
+    p = subprocess.Popen(['diff3', '-E', '-m', '-L', 'mine', paths[0],
+                          '-L', 'BASE', paths[1], '-L', 'yours', paths[2]],
+                         stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    self.assertIn(p.returncode, (0, 1))
+    return out, p.returncode == 1
+
+  def change(self, lines, alphabet, changes):
+    lines = list(lines)
+    for i in range(self.random.randint(0, changes)):
+      at = self.random.randint(0, len(lines))
+      what = self.random.random()
+      if what < 0.4:
+        lines[at:at] = [self.random.choice(alphabet)
+                        for j in range(self.random.randint(1, 3))]
+      elif what < 0.8:
+        del lines[at:at + self.random.randint(1, 3)]
+      else:
+        lines[at:at + 1] = [self.random.choice(alphabet).upper()]
+    return ''.join(line + '\n' for line in lines)
+
+  def check(self, count, size, changes):
+    for i in range(count):
+      # few distinct lines, so that there are many ways to line them up
+      alphabet = self.random.choice(['ab', 'abcd', 'abcdefghijklmnop'])
+      older = [self.random.choice(alphabet)
+               for j in range(self.random.randint(0, size))]
+      mine = self.change(older, alphabet, changes)
+      yours = self.change(older, alphabet, changes)
+      older = ''.join(line + '\n' for line in older)
+      self.assertEqual(merge3.merge(mine, older, yours, 'mine', 'yours'),
+                       self.diff3(mine, older, yours),
+                       (mine, older, yours))
+
+  def test_small(self):
+    self.check(200, 30, 6)
+
+  def test_large(self):
+    # beyond the lines of horizon diff3 asks diff for
+    self.check(20, 500, 20)
@@ -0,0 +1,75 @@
+import BaseHTTPServer
+import os
+import shutil
+import threading
+import unittest
+from tempfile import mkdtemp
+
+from model.mirror import MirrorSet, is_not_found
+
+class BrokenHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    self.send_error(500)
+
+  def log_message(self, *args):
+    pass
+
+class MirrorSetTest(unittest.TestCase):
+  def setUp(self):
+    self.good = mkdtemp(prefix='momtest.mirror.')
+    self.output = mkdtemp(prefix='momtest.mirror.')
+    with open(os.path.join(self.good, 'hello.txt'), 'w') as f:
+      f.write('hello\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.good)
+    shutil.rmtree(self.output)
+
+  # Nothing listens on port 1, so the first mirror is down. The file
+  # should come from the second mirror, and the first should be avoided
+  # from then on.
+  def test_failover(self):
+    mirrors = MirrorSet(['http://127.0.0.1:1/down', 'file://' + self.good])
+    filename = os.path.join(self.output, 'pool/hello.txt')
+    self.assertEqual(mirrors.retrieve('hello.txt', filename), 6)
+    self.assertEqual(open(filename).read(), 'hello\n')
+    self.assertEqual(mirrors.best(), 'file://' + self.good)
+    self.assertEqual(mirrors.ordered()[-1].failures, 1)
+
+  # A file missing from every mirror is reported as missing, and does
+  # not count against the mirrors' health
+  def test_notFound(self):
+    mirrors = MirrorSet(['file:///nonexistent', 'file://' + self.good])
+    with self.assertRaises(IOError) as cm:
+      mirrors.fetch('missing.txt')
+    self.assertTrue(is_not_found(cm.exception))
+    for m in mirrors.ordered():
+      self.assertEqual(m.failures, 0)
+    self.assertFalse(os.listdir(self.output))
+
+  # Mirrors on the local filesystem are linked into place, not copied
+  def test_localPath(self):
+    mirrors = MirrorSet(['http://127.0.0.1:1/local'],
+                        local_paths={'http://127.0.0.1:1/local': self.good})
+    filename = os.path.join(self.output, 'hello.txt')
+    mirrors.retrieve('hello.txt', filename)
+    self.assertEqual(os.stat(filename).st_ino,
+                     os.stat(os.path.join(self.good, 'hello.txt')).st_ino)
+    self.assertEqual(mirrors.fetch('hello.txt'), 'hello\n')
+
+  # A mirror answering with server errors keeps failing, so it is
+  # benched for longer each time, though its latency is still measured
+  def test_httpError(self):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), BrokenHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+      mirrors = MirrorSet(['http://127.0.0.1:%d' % server.server_port])
+      for i in range(2):
+        self.assertRaises(IOError, mirrors.fetch, 'hello.txt')
+    finally:
+      server.shutdown()
+      thread.join()
+    self.assertEqual(mirrors.mirrors[0].failures, 2)
+    self.assertFalse(mirrors.mirrors[0].healthy)
+    self.assertNotEqual(mirrors.mirrors[0].latency, None)
@@ -0,0 +1,56 @@
+import logging
+import os
+import unittest
+
+from util.parallel import run_jobs
+
+logger = logging.getLogger('parallelTests')
+
+def square(n):
+  logger.warning('squaring %d', n)
+  if n == 3:
+    raise ValueError(n)
+  return n * n
+
+def pid(item):
+  return os.getpid()
+
+class Collect(logging.Handler):
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+class RunJobsTest(unittest.TestCase):
+  def setUp(self):
+    self.collect = Collect()
+    logger.addHandler(self.collect)
+
+  def tearDown(self):
+    logger.removeHandler(self.collect)
+
+  # Results and log messages come back in order, labelled, and one
+  # failure does not stop the rest
+  def test_workers(self):
+    results = run_jobs(square, range(6), jobs=3, label=lambda n: 'n%d' % n)
+    self.assertEqual([r[1] for r in results], [0, 1, 4, None, 16, 25])
+    self.assertEqual([r[2] for r in results],
+                     [False, False, False, True, False, False])
+    self.assertEqual(self.collect.messages,
+                     ['n%d: squaring %d' % (n, n) for n in range(6)])
+
+  def test_serial(self):
+    results = run_jobs(square, [2, 3], jobs=1)
+    self.assertEqual([(r[1], r[2]) for r in results], [(4, False),
+                                                       (None, True)])
+
+  # started() runs in this process once the workers are forked
+  def test_started(self):
+    started = []
+    results = run_jobs(pid, [1, 2], jobs=2,
+                       started=lambda: started.append(os.getpid()))
+    self.assertEqual(started, [os.getpid()])
+    self.assertEqual([r[2] for r in results], [False, False])
+    self.assertNotIn(os.getpid(), [r[1] for r in results])
@@ -0,0 +1,71 @@
+import os
+import shutil
+import time
+import unittest
+from tempfile import mkdtemp
+
+from model import prefetch
+from model.mirror import MirrorSet
+from util.parallel import flocked
+
+class PrefetcherTest(unittest.TestCase):
+  def setUp(self):
+    self.mirror = mkdtemp(prefix='momtest.prefetch.')
+    self.output = mkdtemp(prefix='momtest.prefetch.')
+    for name in ('small', 'large'):
+      with open(os.path.join(self.mirror, name), 'w') as f:
+        f.write(name)
+    self.mirrors = MirrorSet(['file://' + self.mirror])
+
+  def tearDown(self):
+    shutil.rmtree(self.mirror)
+    shutil.rmtree(self.output)
+
+  def test_background(self):
+    p = prefetch.Prefetcher(jobs=2)
+    for name, size in (('small', 5), ('large', 5000), ('small', 5)):
+      p.add(self.mirrors, name, os.path.join(self.output, name), size)
+    self.assertEqual(len(p), 2)
+    p.start()
+    self.assertTrue(prefetch.active() is p)
+    try:
+      # give the workers time to pick everything up
+      for i in range(100):
+        if p.fetched == 2:
+          break
+        time.sleep(0.05)
+      for name in ('small', 'large'):
+        filename = os.path.join(self.output, name)
+        self.assertTrue(p.wait(filename))
+        self.assertEqual(open(filename).read(), name)
+      self.assertFalse(p.wait(os.path.join(self.output, 'other')))
+    finally:
+      p.close()
+    self.assertTrue(prefetch.active() is None)
+
+  # A file wanted before any worker starts on it is handed back to the
+  # caller rather than waited for
+  def test_taken(self):
+    p = prefetch.Prefetcher(jobs=0)
+    filename = os.path.join(self.output, 'small')
+    p.add(self.mirrors, 'small', filename, 5)
+    p.start()
+    self.assertFalse(p.wait(filename))
+    p.close()
+    self.assertFalse(os.path.exists(filename))
+
+  # Files whose lock someone else holds are left to them
+  def test_locked(self):
+    lock = os.path.join(self.output, 'lock')
+    p = prefetch.Prefetcher(jobs=1)
+    for name in ('small', 'large'):
+      p.add(self.mirrors, name, os.path.join(self.output, name), 5, lock)
+    with flocked(lock):
+      p.start()
+      try:
+        for name in ('small', 'large'):
+          self.assertFalse(p.wait(os.path.join(self.output, name)))
+      finally:
+        p.close()
+    self.assertEqual((p.fetched, p.failed), (0, 0))
+    self.assertEqual(os.listdir(self.output), ['lock'])
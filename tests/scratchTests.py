@@ -0,0 +1,73 @@
+import os
+import shutil
+import subprocess
+import unittest
+from tempfile import mkdtemp
+
+from util.scratch import Scratch
+
+class ScratchTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = mkdtemp(prefix='momtest.scratch.')
+    self.ram = os.path.join(self.dir, 'ram')
+    self.disk = os.path.join(self.dir, 'disk')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_budget(self):
+    scratch = Scratch(self.ram, budget=100)
+    first = scratch.mkdtemp(60, self.disk)
+    self.assertEqual(os.path.dirname(first), self.ram)
+    self.assertEqual(scratch.reserved(first), 60)
+    # another process sees what is reserved
+    spilled = Scratch(self.ram, budget=100).mkdtemp(60, self.disk)
+    self.assertEqual(os.path.dirname(spilled), self.disk)
+    self.assertIsNone(scratch.reserved(spilled))
+    self.assertEqual(os.path.dirname(scratch.mkdtemp(None, self.disk)),
+                     self.disk)
+
+    scratch.remove(first)
+    self.assertFalse(os.path.exists(first))
+    second = scratch.mkdtemp(60, self.disk)
+    self.assertEqual(os.path.dirname(second), self.ram)
+    self.assertEqual(scratch.peak, 60)
+
+  def test_place(self):
+    scratch = Scratch(self.ram, budget=100)
+    work = os.path.join(self.disk, 'work', '1.0')
+    scratch.place(work, 10)
+    self.assertTrue(os.path.islink(work))
+    with open(os.path.join(work, 'file'), 'w') as f:
+      f.write('x')
+    target = os.path.realpath(work)
+    self.assertEqual(scratch.reserved(work), 10)
+
+    # placing it again starts afresh
+    scratch.place(work, 200)
+    self.assertFalse(os.path.exists(target))
+    self.assertFalse(os.path.islink(work))
+    self.assertEqual(os.listdir(work), [])
+    scratch.remove(work)
+    self.assertFalse(os.path.exists(work))
+
+    # or on disk, whatever room there is
+    scratch.place(work, None)
+    self.assertFalse(os.path.islink(work))
+    self.assertIsNone(scratch.reserved(work))
+
+  def test_dead_process(self):
+    scratch = Scratch(self.ram, budget=100)
+    p = subprocess.Popen(['true'])
+    p.wait()
+    os.makedirs(os.path.join(self.ram, 'stale'))
+    with open(os.path.join(self.ram, 'stale.reserved'), 'w') as f:
+      f.write('%d 100\n' % p.pid)
+    self.assertEqual(os.path.dirname(scratch.mkdtemp(60, self.disk)),
+                     self.ram)
+    self.assertFalse(os.path.exists(os.path.join(self.ram, 'stale')))
+
+  def test_no_directory(self):
+    scratch = Scratch(None)
+    self.assertEqual(os.path.dirname(scratch.mkdtemp(0, self.disk)),
+                     self.disk)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+
+from util.unpackcache import UnpackCache
+
+class UnpackCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = mkdtemp(prefix='momtest.unpackcache.')
+    self.built = []
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def build(self, size):
+    def build(path):
+      self.built.append(os.path.basename(path))
+      os.mkdir(path)
+      with open(os.path.join(path, 'data'), 'w') as f:
+        f.write('x' * size)
+    return build
+
+  # An entry is only built the first time it is acquired, by this or any
+  # other cache on the same directory
+  def test_acquire(self):
+    cache = UnpackCache(self.dir)
+    path = cache.acquire('a', self.build(10))
+    self.assertEqual(path, os.path.join(self.dir, 'a'))
+    self.assertEqual(open(os.path.join(path, 'data')).read(), 'x' * 10)
+    self.assertEqual(cache.acquire('a', self.build(10)), path)
+    cache.release('a')
+    cache.release('a')
+
+    other = UnpackCache(self.dir)
+    self.assertEqual(other.acquire('a', self.build(10)), path)
+    other.release('a')
+    self.assertEqual(len(self.built), 1)
+    self.assertEqual([(size, key) for mtime, size, key in cache.entries()],
+                     [(10, 'a')])
+
+  # The least recently used entries go first, but not those in use
+  def test_evict(self):
+    cache = UnpackCache(self.dir)
+    for key in ('a', 'b', 'c'):
+      cache.acquire(key, self.build(100))
+      os.utime(os.path.join(self.dir, key + '.lock'),
+               (time.time(), time.time() - 100 + len(self.built)))
+    cache.release('b')
+    cache.release('c')
+
+    self.assertEqual(cache.evict(150), 200)
+    self.assertTrue(os.path.isdir(os.path.join(self.dir, 'a')))
+    self.assertFalse(os.path.exists(os.path.join(self.dir, 'b')))
+    self.assertFalse(os.path.exists(os.path.join(self.dir, 'c')))
+
+    cache.release('a')
+    self.assertEqual(cache.evict(0), 100)
+    self.assertEqual(cache.entries(), [])
+    cache.acquire('a', self.build(100))
+    self.assertEqual(len(self.built), 4)
+    cache.release('a')
+
+  # Going over the budget evicts older entries straight away
+  def test_budget(self):
+    cache = UnpackCache(self.dir, budget=150)
+    cache.acquire('a', self.build(100))
+    cache.release('a')
+    cache.acquire('b', self.build(100))
+    self.assertEqual([key for mtime, size, key in cache.entries()], ['b'])
+    cache.release('b')
+
+  # Trees left half built by a process that died are removed, but not
+  # those still being built
+  def test_partials(self):
+    child = subprocess.Popen(['true'])
+    child.wait()
+    dead = os.path.join(self.dir, 'a.new.%d' % child.pid)
+    building = os.path.join(self.dir, 'b.new.%d' % os.getpid())
+    os.mkdir(dead)
+    os.mkdir(building)
+    UnpackCache(self.dir).evict(0)
+    self.assertFalse(os.path.exists(dead))
+    self.assertTrue(os.path.isdir(building))
+
+  # Threads acquiring the same entry share one build, and no more than
+  # slots entries are built at once
+  def test_threads(self):
+    cache = UnpackCache(self.dir, slots=2)
+    running = []
+    most = []
+    lock = threading.Lock()
+    def build(path):
+      with lock:
+        running.append(path)
+        most.append(len(running))
+      time.sleep(0.1)
+      self.build(1)(path)
+      with lock:
+        running.remove(path)
+
+    keys = ['a', 'b', 'c', 'a', 'b', 'c']
+    threads = [threading.Thread(target=cache.acquire, args=(key, build))
+               for key in keys]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(sorted(self.built), ['a.new.%d' % os.getpid(),
+                                          'b.new.%d' % os.getpid(),
+                                          'c.new.%d' % os.getpid()])
+    self.assertEqual(max(most), 2)
+    for key in keys:
+      cache.release(key)
+    self.assertEqual(cache._held, {})
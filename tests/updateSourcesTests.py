@@ -5,7 +5,7 @@ import json
 import hashlib
 import shutil
 
-from momlib import files
+from momlib import files, needed_packages
 from deb.controlfile import ControlFile
 
 import config
@@ -265,3 +265,54 @@ class DebsnapFetchTest(unittest.TestCase):
     dir_contents = os.listdir(self.output_dir)
     self.assertEqual(len(dir_contents), 3)
     self.assertIn('foo_1.2-1.dsc', dir_contents)
+
+
+class RefreshSourcesTest(unittest.TestCase):
+  def setUp(self):
+    self.target_repo, self.source_repo = testhelper.standard_simple_config()
+    testhelper.config_add_distro_target('othertarget', 'target',
+                                        self.target_repo.dist, 'main',
+                                        ['stable0distro_source'], [])
+
+  # Two targets share both the target distro and the upstream, so each
+  # should only be refreshed once
+  def test_planDeduplicated(self):
+    plan = update_sources.plan_refresh(config.targets())
+    self.assertEqual(sorted((d.name, dist) for d, dist in plan),
+                     [('stable0distro', 'stable'), ('target', 'stable')])
+
+  # Once a release has been processed, refreshing it again without any
+  # change in the archive should report nothing new
+  def test_unchangedRelease(self):
+    testhelper.build_and_import_simple_package('foo', '1.0', self.target_repo)
+    plan = update_sources.plan_refresh(config.targets())
+    self.assertEqual(len(update_sources.refresh_sources(plan)), 2)
+
+    for distro, dist in plan:
+      distro.saveReleaseStamp(dist)
+    self.assertEqual(update_sources.refresh_sources(plan), set())
+
+    testhelper.build_and_import_simple_package('bar', '1.0', self.source_repo)
+    self.assertEqual(update_sources.refresh_sources(plan),
+                     set([('stable0distro', 'stable')]))
+
+class SelectiveMirrorTest(unittest.TestCase):
+  def setUp(self):
+    self.target_repo, self.source_repo = testhelper.standard_simple_config()
+
+  # Only the upstream packages that the target carries are mirrored
+  def test_neededOnly(self):
+    testhelper.build_and_import_simple_package('foo', '1.0', self.target_repo)
+    testhelper.build_and_import_simple_package('foo', '2.0', self.source_repo)
+    testhelper.build_and_import_simple_package('bar', '2.0', self.source_repo)
+    testhelper.update_all_distro_sources()
+
+    source = config.targets()[0].getAllSourceLists()[0][0]
+    names = needed_packages(source.distro, source.dist)
+    self.assertEqual(names, set(['foo']))
+
+    source.distro.downloadPackage(source.dist, 'main', packages=names)
+    foo = source.distro.package(source.dist, 'main', 'foo')
+    bar = source.distro.package(source.dist, 'main', 'bar')
+    self.assertEqual(len(foo.getPoolVersions()), 1)
+    self.assertEqual(bar.getPoolVersions(), [])
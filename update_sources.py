@@ -20,6 +20,7 @@
 import sys
 import os
 import json
+from multiprocessing.pool import ThreadPool
 import urllib2
 
 import osc.core
@@ -29,6 +30,10 @@ from deb.version import Version
 from deb.controlfile import ControlFile
 from model import Distro, UpdateInfo
 from model.obs import OBSDistro
+from model.mirror import is_not_found
+from model.delta import Delta
+from model.prefetch import Prefetcher
+from util.parallel import flocked, run_jobs
 import config
 import model.error
 import logging
@@ -169,26 +174,38 @@ def find_upstream(target, pv):
 
   return upstream
 
-def find_and_download_package(target, package_name, version):
-  # Try to find the requested package in the target distro, just in case
-  # it is there
+def find_in_distros(target, package_name, version):
+  """Return (ours, theirs): the PackageVersion of version of package_name
+  in the target distro, and in the first of its source lists that has
+  it. Either is None if there is no such version there.
+  """
+  ours = None
   try:
-    pv = target.distro.findPackage(package_name, searchDist=target.dist,
-                                   version=version)
-    pv.download()
+    ours = target.distro.findPackage(package_name, searchDist=target.dist,
+                                     version=version)[0]
   except model.error.PackageNotFound:
     pass
 
-  # Try all the source distros
+  theirs = None
   for source_list in target.getAllSourceLists():
     try:
-      pv = source_list.findPackage(package_name, version)[0]
-      pv.download()
-      logger.info('Downloaded %s base version %s from distros',
-                   package_name, pv.version)
-      return True
+      theirs = source_list.findPackage(package_name, version)[0]
+      break
     except model.error.PackageNotFound:
       pass
+  return ours, theirs
+
+def find_and_download_package(target, package_name, version):
+  # Try to find the requested package in the target distro, just in case
+  # it is there, and in all the source distros
+  ours, theirs = find_in_distros(target, package_name, version)
+  if ours is not None:
+    ours.download()
+  if theirs is not None:
+    theirs.download()
+    logger.info('Downloaded %s base version %s from distros',
+                 package_name, theirs.version)
+    return True
 
   logger.debug('Did not find %s base %s in distros', package_name, version)
   return False
@@ -212,30 +229,26 @@ def download_removed_package(target_dir, target, package_name, version):
     if not found:
       return False
 
-    mirror = found.package.distro.mirrorURL()
+    mirrors = found.package.distro.mirrors()
     pooldir = found.package.getCurrentSources()[0]['Directory']
     name = "%s_%s.dsc" % (package_name, version.without_epoch)
-    url = "%s/%s/%s" % (mirror, pooldir, name)
     dsc_file = "%s/%s" % (target_dir, name)
     dsc_file_tmp = "%s.tmp" % dsc_file
-    logger.debug("Downloading %s to %s", url, dsc_file_tmp)
+    logger.debug("Downloading %s/%s to %s", pooldir, name, dsc_file_tmp)
     try:
-      fd = urllib2.urlopen(url)
-      open(dsc_file_tmp, 'w').write(fd.read())
-    except urllib2.HTTPError, e:
-      if e.code == 404:
+      mirrors.retrieve("%s/%s" % (pooldir, name), dsc_file_tmp)
+    except IOError, e:
+      if is_not_found(e):
         return False
       raise
 
     dsc_data = ControlFile(dsc_file_tmp, multi_para=False, signed=True).para
     for md5sum, size, name in files(dsc_data):
-      url = "%s/%s/%s" % (mirror, pooldir, name)
       outfile = "%s/%s" % (target_dir, name)
       try:
-        fd = urllib2.urlopen(url)
-        open(outfile, 'w').write(fd.read())
-      except urllib2.HTTPError, e:
-        if e.code == 404:
+        mirrors.retrieve("%s/%s" % (pooldir, name), outfile)
+      except IOError, e:
+        if is_not_found(e):
           return False
         raise
 
@@ -245,35 +258,78 @@ def download_removed_package(target_dir, target, package_name, version):
     logger.info('Downloaded removed package %s %s', package_name, version)
     return True
 
+class PackageNeeds(object):
+  """What handle_package() has to do for a package of target, as far as
+  the indices and the pool can tell before anything is downloaded.
+  """
+
+  def __init__(self, target, package, force=False):
+    self.target = target
+    self.update_info = UpdateInfo(package)
+
+    # The PackageVersion that we will look to update from upstream,
+    # and the upstream version to upgrade it to.
+    self.pv = package.newestVersion()
+    self.upstream = find_upstream(target, self.pv)
+    if self.upstream is not None:
+      self.upstream_version = self.upstream.version
+    else:
+      self.upstream_version = None
+
+    # If UpdateInfo is already recorded to upgrade this version to the
+    # detected upstream, then nothing has changed since last time.
+    self.unchanged = not force \
+        and self.update_info.version == self.pv.version \
+        and self.update_info.upstream_version == self.upstream_version
+
+    # The base has to be found unless our version is the base, meaning
+    # that we have taken the package as-is from upstream, or the base is
+    # already in a local pool.
+    self.base_version = self.pv.version.base()
+    self.pool_versions = None
+    self.need_base = False
+    if not self.unchanged and self.base_version != self.pv.version:
+      self.pool_versions = [v.version for v in
+                            target.getAllPoolVersions(package.name)]
+      self.need_base = self.base_version not in self.pool_versions
+
+  def versions(self):
+    """Return the PackageVersions that handle_package() can be expected
+    to download: our newest version, the upstream version we would
+    update to and, if we still need it, our base version from the
+    distros.
+    """
+    ret = [self.pv]
+    if self.upstream is not None and self.upstream > self.pv:
+      ret.append(self.upstream)
+    if self.need_base:
+      found = find_in_distros(self.target, self.pv.package.name,
+                              self.base_version)
+      ret.extend(pv for pv in found if pv is not None)
+    return ret
+
 # Set the stage for updating a specific package
 def handle_package(target, package, force=False):
     # Store our results in a UpdateInfo file and use that to avoid repeating
     # the work we do below.
-    update_info = UpdateInfo(package)
-
-    # Find the PackageVersion that we will look to update from upstream,
-    # and download its sources.
-    pv = package.newestVersion()
+    needs = PackageNeeds(target, package, force)
+    update_info = needs.update_info
+    pv = needs.pv
+    upstream = needs.upstream
+    upstream_version = needs.upstream_version
+    base_version = needs.base_version
+    pool_versions = needs.pool_versions
+
+    # Download the sources of our version, and make the new upstream
+    # version available for the upgrade process
     logger.debug('Handling package %s with UpdateInfo %s', pv, update_info)
     pv.download()
-
-    # Look at the upstreams and figure out which is the right version to
-    # upgrade to.
-    upstream = find_upstream(target, pv)
-    if upstream is not None:
-      upstream_version = upstream.version
-    else:
-      upstream_version = None
-
-    # Make that new version available for the upgrade process
     if upstream is not None and upstream > pv:
       upstream.download()
 
-    # If UpdateInfo is already recorded to upgrade this version to the
-    # detected upstream, then nothing has changed since last time and we
-    # do not need to repeat that work.
-    if not force and update_info.version == pv.version \
-        and update_info.upstream_version == upstream_version:
+    # If nothing has changed since last time, we do not need to repeat
+    # the work below.
+    if needs.unchanged:
       logger.debug('Already have base info for base=%s upstream=%s',
                     pv, upstream)
       return
@@ -284,23 +340,16 @@ def handle_package(target, package, force=False):
     # Now we try to figure out which version that our package is based
     # upon, and we make a strong effort to download that version to
     # a local pool.
-    base_version = pv.version.base()
     update_info.set_base_version(base_version)
 
-    # If our version number is the same as the base then that means
-    # we have taken the package as-is from upstream, so no merging
-    # is necessary.
-    if base_version == pv.version:
-      logger.debug('%s is unmodified from upstream', pv)
-      update_info.save()
-      return
-
-    # If we already have the base version present in a local pool
-    # then we have nothing else to do.
-    pool_versions = target.getAllPoolVersions(pv.package.name)
-    pool_versions = map(lambda x: x.version, pool_versions)
-    if base_version in pool_versions:
-      logger.info('%s base %s was found in local pool', pv, base_version)
+    # If our version number is the same as the base, no merging is
+    # necessary; if the base is in a local pool, we have nothing else
+    # to do.
+    if not needs.need_base:
+      if base_version == pv.version:
+        logger.debug('%s is unmodified from upstream', pv)
+      else:
+        logger.info('%s base %s was found in local pool', pv, base_version)
       update_info.save()
       return
 
@@ -310,12 +359,39 @@ def handle_package(target, package, force=False):
       update_info.save()
       return
 
+    # The searches below are slow, so the base they find is remembered for
+    # this version and upstream, for other targets and later runs. A base
+    # found before only helps if this target can still get hold of it.
+    # Finding none is not remembered, since it may only mean that
+    # snapshot.debian.org or the archive could not be reached, and --force
+    # searches afresh.
+    store = UpdateInfo.store()
+    resolved = None
+    if not force:
+      resolved = store.getResolution(pv.package.name, pv.version,
+                                     upstream_version)[1]
+    if resolved is not None:
+      resolved = Version(resolved)
+      if resolved in pool_versions \
+          or find_and_download_package(target, pv.package.name, resolved):
+        logger.info('%s base %s was resolved before', pv, resolved)
+        update_info.set_base_version(resolved)
+        update_info.save()
+        return
+      logger.debug('%s base %s was resolved before but is not available '
+                   'here, searching again', pv, resolved)
+
+    def remember(version):
+      store.putResolution(pv.package.name, pv.version, upstream_version,
+                          version)
+
     # Fall back on checking snapshot.debian.org
     debsnap_versions = get_debian_snapshot_versions(pv.package.name)
     if base_version in debsnap_versions:
       ret = download_from_debsnap(pv.package.poolPath, pv.package.name,
                                   base_version)
       if ret:
+        remember(base_version)
         update_info.save()
         return
 
@@ -323,6 +399,7 @@ def handle_package(target, package, force=False):
     ret = download_removed_package(pv.package.poolPath, target, pv.package.name,
                                    base_version)
     if ret:
+      remember(base_version)
       update_info.save()
       return
 
@@ -331,39 +408,42 @@ def handle_package(target, package, force=False):
     # versions there. They might be close enough to enable a 3-way merge.
     logging.debug('Checking changelog for older base versions')
     unpacked_dir = unpack_source(pv)
-    changelog_versions = read_changelog(unpacked_dir + '/debian/changelog')
-    found = None
-    for cl_version, text in changelog_versions:
-      # Only consider versions that correspond to unmodified packages
-      if cl_version.base() != cl_version:
-        continue
-
-      logger.debug('Considering changelog version %s', cl_version)
+    try:
+      changelog_versions = read_changelog(unpacked_dir + '/debian/changelog')
+      found = None
+      for cl_version, text in changelog_versions:
+        # Only consider versions that correspond to unmodified packages
+        if cl_version.base() != cl_version:
+          continue
 
-      # Do we have it in the pool?
-      if cl_version in pool_versions:
-        logger.debug('Found %s in pool', cl_version)
-        found = cl_version
-        break
+        logger.debug('Considering changelog version %s', cl_version)
 
-      # Can we get it from a standard distro?
-      if find_and_download_package(target, pv.package.name, cl_version):
-        found = cl_version
-        break
+        # Do we have it in the pool?
+        if cl_version in pool_versions:
+          logger.debug('Found %s in pool', cl_version)
+          found = cl_version
+          break
 
-      # Can we get it with debsnap?
-      if cl_version in debsnap_versions:
-        ret = download_from_debsnap(pv.package.poolPath, pv.package.name,
-                                    cl_version)
-        if ret:
+        # Can we get it from a standard distro?
+        if find_and_download_package(target, pv.package.name, cl_version):
           found = cl_version
           break
 
-    cleanup_source(pv)
+        # Can we get it with debsnap?
+        if cl_version in debsnap_versions:
+          ret = download_from_debsnap(pv.package.poolPath, pv.package.name,
+                                      cl_version)
+          if ret:
+            found = cl_version
+            break
+    finally:
+      cleanup_source(pv)
+
     if found:
       logger.info('Couldn\'t find %s true base %s, using %s instead',
                    pv, base_version, found)
       update_info.set_base_version(found)
+      remember(found)
       update_info.save()
       return
 
@@ -374,30 +454,182 @@ def handle_package(target, package, force=False):
     update_info.save()
 
 
+def package_lock(name):
+    """Return the lock held while the package name is handled."""
+    return os.path.join(config.get('ROOT'), 'locks', 'packages', name)
+
+def plan_downloads(work, force=False):
+    """Return (mirrors, relpath, filename, size, lock) for each file that
+    the (target, package) pairs in work are expected to need and that is
+    not in the pool yet, where lock is the package_lock() held while
+    handling the package. Each file appears once, however many targets
+    need it.
+    """
+    plan = []
+    seen = set()
+    for target, package in work:
+      for pv in PackageNeeds(target, package, force).versions():
+        distro = pv.package.distro
+        for relpath, filename, size in distro.poolFiles(
+            pv.package.dist, pv.package.component, pv.package.name,
+            pv.version):
+          if filename in seen:
+            continue
+          seen.add(filename)
+          if os.path.isfile(filename) and os.path.getsize(filename) == size:
+            continue
+          plan.append((distro.mirrors(), relpath, filename, size,
+                       package_lock(package.name)))
+    return plan
+
+def plan_refresh(targets):
+    """Return each (Distro, dist) whose Sources are needed by the given
+    targets, either as the target itself or as one of its upstreams.
+    Each pair appears once, however many targets share it.
+    """
+    plan = []
+    seen = set()
+    for target in targets:
+      wanted = [(target.distro, target.dist)]
+      for upstreamList in target.getAllSourceLists():
+        for source in upstreamList:
+          wanted.append((source.distro, source.dist))
+
+      for distro, dist in wanted:
+        if (distro.name, dist) not in seen:
+          seen.add((distro.name, dist))
+          plan.append((distro, dist))
+    return plan
+
+def _refresh_one(item):
+    distro, dist = item
+    return distro.updateSources(dist)
+
+def refresh_sources(plan, jobs=1):
+    """Update the Sources for every (Distro, dist) in plan, running up to
+    jobs updates at a time. Return the set of (distro name, dist) whose
+    release changed since it was last completely processed.
+    """
+    if jobs > 1 and len(plan) > 1:
+      # updates spend their time waiting for mirrors, and threads share
+      # what we learn about the mirrors' speed
+      pool = ThreadPool(min(jobs, len(plan)))
+      try:
+        results = pool.map(_refresh_one, plan)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = [distro.updateSources(dist) for distro, dist in plan]
+
+    changed = set()
+    for (distro, dist), result in zip(plan, results):
+      if result:
+        logger.info("Sources for %s/%s changed", distro, dist)
+        changed.add((distro.name, dist))
+      else:
+        logger.debug("Sources for %s/%s unchanged", distro, dist)
+    return changed
+
+def options(parser):
+    parser.add_option("-f", "--force", action="store_true",
+                      help="Process packages whose sources are unchanged")
+    parser.add_option("--full", action="store_true",
+                      help="Process every package, not just those affected "
+                           "by changes since the last run")
+    parser.add_option("-j", "--jobs", type="int", default=1, metavar="N",
+                      help="Handle up to N packages at once")
+    parser.add_option("-m", "--mirror", action="store_true",
+                      help="Also mirror every version of the packages our "
+                           "targets need into the pool")
+
 def main(options, args):
     logger.info('Updating source packages in target and source distros...')
 
-    upstreamSources = []
-    packages = []
-    for target in config.targets(args):
-      logger.info("Updating sources for %s", target)
-      d = target.distro
-      d.updateSources(target.dist)
-
-      for upstreamList in target.getAllSourceLists():
-        for source in upstreamList:
-          if source not in upstreamSources:
-            logger.info("Updating upstream sources for %s", source)
-            source.distro.updateSources(source.dist)
+    targets = config.targets(args)
+    plan = plan_refresh(targets)
+    logger.info("Updating sources for %d distro releases", len(plan))
+    changed = refresh_sources(plan, config.get('REFRESH_JOBS', default=4))
+
+    # Compare the refreshed Sources with those of the last complete run;
+    # the later stages read the result to decide what to look at
+    delta = Delta.compute(targets)
+    delta.save()
+
+    incomplete = set()
+    work = []
+    for target in targets:
+      target_plan = [(d.name, dist) for d, dist in plan_refresh([target])]
+      wanted = delta.packages(target)
+      if options.package:
+        incomplete.update(target_plan)
+        wanted = None
+      elif options.force or options.full:
+        wanted = None
+      elif not changed.intersection(target_plan) and not wanted:
+        logger.info("%s and its upstreams are unchanged, skipping", target)
+        continue
 
       for package in target.distro.packages(target.dist, target.component):
         if options.package and package.name not in options.package:
           continue
+        if wanted is not None and package.name not in wanted:
+          continue
+        work.append((target, package, target_plan))
+
+    # Work out everything the packages below will download, so that it
+    # can be fetched in the background while they are handled
+    prefetcher = Prefetcher(config.get('PREFETCH_JOBS', default=4))
+    downloads = plan_downloads([(t, p) for t, p, tp in work], options.force)
+    for item in downloads:
+      prefetcher.add(*item)
+    logger.info("Prefetching %d files (%d bytes)", len(downloads),
+                sum(item[3] for item in downloads))
+
+    def handle(item):
+      target, package, target_plan = item
+      # Targets share upstream pools and base information, so the same
+      # package must not be handled twice at once. What it records is
+      # committed before the next package, so that other workers are not
+      # kept waiting for the database and an interrupted run loses little.
+      with flocked(package_lock(package.name)):
         try:
-          handle_package(target, package, options.force)
+          with UpdateInfo.batch():
+            handle_package(target, package, options.force)
+          return True
         except urllib2.HTTPError, e:
           logger.warning('Caught HTTPError while handling %s: %s:', package, e)
+          return False
+
+    try:
+      # Workers must not inherit downloads in progress, so the prefetcher
+      # only starts once they are running; it leaves alone the packages
+      # they are handling.
+      results = run_jobs(handle, work, options.jobs,
+                         label=lambda item: item[1].name,
+                         started=prefetcher.start)
+      for (target, package, target_plan), ok, failed in results:
+        if failed or not ok:
+          incomplete.update(target_plan)
+          delta.fail(target, package.name)
+      delta.save()
+
+      # Populating the pool with everything the targets could use saves
+      # fetching it on demand later, but whole archives are never needed
+      if options.mirror:
+        for distro, dist in plan:
+          names = needed_packages(distro, dist, targets)
+          for component in distro.components():
+            distro.downloadPackage(dist, component, packages=names)
+    finally:
+      prefetcher.close()
+
+    # Only now that every package has been handled can we consider these
+    # releases done with; otherwise they are retried next time
+    for distro, dist in plan:
+      if (distro.name, dist) not in incomplete:
+        distro.saveReleaseStamp(dist)
 
 if __name__ == "__main__":
-    run(main, usage="%prog [DISTRO...]",
+    run(main, options, usage="%prog [DISTRO...]",
         description="update the Sources file in a distribution's pool")
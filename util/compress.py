@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/compress.py - store files compressed, and read them back
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Files that are kept compressed on disk.
+
+A stored file is known by its uncompressed name, and is on disk under
+that name plus the extension of whichever compression it was written
+with, or that pack-archive.sh gave it later. Writers stream through the
+compressor, and readers find whichever variant there is and decompress
+it as they read.
+"""
+
+from __future__ import with_statement
+
+import bz2
+import errno
+import fcntl
+import gzip
+import os
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# Compression methods files can be written with, and their extensions
+METHODS = {
+    'xz': '.xz',
+    'bz2': '.bz2',
+    'gzip': '.gz',
+    'none': '',
+}
+
+# Extensions a stored file may have, in the order they are looked for
+EXTENSIONS = ('', '.xz', '.bz2', '.gz')
+
+
+class _Compressor(object):
+    """A file object writing through a bz2 or lzma compressor object."""
+
+    def __init__(self, f, compressor):
+        self.f = f
+        self.compressor = compressor
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.f.write(data)
+
+    def close(self):
+        self.f.write(self.compressor.flush())
+
+
+class _Pipe(object):
+    """A file object writing through a compressor process."""
+
+    def __init__(self, f, args):
+        self.args = args
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=f,
+                                     close_fds=True)
+        # other processes started meanwhile mustn't hold the pipe open
+        fd = self.proc.stdin.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise IOError('%s failed' % ' '.join(self.args))
+
+
+def find(filename):
+    """Return the path of the stored file filename, or None if there is
+    none.
+    """
+    for ext in EXTENSIONS:
+        if os.path.isfile(filename + ext):
+            return filename + ext
+    return None
+
+def exists(filename):
+    """Return whether there is a stored file filename."""
+    return find(filename) is not None
+
+def remove(filename):
+    """Remove every variant of the stored file filename."""
+    for ext in EXTENSIONS:
+        try:
+            os.unlink(filename + ext)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+@contextmanager
+def open_write(filename, method='none'):
+    """Open the stored file filename for writing, compressed with method.
+
+    What is written goes to a temporary file, which replaces any variant
+    of filename there was once the block is left; nothing is stored if it
+    raises an exception.
+    """
+    if method not in METHODS:
+        raise ValueError('unknown compression method %s' % method)
+    path = filename + METHODS[method]
+    new = '%s.new.%d.%d' % (path, os.getpid(),
+                            threading.current_thread().ident)
+
+    f = open(new, 'wb')
+    try:
+        out = f
+        done = False
+        try:
+            if method == 'xz' and lzma is None:
+                out = _Pipe(f, ('xz', '-c'))
+            elif method == 'xz':
+                out = _Compressor(f, lzma.LZMACompressor())
+            elif method == 'bz2':
+                out = _Compressor(f, bz2.BZ2Compressor())
+            elif method == 'gzip':
+                out = gzip.GzipFile(os.path.basename(filename), 'wb',
+                                    fileobj=f, mtime=0)
+            yield out
+            done = True
+        finally:
+            try:
+                if out is not f:
+                    out.close()
+            except EnvironmentError:
+                # only worth mentioning if nothing else went wrong
+                if done:
+                    raise
+            finally:
+                f.close()
+        remove(filename)
+        os.rename(new, path)
+    except:
+        if os.path.exists(new):
+            os.unlink(new)
+        raise
+
+@contextmanager
+def open_read(filename):
+    """Open the stored file filename for reading, decompressing it."""
+    path = find(filename)
+    if path is None:
+        raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+
+    if path.endswith('.xz') and lzma is None:
+        with open(path, 'rb') as f:
+            proc = subprocess.Popen(('xz', '-dc'), stdin=f,
+                                    stdout=subprocess.PIPE, close_fds=True)
+        try:
+            yield proc.stdout
+            while proc.stdout.read(65536):
+                pass
+        finally:
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise IOError('xz -dc %s failed' % path)
+        return
+
+    if path.endswith('.xz'):
+        f = lzma.LZMAFile(path)
+    elif path.endswith('.bz2'):
+        f = bz2.BZ2File(path)
+    elif path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    try:
+        yield f
+    finally:
+        f.close()
+
+def read(filename):
+    """Return the contents of the stored file filename."""
+    with open_read(filename) as f:
+        return f.read()
+
+def copy(filename, dest):
+    """Make dest an uncompressed copy of the stored file filename; it is
+    a hardlink if the file is stored uncompressed.
+    """
+    if os.path.isfile(filename):
+        os.link(filename, dest)
+        return
+
+    with open_read(filename) as f:
+        with open(dest, 'wb') as out:
+            shutil.copyfileobj(f, out, 1024 * 1024)
@@ -0,0 +1,632 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/diff.py - compare files the way GNU diff does
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Line-by-line comparison producing the same output as "diff -pu".
+
+This follows GNU diffutils step by step (identical prefix and suffix,
+discarding confusing lines, the divide-and-conquer Myers search with its
+cut-off, and sliding the changes), since anything else finds equally
+valid but different edit scripts, and our diffs are compared with ones
+made by diff itself. Text is handled as bytes, as in the C locale.
+"""
+
+import calendar
+import re
+import sys
+import time
+
+# Lines of context, and the lines of the identical prefix and suffix kept
+# for shift_boundaries() (the horizon), which diff makes at least as large
+CONTEXT = 3
+
+# diff -p
+FUNCTION_RE = re.compile(r'[A-Za-z$_]')
+
+# Bytes that make diff quote a file name, and how it escapes them
+_QUOTE_RE = re.compile(r'[\x00-\x20"\\\x80-\xff]')
+_ESCAPES = {
+    '\a': '\\a', '\b': '\\b', '\t': '\\t', '\n': '\\n', '\v': '\\v',
+    '\f': '\\f', '\r': '\\r', '"': '\\"', '\\': '\\\\',
+}
+
+_SNAKE_LIMIT = 20
+
+
+def is_binary(data, blksize=4096):
+    """Return whether diff would treat data as binary: that is, if its
+    first block holds a NUL byte.
+    """
+    return '\0' in data[:blksize]
+
+
+def quote_name(name):
+    """Quote a file name as diff does in its headers."""
+    if not _QUOTE_RE.search(name):
+        return name
+    out = []
+    for c in name:
+        if c in _ESCAPES:
+            out.append(_ESCAPES[c])
+        elif c < " " or c > "\x7f":
+            out.append('\\%03o' % ord(c))
+        else:
+            out.append(c)
+    return '"%s"' % ''.join(out)
+
+
+def format_time(mtime, nsec=0):
+    """Format a modification time as diff -u does, in local time."""
+    tm = time.localtime(mtime)
+    offset = (calendar.timegm(tm) - int(mtime)) // 60
+    sign = '-' if offset < 0 else '+'
+    offset = abs(offset)
+    return '%s.%09d %s%02d%02d' % (time.strftime('%Y-%m-%d %H:%M:%S', tm),
+                                    nsec, sign, offset // 60, offset % 60)
+
+
+def _common_prefix(a, b, limit):
+    """Return the length of the common prefix of a and b, up to limit."""
+    lo, hi = 0, limit
+    # double the step first, since the prefix is often short
+    step = 64
+    while lo + step < hi and a[lo:lo + step] == b[lo:lo + step]:
+        lo += step
+        step *= 2
+    hi = min(hi, lo + step)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b, limit):
+    """Return the length of the common suffix of a and b, up to limit."""
+    na, nb = len(a), len(b)
+    lo, hi = 0, limit
+    step = 64
+    while lo + step < hi \
+            and a[na - lo - step:na - lo] == b[nb - lo - step:nb - lo]:
+        lo += step
+        step *= 2
+    hi = min(hi, lo + step)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[na - mid:na - lo] == b[nb - mid:nb - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _split(data, start, end, missing_newline):
+    """Return the lines of data[start:end], which starts at the beginning
+    of a line, each with its newline. data has had a newline added if it
+    lacked one, which is left out again here.
+    """
+    lines = data[start:end].split('\n')
+    # the text after the last newline is empty
+    lines.pop()
+    lines = [line + '\n' for line in lines]
+    if missing_newline and end == len(data) and lines:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+class _Analysis(object):
+    """The state of diff_2_files() for one pair of files."""
+
+    def __init__(self, equivs0, equivs1):
+        self.equivs = (equivs0, equivs1)
+        n0, n1 = len(equivs0), len(equivs1)
+        # changed[f][i + 1] is the flag for line i, with a zero at each end
+        self.changed = ([0] * (n0 + 2), [0] * (n1 + 2))
+
+    def discard_confusing_lines(self):
+        """Set aside lines that match nothing in the other file, and
+        runs of lines that match too many, which otherwise make the
+        search expensive without helping it.
+        """
+        equiv_count = ({}, {})
+        for f in (0, 1):
+            counts = equiv_count[f]
+            for e in self.equivs[f]:
+                counts[e] = counts.get(e, 0) + 1
+
+        discarded = ([], [])
+        for f in (0, 1):
+            end = len(self.equivs[f])
+            counts = equiv_count[1 - f]
+            many = 5
+            tem = end // 64
+            tem >>= 2
+            while tem > 0:
+                many *= 2
+                tem >>= 2
+            for e in self.equivs[f]:
+                nmatch = counts.get(e, 0)
+                if nmatch == 0:
+                    discarded[f].append(1)
+                elif nmatch > many:
+                    discarded[f].append(2)
+                else:
+                    discarded[f].append(0)
+
+        for f in (0, 1):
+            discards = discarded[f]
+            end = len(discards)
+            i = 0
+            while i < end:
+                if discards[i] == 2:
+                    discards[i] = 0
+                elif discards[i] != 0:
+                    provisional = 0
+                    j = i
+                    while j < end:
+                        if discards[j] == 0:
+                            break
+                        if discards[j] == 2:
+                            provisional += 1
+                        j += 1
+                    while j > i and discards[j - 1] == 2:
+                        j -= 1
+                        discards[j] = 0
+                        provisional -= 1
+                    length = j - i
+
+                    if provisional * 4 > length:
+                        while j > i:
+                            j -= 1
+                            if discards[j] == 2:
+                                discards[j] = 0
+                    else:
+                        minimum = 1
+                        tem = length >> 2
+                        tem >>= 2
+                        while tem > 0:
+                            minimum <<= 1
+                            tem >>= 2
+                        minimum += 1
+
+                        j = 0
+                        consec = 0
+                        while j < length:
+                            if discards[i + j] != 2:
+                                consec = 0
+                            else:
+                                consec += 1
+                                if minimum == consec:
+                                    j -= consec
+                                elif minimum < consec:
+                                    discards[i + j] = 0
+                            j += 1
+
+                        j = 0
+                        consec = 0
+                        while j < length:
+                            if j >= 8 and discards[i + j] == 1:
+                                break
+                            if discards[i + j] == 2:
+                                consec = 0
+                                discards[i + j] = 0
+                            elif discards[i + j] == 0:
+                                consec = 0
+                            else:
+                                consec += 1
+                            if consec == 3:
+                                break
+                            j += 1
+
+                        i += length - 1
+
+                        j = 0
+                        consec = 0
+                        while j < length:
+                            if j >= 8 and discards[i - j] == 1:
+                                break
+                            if discards[i - j] == 2:
+                                consec = 0
+                                discards[i - j] = 0
+                            elif discards[i - j] == 0:
+                                consec = 0
+                            else:
+                                consec += 1
+                            if consec == 3:
+                                break
+                            j += 1
+                i += 1
+
+        self.undiscarded = ([], [])
+        self.realindexes = ([], [])
+        for f in (0, 1):
+            for i, e in enumerate(self.equivs[f]):
+                if discarded[f][i] == 0:
+                    self.undiscarded[f].append(e)
+                    self.realindexes[f].append(i)
+                else:
+                    self.changed[f][i + 1] = 1
+
+    def compareseq(self):
+        """Mark the lines that are not part of a longest common
+        subsequence of the lines that were not discarded.
+        """
+        xv, yv = self.undiscarded
+        nx, ny = len(xv), len(yv)
+        diags = nx + ny + 3
+        too_expensive = 1
+        while diags != 0:
+            too_expensive <<= 1
+            diags >>= 2
+        self.too_expensive = max(4096, too_expensive)
+        self.fd = [0] * (nx + ny + 3)
+        self.bd = [0] * (nx + ny + 3)
+        self.doff = ny + 1
+
+        changed0, changed1 = self.changed
+        real0, real1 = self.realindexes
+        stack = [(0, nx, 0, ny, False)]
+        while stack:
+            xoff, xlim, yoff, ylim, minimal = stack.pop()
+            while xoff < xlim and yoff < ylim and xv[xoff] == yv[yoff]:
+                xoff += 1
+                yoff += 1
+            while xoff < xlim and yoff < ylim \
+                    and xv[xlim - 1] == yv[ylim - 1]:
+                xlim -= 1
+                ylim -= 1
+
+            if xoff == xlim:
+                for y in xrange(yoff, ylim):
+                    changed1[real1[y] + 1] = 1
+            elif yoff == ylim:
+                for x in xrange(xoff, xlim):
+                    changed0[real0[x] + 1] = 1
+            else:
+                xmid, ymid, lo_minimal, hi_minimal = \
+                    self._diag(xoff, xlim, yoff, ylim, minimal)
+                # the order does not matter, only the marks
+                stack.append((xmid, xlim, ymid, ylim, hi_minimal))
+                stack.append((xoff, xmid, yoff, ymid, lo_minimal))
+
+    def _diag(self, xoff, xlim, yoff, ylim, find_minimal):
+        """Find the midpoint of the shortest edit script for a part of
+        the files, or give up at too_expensive and return a good guess.
+        """
+        fd, bd, o = self.fd, self.bd, self.doff
+        xv, yv = self.undiscarded
+        dmin = xoff - ylim
+        dmax = xlim - yoff
+        fmid = xoff - yoff
+        bmid = xlim - ylim
+        fmin = fmax = fmid
+        bmin = bmax = bmid
+        odd = (fmid - bmid) & 1
+
+        fd[o + fmid] = xoff
+        bd[o + bmid] = xlim
+
+        c = 0
+        while True:
+            c += 1
+
+            if fmin > dmin:
+                fmin -= 1
+                fd[o + fmin - 1] = -1
+            else:
+                fmin += 1
+            if fmax < dmax:
+                fmax += 1
+                fd[o + fmax + 1] = -1
+            else:
+                fmax -= 1
+            for d in xrange(fmax, fmin - 1, -2):
+                tlo = fd[o + d - 1]
+                thi = fd[o + d + 1]
+                x = thi if tlo < thi else tlo + 1
+                y = x - d
+                while x < xlim and y < ylim and xv[x] == yv[y]:
+                    x += 1
+                    y += 1
+                fd[o + d] = x
+                if odd and bmin <= d <= bmax and bd[o + d] <= x:
+                    return x, y, True, True
+
+            if bmin > dmin:
+                bmin -= 1
+                bd[o + bmin - 1] = sys.maxint
+            else:
+                bmin += 1
+            if bmax < dmax:
+                bmax += 1
+                bd[o + bmax + 1] = sys.maxint
+            else:
+                bmax -= 1
+            for d in xrange(bmax, bmin - 1, -2):
+                tlo = bd[o + d - 1]
+                thi = bd[o + d + 1]
+                x = tlo if tlo < thi else thi - 1
+                y = x - d
+                while xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+                    x -= 1
+                    y -= 1
+                bd[o + d] = x
+                if not odd and fmin <= d <= fmax and x <= fd[o + d]:
+                    return x, y, True, True
+
+            if find_minimal:
+                continue
+
+            if c >= self.too_expensive:
+                fxybest = -1
+                fxbest = 0
+                for d in xrange(fmax, fmin - 1, -2):
+                    x = min(fd[o + d], xlim)
+                    y = x - d
+                    if ylim < y:
+                        x = ylim + d
+                        y = ylim
+                    if fxybest < x + y:
+                        fxybest = x + y
+                        fxbest = x
+
+                bxybest = None
+                bxbest = 0
+                for d in xrange(bmax, bmin - 1, -2):
+                    x = max(xoff, bd[o + d])
+                    y = x - d
+                    if y < yoff:
+                        x = yoff + d
+                        y = yoff
+                    if bxybest is None or x + y < bxybest:
+                        bxybest = x + y
+                        bxbest = x
+
+                if (xlim + ylim) - bxybest < fxybest - (xoff + yoff):
+                    return fxbest, fxybest - fxbest, True, False
+                else:
+                    return bxbest, bxybest - bxbest, False, True
+
+    def shift_boundaries(self):
+        """Slide each run of changes as far as it will go, so that runs
+        merge where they can and otherwise line up with the other file.
+        """
+        for f in (0, 1):
+            # indexes here are shifted by one, for the zero at each end
+            changed = self.changed[f]
+            other_changed = self.changed[1 - f]
+            equivs = [None] + self.equivs[f]
+            i = 1
+            j = 1
+            i_end = len(changed) - 1
+
+            while True:
+                while i < i_end and not changed[i]:
+                    while other_changed[j]:
+                        j += 1
+                    j += 1
+                    i += 1
+
+                if i == i_end:
+                    break
+
+                start = i
+
+                i += 1
+                while changed[i]:
+                    i += 1
+                while other_changed[j]:
+                    j += 1
+
+                while True:
+                    runlength = i - start
+
+                    while start > 1 and equivs[start - 1] == equivs[i - 1]:
+                        start -= 1
+                        changed[start] = 1
+                        i -= 1
+                        changed[i] = 0
+                        while changed[start - 1]:
+                            start -= 1
+                        j -= 1
+                        while other_changed[j]:
+                            j -= 1
+
+                    corresponding = i if other_changed[j - 1] else i_end
+
+                    while i != i_end and equivs[start] == equivs[i]:
+                        changed[start] = 0
+                        start += 1
+                        changed[i] = 1
+                        i += 1
+                        while changed[i]:
+                            i += 1
+                        j += 1
+                        while other_changed[j]:
+                            corresponding = i
+                            j += 1
+
+                    if runlength == i - start:
+                        break
+
+                while corresponding < i:
+                    start -= 1
+                    changed[start] = 1
+                    i -= 1
+                    changed[i] = 0
+                    j -= 1
+                    while other_changed[j]:
+                        j -= 1
+
+    def build_script(self):
+        """Return the changes as (line0, deleted, line1, inserted)."""
+        changed0, changed1 = self.changed
+        script = []
+        i0 = len(changed0) - 2
+        i1 = len(changed1) - 2
+        while i0 >= 0 or i1 >= 0:
+            if changed0[i0] or changed1[i1]:
+                line0, line1 = i0, i1
+                while changed0[i0]:
+                    i0 -= 1
+                while changed1[i1]:
+                    i1 -= 1
+                script.append((i0, line0 - i0, i1, line1 - i1))
+            i0 -= 1
+            i1 -= 1
+        script.reverse()
+        return script
+
+
+def compare(a, b, horizon=CONTEXT):
+    """Compare two texts, and return the lines of each and the changes
+    between them as a list of (line0, deleted, line1, inserted), with
+    line numbers counted from 0. horizon is as diff --horizon-lines.
+    """
+    missing0 = a != '' and not a.endswith('\n')
+    missing1 = b != '' and not b.endswith('\n')
+    buf0 = a + '\n' if missing0 else a
+    buf1 = b + '\n' if missing1 else b
+    n0, n1 = len(buf0), len(buf1)
+
+    # find_identical_ends()
+    p0 = _common_prefix(buf0, buf1, min(n0, n1))
+    i = horizon
+    while p0 > 0:
+        if buf0[p0 - 1] == '\n':
+            if i == 0:
+                break
+            i -= 1
+        p0 -= 1
+    prefix_end = p0
+
+    s0, s1 = n0, n1
+    if missing0 == missing1:
+        beg0 = prefix_end + max(0, n0 - n1)
+        p0 = n0 - _common_suffix(buf0, buf1, n0 - beg0)
+        p1 = n1 - (n0 - p0)
+        at_start = (p0 == 0 or buf0[p0 - 1] == '\n') \
+            and (p1 == 0 or buf1[p1 - 1] == '\n')
+        beg0 = p0
+        i = horizon + (0 if at_start else 1)
+        while i > 0 and p0 != n0:
+            i -= 1
+            p0 = buf0.index('\n', p0) + 1
+        s0 = p0
+        s1 = p1 + (p0 - beg0)
+
+    prefix_lines = buf0.count('\n', 0, prefix_end)
+    lines0 = _split(buf0, 0, n0, missing0)
+    lines1 = _split(buf1, 0, n1, missing1)
+    mid0 = buf0.count('\n', prefix_end, s0)
+    mid1 = buf1.count('\n', prefix_end, s1)
+
+    classes = {}
+    equivs = ([], [])
+    for f, lines, count in ((0, lines0, mid0), (1, lines1, mid1)):
+        for line in lines[prefix_lines:prefix_lines + count]:
+            e = classes.get(line)
+            if e is None:
+                e = classes[line] = len(classes) + 1
+            equivs[f].append(e)
+
+    analysis = _Analysis(equivs[0], equivs[1])
+    analysis.discard_confusing_lines()
+    analysis.compareseq()
+    analysis.shift_boundaries()
+    script = [(line0 + prefix_lines, deleted, line1 + prefix_lines, inserted)
+              for line0, deleted, line1, inserted in analysis.build_script()]
+    return lines0, lines1, script
+
+
+def _group(script, context):
+    """Split script into hunks as find_hunk() does."""
+    hunks = []
+    current = []
+    for change in script:
+        if current:
+            top0 = current[-1][0] + current[-1][1]
+            if change[0] - top0 >= 2 * context + 1:
+                hunks.append(current)
+                current = []
+        current.append(change)
+    if current:
+        hunks.append(current)
+    return hunks
+
+
+def _range(first, last):
+    a, b = first + 1, last + 1
+    if b <= a:
+        return ('%d,0' if b < a else '%d') % b
+    return '%d,%d' % (a, b - a + 1)
+
+
+def _line(out, mark, line):
+    out.append(mark)
+    out.append(line)
+    if not line.endswith('\n'):
+        out.append('\n\\ No newline at end of file\n')
+
+
+def unified_hunks(a, b, context=CONTEXT, function=True):
+    """Return the hunks of "diff -u" (and -p, if function is True)
+    between the texts a and b, without the file header, as a string.
+    """
+    lines0, lines1, script = compare(a, b, max(context, CONTEXT))
+    out = []
+    last_search = 0
+    last_match = None
+    for hunk in _group(script, context):
+        first0 = max(hunk[0][0] - context, 0)
+        first1 = max(hunk[0][2] - context, 0)
+        last0 = min(hunk[-1][0] + hunk[-1][1] - 1 + context, len(lines0) - 1)
+        last1 = min(hunk[-1][2] + hunk[-1][3] - 1 + context, len(lines1) - 1)
+
+        out.append('@@ -%s +%s @@' % (_range(first0, last0),
+                                      _range(first1, last1)))
+        if function:
+            # find_function()
+            found = None
+            for i in xrange(first0 - 1, last_search - 1, -1):
+                if FUNCTION_RE.match(lines0[i]):
+                    found = last_match = i
+                    break
+            last_search = first0
+            if found is None:
+                found = last_match
+            if found is not None:
+                text = lines0[found].split('\n', 1)[0][:40].rstrip(' \t\n\v\f\r')
+                out.append(' ' + text)
+        out.append('\n')
+
+        i, j = first0, first1
+        changes = list(hunk)
+        while i <= last0 or j <= last1:
+            if not changes or i < changes[0][0]:
+                _line(out, ' ', lines0[i])
+                i += 1
+                j += 1
+            else:
+                line0, deleted, line1, inserted = changes.pop(0)
+                for k in xrange(deleted):
+                    _line(out, '-', lines0[i])
+                    i += 1
+                for k in xrange(inserted):
+                    _line(out, '+', lines1[j])
+                    j += 1
+    return ''.join(out)
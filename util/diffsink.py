@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/diffsink.py - write diffs within a budget
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A file object that passes the output of "diff -pruN" on, counting
+what it changes in each file, until it has written as many bytes or
+hunks as it may.  After that, hunks are only counted, and once closed it
+ends the diff with how many lines the files it left out changed.
+
+Hunks are written whole or not at all, so a cut short diff still applies
+as far as it goes; the one being written is held back until it is
+complete, which takes no more memory than the byte budget.
+"""
+
+# How much of a hunk is held back at a time without a byte budget
+_CHUNK = 65536
+
+
+class FileStat(object):
+    """What a diff changes in one file."""
+
+    __slots__ = ('name', 'insertions', 'deletions', 'binary', 'omitted')
+
+    def __init__(self, name=None, binary=False):
+        self.name = name
+        self.insertions = 0
+        self.deletions = 0
+        self.binary = binary
+        self.omitted = False
+
+
+def _strip_label(name):
+    """Return a file name from a diff header without its first component,
+    the label of the tree it is in.
+    """
+    quoted = name.startswith('"') and name.endswith('"') and len(name) > 1
+    if quoted:
+        name = name[1:-1]
+    return name.split('/', 1)[-1]
+
+
+def _binary_name(line):
+    """Return the file named by a "Binary files A and B differ" line."""
+    names = line[len('Binary files '):-len(' differ\n')]
+    halves = names.split(' and ')
+    # file names may hold " and " too; both name the same file
+    for i in range(1, len(halves)):
+        a = _strip_label(' and '.join(halves[:i]))
+        b = _strip_label(' and '.join(halves[i:]))
+        if a == b:
+            return b
+    return _strip_label(names)
+
+
+class DiffSink(object):
+    """Write a diff to out, keeping to at most max_bytes and max_hunks
+    (None for no limit) before the summary of what was left out.
+    """
+
+    def __init__(self, out, max_bytes=None, max_hunks=None):
+        self.out = out
+        self.max_bytes = max_bytes
+        self.max_hunks = max_hunks
+        self.written = 0
+        self.hunks = 0
+        self.truncated = False
+        self.files = []
+        self._partial = ''
+        self._pending = []
+        self._pending_size = 0
+        self._pending_hunk = False
+        self._current = None
+        self._state = None
+
+    def write(self, data):
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line + '\n')
+
+    def close(self):
+        """Write what is held back, and the summary if the diff was cut
+        short.  out is left open.
+        """
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ''
+        self._flush()
+        if self.truncated:
+            self.out.write(self.summary())
+
+    def _line(self, line):
+        if self._state == 'hunk' and line[:1] in ' +-\\':
+            if line.startswith('+'):
+                self._current.insertions += 1
+            elif line.startswith('-'):
+                self._current.deletions += 1
+            self._pend(line)
+            return
+
+        # anything else ends the hunk; a file's header is held back
+        # with its first hunk
+        if self._state == 'hunk':
+            self._flush()
+        if line.startswith('diff '):
+            self._flush()
+            self._start(FileStat(), 'header')
+            self._pend(line)
+        elif line.startswith('Binary files ') \
+                and line.endswith(' differ\n'):
+            if self._state != 'header' or self._current.name is not None:
+                self._start(FileStat(), None)
+            self._current.name = _binary_name(line)
+            self._current.binary = True
+            self._pend(line)
+            self._flush()
+            self._state = None
+        elif self._state == 'header' and line.startswith('+++ '):
+            self._current.name = _strip_label(line[4:].split('\t')[0]
+                                              .rstrip('\n'))
+            self._pend(line)
+        elif self._state == 'header' and line.startswith('--- '):
+            self._pend(line)
+        elif self._current is not None and line.startswith('@@ '):
+            if self.max_hunks is not None and self.hunks >= self.max_hunks:
+                self._truncate()
+            self._state = 'hunk'
+            self._pend(line)
+            self._pending_hunk = not self.truncated
+        else:
+            self._flush()
+            self._state = None
+            self._pend(line)
+            self._flush()
+
+    def _start(self, stat, state):
+        self.files.append(stat)
+        self._current = stat
+        self._state = state
+        if self.truncated:
+            stat.omitted = True
+
+    def _pend(self, line):
+        if self.truncated:
+            return
+        self._pending.append(line)
+        self._pending_size += len(line)
+        if self.max_bytes is None:
+            # only a file's header need be held back, for max_hunks
+            if self._state == 'hunk' and self._pending_size >= _CHUNK:
+                self._flush()
+        elif self.written + self._pending_size > self.max_bytes:
+            self._truncate()
+
+    def _flush(self):
+        """Write the lines held back, which end a hunk or stand alone."""
+        if not self._pending:
+            return
+        # a hunk counts once, however many times it is flushed
+        if self._pending_hunk:
+            self.hunks += 1
+        self.out.write(''.join(self._pending))
+        self.written += self._pending_size
+        self._pending = []
+        self._pending_size = 0
+        self._pending_hunk = False
+
+    def _truncate(self):
+        self.truncated = True
+        self._pending = []
+        self._pending_size = 0
+        self._pending_hunk = False
+        if self._state is not None:
+            self._current.omitted = True
+
+    def stats(self):
+        """Return the totals of what the diff changes, as a dict."""
+        return {
+            'files': len(self.files),
+            'insertions': sum(stat.insertions for stat in self.files),
+            'deletions': sum(stat.deletions for stat in self.files),
+            'binary': len([stat for stat in self.files if stat.binary]),
+            'truncated': self.truncated,
+        }
+
+    def summary(self):
+        """Return the lines ending a diff that was cut short: a diffstat
+        of the files whose changes were left out, in whole or in part.
+        """
+        omitted = [stat for stat in self.files if stat.omitted]
+        return ('Diff truncated after %d bytes and %d hunks; '
+                'changes to %d files are left out:\n'
+                % (self.written, self.hunks, len(omitted))
+                + format_diffstat(omitted))
+
+
+def format_diffstat(stats):
+    """Return a diffstat of the FileStats in stats: a line for each file
+    with how many lines it changes, then the totals.
+    """
+    lines = []
+    width = max([len(stat.name or '') for stat in stats] + [0])
+    for stat in stats:
+        if stat.binary:
+            change = 'Bin'
+        else:
+            change = '%d +%d -%d' % (stat.insertions + stat.deletions,
+                                     stat.insertions, stat.deletions)
+        lines.append(' %-*s | %s\n' % (width, stat.name or '?', change))
+    lines.append(' %d files changed, %d insertions(+), %d deletions(-)\n'
+                 % (len(stats), sum(stat.insertions for stat in stats),
+                    sum(stat.deletions for stat in stats)))
+    return ''.join(lines)
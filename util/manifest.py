@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/manifest.py - what is in an unpacked tree, worked out once
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Manifests of directory trees that are not modified once they exist,
+such as those in the unpack cache: the type, mode, size, symlink target
+and MD5 of everything in the tree, so that comparing trees does not
+take a stat() and a read of every file each time.
+
+The manifest of a tree at PATH is kept in PATH.manifest, one line per
+entry holding its mode, size, device number, MD5 (or "-"), symlink
+target (or "-") and path, the last two escaped so that neither holds a
+newline, nor the target a space.
+"""
+
+from __future__ import with_statement
+
+import errno
+import heapq
+import itertools
+import os
+import stat
+from hashlib import md5
+
+from util import tree
+
+# Manifests read recently, which are used again and again while merging
+# a package: {real path of the tree: Manifest}
+_manifests = {}
+_MANIFESTS_KEPT = 8
+
+
+def md5_file(filename):
+    """Return the MD5 of a file's contents."""
+    h = md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _escape(s):
+    s = s.encode('string_escape').replace(' ', '\\x20')
+    return '\\x2d' if s == '-' else s
+
+
+class Entry(object):
+    """Something in a tree, with the attributes of the os.lstat() result
+    that comparing trees looks at.
+    """
+
+    __slots__ = ('st_mode', 'st_size', 'st_rdev', 'digest', 'linkname')
+
+    def __init__(self, st_mode, st_size, st_rdev=0, digest=None,
+                 linkname=None):
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_rdev = st_rdev
+        self.digest = digest
+        self.linkname = linkname
+
+
+class Manifest(object):
+    """What is in the tree at root: {path relative to root: Entry}, for
+    everything os.walk() finds without following symlinks, and the paths
+    util.tree.walk() returns, in the same order.
+
+    Paths the manifest cannot answer for, which lead through a symlink,
+    are looked up in the tree itself.
+    """
+
+    def __init__(self, root, entries, paths):
+        self.root = root
+        self.entries = entries
+        self.paths = paths
+
+    @classmethod
+    def scan(cls, root):
+        """Return the Manifest of the tree at root, reading every file."""
+        entries = {}
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            base = tree.subdir(root, dirpath)
+            for name in filenames:
+                path = os.path.join(base, name)
+                entries[path] = cls.entry(os.path.join(dirpath, name))
+                paths.append(path)
+            for name in list(dirnames):
+                path = os.path.join(base, name)
+                entries[path] = cls.entry(os.path.join(dirpath, name))
+                if stat.S_ISLNK(entries[path].st_mode):
+                    dirnames.remove(name)
+                    paths.append(path)
+        return cls(root, entries, paths)
+
+    @staticmethod
+    def entry(filename):
+        """Return the Entry for filename."""
+        st = os.lstat(filename)
+        digest = linkname = None
+        if stat.S_ISREG(st.st_mode):
+            try:
+                digest = md5_file(filename)
+            except IOError as e:
+                # digest() reads it, if it is ever made readable
+                if e.errno != errno.EACCES:
+                    raise
+        elif stat.S_ISLNK(st.st_mode):
+            linkname = os.readlink(filename)
+        return Entry(st.st_mode, st.st_size, st.st_rdev, digest, linkname)
+
+    @classmethod
+    def load(cls, root, filename):
+        """Return the Manifest of the tree at root saved in filename."""
+        entries = {}
+        paths = []
+        with open(filename) as f:
+            for line in f:
+                mode, size, rdev, digest, linkname, path = \
+                    line.rstrip('\n').split(' ', 5)
+                path = path.decode('string_escape')
+                entry = Entry(int(mode, 8), int(size), int(rdev),
+                              None if digest == '-' else digest,
+                              None if linkname == '-'
+                              else linkname.decode('string_escape'))
+                entries[path] = entry
+                if not stat.S_ISDIR(entry.st_mode):
+                    paths.append(path)
+        return cls(root, entries, paths)
+
+    def save(self, filename):
+        """Save the manifest to filename."""
+        # files first, in walk() order, so that load() can tell it
+        dirs = [path for path, entry in self.entries.iteritems()
+                if stat.S_ISDIR(entry.st_mode)]
+        order = self.paths + sorted(dirs)
+        new = "%s.new.%d" % (filename, os.getpid())
+        with open(new, 'w') as f:
+            for path in order:
+                entry = self.entries[path]
+                linkname = '-'
+                if entry.linkname is not None:
+                    linkname = _escape(entry.linkname)
+                f.write('%o %d %d %s %s %s\n'
+                        % (entry.st_mode, entry.st_size, entry.st_rdev,
+                           entry.digest or '-', linkname,
+                           path.encode('string_escape')))
+        os.rename(new, filename)
+
+    def size(self):
+        """Return the total size of everything but directories."""
+        return sum(entry.st_size for entry in self.entries.itervalues()
+                   if not stat.S_ISDIR(entry.st_mode))
+
+    def walk(self):
+        """Return what util.tree.walk(root) would."""
+        return list(self.paths)
+
+    def _known(self, path):
+        """Return whether path is in the manifest, or whether it can't
+        be because it is under a symlink.
+        """
+        if path in self.entries:
+            return True
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            entry = self.entries.get('/'.join(parts[:i]))
+            if entry is not None and stat.S_ISLNK(entry.st_mode):
+                return False
+        return True
+
+    def lstat(self, path):
+        """Return the Entry for path (or what os.lstat() does, if it
+        leads through a symlink), or None if there is nothing there.
+        """
+        if self._known(path):
+            return self.entries.get(path)
+        try:
+            return os.lstat(os.path.join(self.root, path))
+        except OSError:
+            return None
+
+    def exists(self, path):
+        """Return what util.tree.exists() would for path in the tree."""
+        return self.lstat(path) is not None
+
+    def isfile(self, path):
+        """Return whether path is a regular file, and not a symlink."""
+        st = self.lstat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def digest(self, path):
+        """Return the MD5 of the regular file at path."""
+        entry = self.entries.get(path)
+        if entry is not None and entry.digest is not None:
+            return entry.digest
+        return md5_file(os.path.join(self.root, path))
+
+    def readlink(self, path):
+        """Return the target of the symlink at path."""
+        entry = self.entries.get(path)
+        if entry is not None and entry.linkname is not None:
+            return entry.linkname
+        return os.readlink(os.path.join(self.root, path))
+
+    def listing(self):
+        """Return (path split into its components, path, Entry) for
+        everything in the manifest, sorted so that what is under a
+        directory comes straight after it.
+        """
+        return sorted((path.split('/'), path, entry)
+                      for path, entry in self.entries.iteritems())
+
+
+def join(manifests):
+    """Go through the listings of several manifests side by side, and
+    yield (path, listed, entries) for every path in any of them, in the
+    order of their listings. For each manifest, listed says whether the
+    path is in it, and entries holds what its lstat() returns for the
+    path; the tree itself is only looked at for paths that lead through
+    one of its symlinks.
+    """
+    listings = [[(key, i, path, entry) for key, path, entry in m.listing()]
+                for i, m in enumerate(manifests)]
+    # the symlink in each manifest that the paths at hand may be under
+    symlinks = [None] * len(manifests)
+
+    merged = heapq.merge(*listings)
+    for key, group in itertools.groupby(merged, lambda item: item[0]):
+        listed = [False] * len(manifests)
+        entries = [None] * len(manifests)
+        for key, i, path, entry in group:
+            listed[i] = True
+            entries[i] = entry
+        for i, m in enumerate(manifests):
+            link = symlinks[i]
+            if listed[i]:
+                if stat.S_ISLNK(entries[i].st_mode):
+                    symlinks[i] = key
+                elif link is not None and key[:len(link)] != link:
+                    symlinks[i] = None
+            elif link is not None:
+                if key[:len(link)] == link:
+                    entries[i] = m.lstat(path)
+                else:
+                    symlinks[i] = None
+        yield path, listed, entries
+
+
+def manifest_file(path):
+    """Return where the manifest of the tree at path is kept."""
+    return tree.as_file(path) + ".manifest"
+
+def for_tree(path, fresh=False):
+    """Return the Manifest of the tree at path, which may be a symlink to
+    it. The saved one is used if there is one, otherwise the tree is
+    scanned; either way that is only done again if fresh is True, so
+    the tree must not be modified in between.
+    """
+    root = os.path.realpath(path)
+    manifest = None if fresh else _manifests.get(root)
+    if manifest is None:
+        try:
+            manifest = Manifest.load(root, manifest_file(root))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            manifest = Manifest.scan(root)
+        if len(_manifests) >= _MANIFESTS_KEPT:
+            _manifests.clear()
+        _manifests[root] = manifest
+    return manifest
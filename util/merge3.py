@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/merge3.py - merge files the way diff3 does
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Three-way merge producing the same output as "diff3 -E -m".
+
+diff3 runs diff from each of the two changed files to the common one,
+and combines the changes that overlap or touch in the common file into
+blocks; this does the same with util.diff, so that its results, and
+where its conflicts fall, are those of diff3 itself. As there, text is
+handled as bytes, whatever its encoding, and files diff would take as
+binary (which includes text in UTF-16 and UTF-32) are not merged.
+
+diff3 brackets incomplete last lines in ways that are not worth
+following here; texts with one raise Unsupported, and diff3 should be
+run on them instead.
+"""
+
+from __future__ import with_statement
+
+import os
+
+from util import diff
+
+# diff3 runs diff with --horizon-lines=100
+HORIZON = 100
+
+
+class Unsupported(Exception):
+    """The texts should be merged by diff3 itself."""
+    pass
+
+
+class Binary(Exception):
+    """One of the files is binary, so diff3 would refuse to merge them."""
+    pass
+
+
+def _changes(other, common):
+    """Return the lines of other, and the changes diff finds from other
+    to common as a list of (common_start, common_end, other_start,
+    other_end), with line numbers counted from 0.
+    """
+    lines, _, script = diff.compare(other, common, HORIZON)
+    return lines, [(line1, line1 + inserted, line0, line0 + deleted)
+                   for line0, deleted, line1, inserted in script]
+
+
+def _blocks(changes0, changes1):
+    """Combine the changes from two files to the common one, as
+    make_3way_diff() does, into blocks of (used0, start0, end0, used1,
+    start1, end1): the lines of each file, and whether it has changes in
+    them.
+    """
+    threads = (changes0, changes1)
+    taken = [0, 0]
+    # where the last block ended in the common file and the two others
+    last = (0, 0, 0)
+    while taken[0] < len(changes0) or taken[1] < len(changes1):
+        if taken[0] == len(changes0):
+            high = 1
+        elif taken[1] == len(changes1):
+            high = 0
+        else:
+            high = int(changes0[taken[0]][0] > changes1[taken[1]][0])
+        using = ([], [])
+        using[high].append(threads[high][taken[high]])
+        taken[high] += 1
+        start = using[high][0][0]
+        mark = using[high][0][1]
+
+        # take in the changes of either file that overlap or touch the
+        # block in the common file, until it stops growing
+        other = 1 - high
+        while taken[other] < len(threads[other]) \
+                and threads[other][taken[other]][0] <= mark:
+            change = threads[other][taken[other]]
+            using[other].append(change)
+            taken[other] += 1
+            if mark < change[1]:
+                high = other
+                mark = change[1]
+            other = 1 - high
+
+        block = []
+        for f in (0, 1):
+            if using[f]:
+                first, final = using[f][0], using[f][-1]
+                block.extend((True, start - first[0] + first[2],
+                              mark - final[1] + final[3]))
+            else:
+                block.extend((False, start - last[0] + last[f + 1],
+                              mark - last[0] + last[f + 1]))
+        last = (mark, block[2], block[5])
+        yield tuple(block)
+
+
+def merge(mine, older, yours, mine_label, yours_label, blksize=4096):
+    """Merge the changes from older to yours into mine, as "diff3 -E -m"
+    does with the same labels, and return the text, with conflicts
+    bracketed, and whether there were any.
+
+    Raise Binary if diff, with blocks of blksize, would take any of the
+    texts as binary, and Unsupported if diff3 should merge them instead.
+    """
+    for text in (mine, older, yours):
+        if diff.is_binary(text, blksize):
+            raise Binary
+    for text in (mine, older, yours):
+        if text and not text.endswith('\n'):
+            raise Unsupported('incomplete last line')
+
+    lines0, changes0 = _changes(mine, older)
+    lines1, changes1 = _changes(yours, older)
+    out = []
+    conflicts = False
+    done = 0
+    for used0, start0, end0, used1, start1, end1 in _blocks(changes0,
+                                                            changes1):
+        if not used1:
+            # only mine changed, so it stands
+            continue
+        elif not used0:
+            out.extend(lines0[done:start0])
+            out.extend(lines1[start1:end1])
+        elif lines0[start0:end0] == lines1[start1:end1]:
+            # both made the same change
+            continue
+        else:
+            conflicts = True
+            out.extend(lines0[done:start0])
+            out.append('<<<<<<< %s\n' % mine_label)
+            out.extend(lines0[start0:end0])
+            out.append('=======\n')
+            out.extend(lines1[start1:end1])
+            out.append('>>>>>>> %s\n' % yours_label)
+        done = end0
+    out.extend(lines0[done:])
+    return ''.join(out), conflicts
+
+
+def merge_files(mine, older, yours, mine_label, yours_label, out):
+    """Merge the files mine, older and yours as merge() does, write the
+    result to the file object out and return whether there were conflicts.
+    Raise Binary or Unsupported, before anything is written, as merge()
+    does.
+    """
+    texts = []
+    for filename in (mine, older, yours):
+        with open(filename, 'rb') as f:
+            blksize = os.fstat(f.fileno()).st_blksize
+            texts.append(f.read())
+    text, conflicts = merge(texts[0], texts[1], texts[2], mine_label,
+                            yours_label, blksize)
+    out.write(text)
+    return conflicts
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/parallel.py - run independent jobs in a pool of processes
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import errno
+import fcntl
+import logging
+import multiprocessing
+import time
+from contextlib import contextmanager
+
+from util import tree
+
+logger = logging.getLogger('util.parallel')
+
+# (func, items, label) for the pool's workers, which inherit it when they
+# are forked, so that neither func nor the items need to be picklable
+_work = None
+
+
+@contextmanager
+def flocked(filename, wait=True):
+    """Hold an exclusive lock on filename, which is created if needed,
+    for the duration of the with block. Unless wait is True, a lock held
+    by someone else is not waited for; the with block gets whether the
+    lock is held.
+    """
+    tree.ensure(filename)
+    with open(filename, "a") as f:
+        try:
+            fcntl.flock(f.fileno(),
+                        fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked = True
+        except IOError as e:
+            if wait or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            locked = False
+        if not locked:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class _Capture(logging.Handler):
+    """Keeps log records so that they can be sent to another process."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # make the record picklable
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        self.records.append(record)
+
+
+def _run_one(index):
+    func, items, label = _work
+    root = logging.getLogger()
+    capture = _Capture()
+    saved = root.handlers[:]
+    root.handlers = [capture]
+    try:
+        try:
+            return func(items[index]), False, capture.records
+        except Exception:
+            logger.exception("%s failed", label(items[index]))
+            return None, True, capture.records
+    finally:
+        root.handlers = saved
+
+
+def run_jobs(func, items, jobs=1, label=str, started=None):
+    """Call func(item) for each of items, running up to jobs of them at
+    once in forked processes. An exception raised by func is logged and
+    does not affect the other items. started(), if given, is called here
+    once the processes have been forked, and before anything else is
+    done if there are none, to start threads they must not inherit.
+
+    Whatever func logs in a worker process is held back until it
+    returns, then logged here with label(item) in front of each message,
+    in the order of items, so the log does not depend on scheduling.
+
+    Return a list of (item, result, failed) in the order of items, where
+    result is what func returned (which must be picklable), or None if
+    it raised an exception, in which case failed is True.
+    """
+    global _work
+
+    start = time.time()
+    results = []
+    if jobs <= 1 or len(items) <= 1:
+        if started is not None:
+            started()
+        for item in items:
+            try:
+                results.append((item, func(item), False))
+            except Exception:
+                logger.exception("%s failed", label(item))
+                results.append((item, None, True))
+    else:
+        _work = (func, items, label)
+        pool = multiprocessing.Pool(min(jobs, len(items)))
+        try:
+            if started is not None:
+                started()
+            outcomes = pool.imap(_run_one, range(len(items)))
+            for item, (result, failed, records) in zip(items, outcomes):
+                prefix = label(item)
+                for record in records:
+                    record.msg = "%s: %s" % (prefix, record.msg)
+                    logging.getLogger(record.name).handle(record)
+                results.append((item, result, failed))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _work = None
+
+    elapsed = time.time() - start
+    if items:
+        logger.info("Processed %d items in %.1fs (%.2f per second, "
+                    "%d failed) with %d jobs", len(items), elapsed,
+                    len(items) / max(elapsed, 0.001),
+                    len([r for r in results if r[2]]), max(jobs, 1))
+    return results
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/scratch.py - short-lived trees in RAM, within a budget
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Scratch space for trees that are written, read a few times and
+removed again, such as merge results and the directories source
+packages are built in.
+
+They go in a directory on a RAM filesystem such as tmpfs, as long as
+the bytes reserved for them there stay within a budget; anything that
+would not fit goes on disk instead, where it would have gone anyway.
+
+Each tree NAME in the scratch directory comes with a file NAME.reserved
+holding the pid of the process that made it and the bytes reserved for
+it, which every process using the directory adds up, under a lock, to
+see what room is left. The trees of processes that have died are
+removed the next time space is reserved.
+"""
+
+from __future__ import with_statement
+
+import errno
+import logging
+import os
+import tempfile
+import threading
+
+from util import tree
+from util.parallel import flocked
+
+logger = logging.getLogger('util.scratch')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Scratch(object):
+    """Scratch space in directory (None for none, so that everything
+    goes on disk) for up to budget bytes (None for no limit but the size
+    of the filesystem).
+    """
+
+    def __init__(self, directory, budget=None):
+        self.directory = directory
+        self.budget = budget
+        # the most bytes reserved at once, by every process together,
+        # that this one has seen
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def _reservations(self):
+        """Return {name: bytes} for the trees in the scratch directory,
+        removing those whose process has died. The lock must be held.
+        """
+        reserved = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return reserved
+        for name in names:
+            if not name.endswith(".reserved"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    pid, size = [int(field) for field in f.read().split()]
+            except (IOError, ValueError):
+                continue
+            if _alive(pid):
+                reserved[name[:-len(".reserved")]] = size
+            else:
+                tree.remove(path[:-len(".reserved")])
+                os.unlink(path)
+        return reserved
+
+    def _reserve(self, size, prefix):
+        """Make a tree for size bytes in the scratch directory, and
+        return its path, or None if there is no room for it.
+        """
+        if self.directory is None:
+            return None
+        tree.ensure(os.path.join(self.directory, ".lock"))
+        with self._lock:
+            with flocked(os.path.join(self.directory, ".lock")):
+                used = sum(self._reservations().values())
+                st = os.statvfs(self.directory)
+                if size > st.f_bavail * st.f_frsize \
+                        or (self.budget is not None
+                            and used + size > self.budget):
+                    logger.debug("No room for %d more bytes in %s, with "
+                                 "%d in use", size, self.directory, used)
+                    return None
+
+                path = tempfile.mkdtemp(prefix=prefix, dir=self.directory)
+                with open(path + ".reserved", "w") as f:
+                    f.write("%d %d\n" % (os.getpid(), size))
+                self.peak = max(self.peak, used + size)
+        return path
+
+    def reserved(self, path):
+        """Return how many bytes are reserved for the tree at path, or
+        None if it is not in the scratch space.
+        """
+        path = os.path.realpath(path)
+        if self.directory is None \
+                or os.path.dirname(path) != os.path.realpath(self.directory):
+            return None
+        try:
+            with open(path + ".reserved") as f:
+                return int(f.read().split()[1])
+        except (IOError, ValueError, IndexError):
+            return None
+
+    def mkdtemp(self, size, fallback, prefix="tmp"):
+        """Return a new empty directory for a tree of about size bytes:
+        in the scratch space if there is room, otherwise in fallback, as
+        it is if size is None.  It is removed with remove().
+        """
+        path = None
+        if size is not None:
+            path = self._reserve(size, prefix)
+        if path is None:
+            if not os.path.isdir(fallback):
+                os.makedirs(fallback)
+            path = tempfile.mkdtemp(prefix=prefix, dir=fallback)
+        return path
+
+    def place(self, path, size):
+        """Replace whatever is at path with an empty directory for a tree
+        of about size bytes: a symlink to one in the scratch space if
+        there is room, otherwise a directory at path itself, as it is if
+        size is None.  It is removed with remove().
+        """
+        self.remove(path)
+        tree.ensure(path)
+        scratch = None
+        if size is not None:
+            scratch = self._reserve(size, os.path.basename(path) + ".")
+        if scratch is None:
+            os.mkdir(path)
+        else:
+            os.symlink(scratch, path)
+        return path
+
+    def remove(self, path):
+        """Remove the tree at path, and the one in the scratch space it
+        is, or is a symlink to, freeing its space.
+        """
+        target = path
+        if os.path.islink(path):
+            target = os.path.realpath(path)
+        if self.reserved(target) is not None:
+            tree.remove(target)
+            os.unlink(target + ".reserved")
+        tree.remove(path)
+
+    def report(self):
+        """Log how much of the scratch space was in use at most."""
+        if self.directory is None or not self.peak:
+            return
+        if self.budget is None:
+            logger.info("At most %d MiB of scratch space was in use",
+                        self.peak >> 20)
+        else:
+            logger.info("At most %d MiB of %d MiB of scratch space was "
+                        "in use", self.peak >> 20, self.budget >> 20)
@@ -20,6 +20,11 @@
 import os
 import shutil
 import errno
+import fcntl
+
+# ioctl that makes one file share another's data on copy-on-write
+# filesystems such as btrfs and XFS
+FICLONE = 0x40049409
 
 
 def as_dir(path):
@@ -131,6 +136,32 @@ def copyfile(srcpath, dstpath, link=False, dereference=False):
     else:
         shutil.copy2(srcpath, dstpath)
 
+def clone(srcpath, dstpath):
+    """Make dstpath a copy of the file at srcpath as cheaply as possible.
+
+    The copy is a hardlink if that is allowed, otherwise a reflink if the
+    filesystem supports them, otherwise a plain copy.  Returns which of
+    "link", "reflink" or "copy" was made.
+    """
+    try:
+        os.link(srcpath, dstpath)
+        return "link"
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+
+    with open(srcpath, "rb") as src:
+        with open(dstpath, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except IOError, e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP,
+                                   errno.EINVAL, errno.ENOTTY):
+                    raise
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+    return "copy"
+
 def movetree(path, newpath, eat_toplevel=False):
     """Move the contents of one tree into another.
 
@@ -205,4 +236,9 @@ def ensure(path):
     """Ensure that the parent directories for path exist."""
     dirname = os.path.dirname(path)
     if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+        try:
+            os.makedirs(dirname)
+        except OSError, e:
+            # somebody else may have created it in the meantime
+            if e.errno != errno.EEXIST:
+                raise
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# util/unpackcache.py - keep unpacked trees around between uses
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of version 3 of the GNU General Public License as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import with_statement
+
+import errno
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from util import tree
+from util.manifest import Manifest, manifest_file
+
+logger = logging.getLogger('util.unpackcache')
+
+# what _build() leaves behind if the process dies while building
+PARTIAL = re.compile(r"\.new\.(\d+)$")
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class UnpackCache(object):
+    """Directory trees kept in a cache directory, one per key, so that
+    something that takes a while to unpack only has to be unpacked once.
+
+    Each entry KEY comes with a file KEY.lock, which records the size of
+    the tree and whose modification time is when the entry was last
+    used. Anybody using an entry holds a shared lock on that file, from
+    acquire() until release(), so that evict() can tell which entries it
+    is free to remove: those it can lock exclusively. This works across
+    processes, but within a process entries are counted, since the locks
+    belong to the open file.
+
+    The least recently used entries are evicted whenever a new one takes
+    the cache over its budget, in bytes (None for no limit).
+
+    Entries may be acquired from several threads at once. No more than
+    slots of them (None for no limit) are built at a time, by all the
+    processes and threads using the cache together.
+    """
+
+    def __init__(self, directory, budget=None, slots=None):
+        self.directory = directory
+        self.budget = budget
+        self.slots = slots
+        self._pid = os.getpid()
+        # {key: [fd, count]}
+        self._held = {}
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _lockfile(self, key):
+        return self.path(key) + ".lock"
+
+    def _forked(self):
+        # the locks held by the parent are not ours to release, although
+        # we share them, so only remember what this process acquires
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._held = {}
+
+    def _open_locked(self, key, operation):
+        """Open KEY.lock and lock it. Return the file descriptor, or None
+        if operation includes LOCK_NB and the file is locked.
+        """
+        lockfile = self._lockfile(key)
+        tree.ensure(lockfile)
+        while True:
+            fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0664)
+            try:
+                fcntl.flock(fd, operation)
+            except IOError as e:
+                os.close(fd)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return None
+                raise
+            # evict() may have removed the file while we were waiting
+            try:
+                if os.fstat(fd).st_ino == os.stat(lockfile).st_ino:
+                    return fd
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+
+    def acquire(self, key, build):
+        """Return the directory holding the tree for key, first calling
+        build(path) to create it at path if it is not in the cache. The
+        entry will not be evicted until release(key) is called as many
+        times as acquire(key) was.
+
+        The tree's util.manifest.Manifest is saved next to it, for
+        util.manifest.for_tree(); build may return it, if it has one,
+        rather than have the tree scanned again.
+        """
+        self._forked()
+        entry = self.path(key)
+        with self._lock:
+            if key in self._held:
+                self._held[key][1] += 1
+                os.utime(self._lockfile(key), None)
+                return entry
+
+        fd = self._open_locked(key, fcntl.LOCK_SH)
+        built = False
+        try:
+            if not os.path.isdir(entry):
+                # converting the lock lets go of it first, so check again
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not os.path.isdir(entry):
+                    with self._slot():
+                        self._build(fd, key, build)
+                    built = True
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            os.utime(self._lockfile(key), None)
+        except:
+            os.close(fd)
+            raise
+        with self._lock:
+            if key in self._held:
+                # another thread got there first; its lock will do
+                self._held[key][1] += 1
+                os.close(fd)
+            else:
+                self._held[key] = [fd, 1]
+
+        if built and self.budget is not None:
+            self.evict(self.budget)
+        return entry
+
+    @contextmanager
+    def _slot(self):
+        """Hold one of the slots for building entries, waiting for one
+        to come free if they are all in use.
+        """
+        if self.slots is None:
+            yield
+            return
+        delay = 0.05
+        while True:
+            for i in range(self.slots):
+                fd = self._open_locked("slots/%d" % i,
+                                       fcntl.LOCK_EX | fcntl.LOCK_NB)
+                if fd is not None:
+                    try:
+                        yield
+                    finally:
+                        os.close(fd)
+                    return
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def _build(self, fd, key, build):
+        entry = self.path(key)
+        partial = "%s.new.%d" % (entry, os.getpid())
+        tree.remove(partial)
+        try:
+            manifest = build(partial)
+            if manifest is None:
+                manifest = Manifest.scan(partial)
+            manifest.save(manifest_file(entry))
+            size = manifest.size()
+            os.ftruncate(fd, 0)
+            os.write(fd, "%d\n" % size)
+            os.rename(partial, entry)
+        except:
+            tree.remove(partial)
+            raise
+        logger.debug("Added %s to the unpack cache (%d bytes)", key, size)
+
+    def release(self, key):
+        """Let go of an entry returned by acquire()."""
+        self._forked()
+        with self._lock:
+            held = self._held.get(key)
+            if held is None:
+                return
+            held[1] -= 1
+            if held[1] <= 0:
+                del self._held[key]
+                fcntl.flock(held[0], fcntl.LOCK_UN)
+                os.close(held[0])
+
+    def entries(self):
+        """Return (last used, size, key) for each entry, oldest first."""
+        ret = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return ret
+        for name in names:
+            if not name.endswith(".lock"):
+                continue
+            lockfile = os.path.join(self.directory, name)
+            try:
+                with open(lockfile) as f:
+                    size = int(f.read().strip() or 0)
+                mtime = os.stat(lockfile).st_mtime
+            except (IOError, OSError, ValueError):
+                continue
+            ret.append((mtime, size, name[:-len(".lock")]))
+        ret.sort()
+        return ret
+
+    def _remove_partials(self):
+        """Remove the trees left half built by processes that died."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            match = PARTIAL.search(name)
+            if match is not None and not _alive(int(match.group(1))):
+                logger.debug("Removing %s, left behind by process %s",
+                             name, match.group(1))
+                tree.remove(os.path.join(self.directory, name))
+
+    def evict(self, budget=None):
+        """Remove the least recently used entries that nobody is using
+        until the cache fits into budget bytes, which defaults to the
+        cache's own budget, and any trees left half built. Return the
+        number of bytes freed by evicting entries.
+        """
+        self._remove_partials()
+        if budget is None:
+            budget = self.budget
+        if budget is None:
+            return 0
+
+        entries = self.entries()
+        total = sum(size for mtime, size, key in entries)
+        freed = 0
+        removed = 0
+        for mtime, size, key in entries:
+            if total <= budget:
+                break
+            fd = self._open_locked(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if fd is None:
+                continue
+            try:
+                tree.remove(self.path(key))
+                tree.remove(manifest_file(self.path(key)))
+                os.unlink(self._lockfile(key))
+            finally:
+                os.close(fd)
+            total -= size
+            freed += size
+            removed += 1
+
+        if removed:
+            logger.info("Evicted %d unpacked trees (%d MiB) from %s, "
+                        "%d MiB left", removed, freed >> 20,
+                        self.directory, total >> 20)
+        return freed